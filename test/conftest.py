@@ -0,0 +1,53 @@
+"""Test configuration, host tools are imported as on the server."""
+import os
+import shutil
+import subprocess
+import sys
+import pytest
+
+HOST_TOOLS = os.path.join(os.path.dirname(__file__), "..", "tools", "host")
+sys.path[:0] = [HOST_TOOLS, os.path.join(HOST_TOOLS, "lib")]
+
+
+def openssl(command, cwd):
+    """Run openssl command in directory."""
+    subprocess.run(
+        ["openssl"] + command.split(),
+        cwd=cwd,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+@pytest.fixture(scope="session")
+def certs(tmp_path_factory):
+    """Generate CA, RSA and ECDSA server certificates and a client certificate.
+
+    Returns directory holding <name>.pem and <name>.key files.
+    """
+    if not shutil.which("openssl"):
+        pytest.skip("openssl not available")
+    path = tmp_path_factory.mktemp("certs")
+    keys = {
+        "ca": "rsa:2048",
+        "rsa": "rsa:2048",
+        "ec": "ec -pkeyopt ec_paramgen_curve:prime256v1",
+    }
+    for name, key in keys.items():
+        openssl(
+            "req -x509 -nodes -days 1 -subj /CN=flake-{name} -newkey {key}"
+            " -keyout {name}.key -out {name}.pem".format(name=name, key=key),
+            cwd=path,
+        )
+    openssl(
+        "req -nodes -newkey rsa:2048 -subj /CN=flake-client"
+        " -keyout client.key -out client.csr",
+        cwd=path,
+    )
+    openssl(
+        "x509 -req -days 1 -in client.csr -CA ca.pem -CAkey ca.key"
+        " -CAcreateserial -out client.pem",
+        cwd=path,
+    )
+    return path
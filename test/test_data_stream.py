@@ -0,0 +1,61 @@
+"""Data stream tests."""
+import pytest
+from data_stream import DataStream, BLOCK_SIZE, parse_rate, parse_size
+
+
+@pytest.mark.parametrize(
+    "size, expected", [("10B", 10), ("0.5MB", 512 * 1024), ("2 kb", 2048)]
+)
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+@pytest.mark.parametrize(
+    "rate, expected",
+    [("8mbit", 1000000), ("1.5 Gbit", 187500000), ("2kbps", 2000), ("800bit", 100)],
+)
+def test_parse_rate(rate, expected):
+    assert parse_rate(rate) == expected
+
+
+@pytest.mark.parametrize(
+    "path, data_type, size",
+    [
+        ("stream/text/1KB", "text", 1024),
+        ("/stream/binary/0.5 MB", "binary", 512 * 1024),
+        ("/stream/TEXT/10b", "text", 10),
+    ],
+)
+def test_from_path(path, data_type, size):
+    stream = DataStream.from_path(path)
+    assert (stream.data_type, stream.size) == (data_type, size)
+
+
+@pytest.mark.parametrize("path", ["/", "files/1MB.txt", "/streams/text/1MB"])
+def test_from_path_not_stream(path):
+    assert DataStream.from_path(path) is None
+
+
+@pytest.mark.parametrize(
+    "path",
+    [
+        "stream/text/1.2.3MB",
+        "stream/text/..MB",
+        "stream/text/MB",
+        "stream/text/1XB",
+        "stream/video/1MB",
+        "stream/text/1MB?size=2",
+    ],
+)
+def test_from_path_invalid(path):
+    with pytest.raises(ValueError):
+        DataStream.from_path(path)
+
+
+def test_read_range_across_blocks():
+    stream = DataStream("binary", 3 * BLOCK_SIZE)
+    data = stream.read()
+    assert len(data) == stream.size
+    start, end = BLOCK_SIZE - 10, 2 * BLOCK_SIZE + 10
+    assert stream.read(start, end) == data[start:end]
+    assert DataStream("binary", 3 * BLOCK_SIZE).read() == data
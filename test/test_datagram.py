@@ -0,0 +1,49 @@
+"""Batched datagram I/O tests, on local UDP sockets."""
+import socket
+import pytest
+import datagram
+
+
+def udp_socket():
+    """Return UDP socket bound to a free local port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(5)
+    return sock
+
+
+@pytest.mark.parametrize("mmsg", [True, False])
+def test_ring_round_trip(monkeypatch, mmsg):
+    if not mmsg:
+        monkeypatch.setattr(datagram, "LIBC", None)
+    elif datagram.LIBC is None:
+        pytest.skip("recvmmsg not available")
+    server = udp_socket()
+    clients = [udp_socket() for _ in range(3)]
+    sent = {}
+    try:
+        for i in range(12):
+            client = clients[i % 3]
+            payload = bytes([i]) * (100 * i + 1)
+            client.sendto(payload, server.getsockname())
+            sent.setdefault(client.getsockname(), []).append(payload)
+        ring = datagram.DatagramRing(server, batch=8, buffer_size=2048)
+        received = {}
+        counts = []
+        while sum(counts) < 12:
+            count = ring.recv()
+            counts.append(count)
+            for i in range(count):
+                received.setdefault(ring.addr(i), []).append(bytes(ring.payload(i)))
+            # Echo back the first half of each datagram
+            ring.reply(count, [(ring.lengths[i] + 1) // 2 for i in range(count)])
+        assert received == sent
+        # Queued datagrams are received in batches, one by one without recvmmsg
+        assert counts == ([8, 4] if mmsg else [1] * 12)
+        for client in clients:
+            for payload in sent[client.getsockname()]:
+                assert client.recv(2048) == payload[: (len(payload) + 1) // 2]
+    finally:
+        server.close()
+        for client in clients:
+            client.close()
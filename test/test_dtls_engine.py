@@ -0,0 +1,155 @@
+"""DTLS engine tests, with fake DTLS connections on local UDP sockets."""
+import socket
+import threading
+import pytest
+
+pytest.importorskip("dtls")
+import dtls_engine  # noqa: E402
+import udp_server  # noqa: E402
+
+
+def ssl_error(code):
+    """OpenSSL error raised by DTLS connections."""
+    return dtls_engine.openssl_error()(code, [], -1, None, ())
+
+
+class FakeConnection:
+    """DTLS connection reading records from a list, recording writes."""
+
+    def __init__(self, records=(), handshake=True):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.records = list(records)
+        self.handshake = handshake
+        self.writes = []
+        self.shut_down = False
+
+    def get_socket(self, inbound):
+        return self.sock
+
+    def do_handshake(self):
+        if not self.handshake:
+            raise ssl_error(dtls_engine.SSL_ERROR_WANT_READ)
+
+    def get_timeout(self):
+        return None
+
+    def handle_timeout(self):
+        pass
+
+    def read(self, size):
+        if not self.records:
+            raise ssl_error(dtls_engine.SSL_ERROR_ZERO_RETURN)
+        return self.records.pop(0)[:size]
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def shutdown(self):
+        self.shut_down = True
+
+
+class FakeListener:
+    """Listening connection accepting given connections."""
+
+    def __init__(self, accepted):
+        self.accepted = list(accepted)
+
+    def accept(self):
+        accepted = self.accepted.pop(0)
+        if isinstance(accepted, Exception):
+            raise accepted
+        return accepted
+
+
+def make_engine(handler, timeout=5, max_associations=4):
+    """DTLS engine serving associations with handler."""
+    return dtls_engine.DtlsEngine(
+        "DTLS TEST",
+        ("127.0.0.1", 0),
+        "cert.pem",
+        "key.pem",
+        handler,
+        timeout,
+        max_associations=max_associations,
+    )
+
+
+def test_association_served_then_removed():
+    served = []
+
+    def handler(association):
+        # Association is tracked while served
+        served.append(engine.associations.get(association.addr) is association)
+        association.write(association.read())
+
+    engine = make_engine(handler)
+    conn = FakeConnection([b"hello"])
+    addr = ("127.0.0.1", 40000)
+    association = engine.accept(FakeListener([(conn, addr)]))
+    engine.executor.shutdown()
+    assert served == [True]
+    assert engine.associations == {}
+    assert conn.writes == [b"hello"]
+    assert conn.shut_down
+    assert conn.sock.fileno() == -1
+    timing = association.timing()
+    assert timing["handshake"] is not None
+    assert (timing["bytes_received"], timing["bytes_sent"]) == (5, 5)
+
+
+def test_association_limit():
+    release = threading.Event()
+    engine = make_engine(lambda association: release.wait(5), max_associations=2)
+    conns = [FakeConnection() for _ in range(3)]
+    listener = FakeListener(
+        [(conn, ("127.0.0.1", 40000 + i)) for i, conn in enumerate(conns)]
+    )
+    try:
+        assert engine.accept(listener)
+        assert engine.accept(listener)
+        # Client beyond the limit is closed without being served
+        assert engine.accept(listener) is None
+        assert sorted(engine.associations) == [
+            ("127.0.0.1", 40000),
+            ("127.0.0.1", 40001),
+        ]
+        assert conns[2].sock.fileno() == -1
+        assert not conns[2].shut_down
+    finally:
+        release.set()
+        engine.executor.shutdown()
+    assert engine.associations == {}
+    assert all(conn.shut_down for conn in conns[:2])
+
+
+def test_handshake_timeout():
+    served = []
+    engine = make_engine(served.append, timeout=0.1)
+    conn = FakeConnection(handshake=False)
+    association = engine.accept(FakeListener([(conn, ("127.0.0.1", 40000))]))
+    engine.executor.shutdown()
+    assert served == []
+    assert association.handshake_time is None
+    assert engine.associations == {}
+    assert conn.sock.fileno() == -1
+    assert not conn.shut_down
+
+
+@pytest.mark.parametrize("accepted", [None, ValueError("bad cookie")])
+def test_client_hello_rejected(accepted):
+    engine = make_engine(lambda association: None)
+    assert engine.accept(FakeListener([accepted])) is None
+    assert engine.associations == {}
+
+
+def test_echo_handler():
+    server = udp_server.UdpServer.__new__(udp_server.UdpServer)
+    server.name = "DTLS ECHO SERVER"
+    server.log_packets = False
+    engine = make_engine(server.dtls_echo)
+    conn = FakeConnection([b"ping", b"pong"])
+    engine.accept(FakeListener([(conn, ("127.0.0.1", 40000))]))
+    engine.executor.shutdown()
+    assert conn.writes == [b"ping", b"pong"]
+    assert conn.shut_down
@@ -0,0 +1,189 @@
+"""Dynamic HTTP server tests."""
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlencode
+import pytest
+import dynamic_http
+from data_stream import DataStream
+
+
+class FakeClient:
+    """Echo client running until cancelled."""
+
+    def __init__(self, address, port, message, echo, mode, local_port, timeout):
+        self.address = address
+        self.port = port
+        self.echo = echo
+        self.state = "created"
+        self.stopped = threading.Event()
+
+    def run(self):
+        self.state = "running"
+        self.stopped.wait(5)
+        self.state = "cancelled"
+
+    def cancel(self):
+        self.stopped.set()
+
+    def stats(self):
+        return {"state": self.state}
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """HTTP server serving from a thread, with fake echo client jobs."""
+    monkeypatch.setattr(dynamic_http, "EchoClient", FakeClient)
+    httpd = dynamic_http.ThreadingHTTPServer(
+        ("127.0.0.1", 0), dynamic_http.RequestHandler
+    )
+    httpd.job_engine = dynamic_http.JobEngine(max_jobs=2, history=4)
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+    thread.join()
+    for job in httpd.job_engine.list():
+        job.client.cancel()
+    httpd.job_engine.executor.shutdown()
+
+
+def request(server, path, method="GET", headers=None, body=None):
+    """Send request to server, return response and body."""
+    conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        rsp = conn.getresponse()
+        return rsp, rsp.read()
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize(
+    "byte_range, status, start, end",
+    [
+        (None, 200, 0, 1024),
+        ("bytes=100-199", 206, 100, 200),
+        ("bytes=1000-", 206, 1000, 1024),
+        ("bytes=-10", 206, 1014, 1024),
+        ("bytes=-2000", 206, 0, 1024),
+    ],
+)
+def test_get_stream(server, byte_range, status, start, end):
+    headers = {"Range": byte_range} if byte_range else {}
+    rsp, body = request(server, "/stream/text/1KB", headers=headers)
+    assert rsp.status == status
+    assert body == DataStream("text", 1024).read(start, end)
+    if byte_range:
+        assert rsp.headers["Content-Range"] == "bytes %d-%d/1024" % (start, end - 1)
+
+
+@pytest.mark.parametrize("byte_range", ["bytes=-0", "bytes=1024-", "bytes=5-2", "x"])
+def test_get_stream_range_not_satisfiable(server, byte_range):
+    rsp, body = request(server, "/stream/text/1KB", headers={"Range": byte_range})
+    assert rsp.status == 416
+    assert rsp.headers["Content-Range"] == "bytes */1024"
+    assert body == b""
+
+
+@pytest.mark.parametrize("method", ["GET", "HEAD"])
+@pytest.mark.parametrize("path", ["/stream/text/1.2.3MB", "/stream/video/1MB"])
+def test_invalid_stream_path(server, method, path):
+    rsp, body = request(server, path, method=method)
+    assert rsp.status == 400
+    assert (b"Invalid stream path" in body) == (method == "GET")
+
+
+def test_head_stream(server):
+    rsp, body = request(server, "/stream/binary/2KB", method="HEAD")
+    assert rsp.status == 200
+    assert rsp.headers["Content-Length"] == "2048"
+    assert body == b""
+
+
+JOB = {"service": "tcp_client", "address": "127.0.0.1", "port": 7, "echo": True}
+
+
+def request_json(server, path, method="GET", data=None):
+    """Send JSON request to server, return response status and JSON body."""
+    body = None if data is None else json.dumps(data)
+    headers = {"Content-Type": "application/json"}
+    rsp, body = request(server, path, method=method, headers=headers, body=body)
+    assert rsp.headers["Content-type"] == "application/json"
+    return rsp.status, json.loads(body)
+
+
+def wait_state(server, job_id, state):
+    """Wait for job to reach state."""
+    deadline = time.monotonic() + 5
+    while request_json(server, "/jobs/%d" % job_id)[1]["state"] != state:
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def test_jobs_api(server):
+    status, job = request_json(server, "/jobs", "POST", JOB)
+    assert status == 201
+    assert job["id"] == 1
+    assert (job["service"], job["address"], job["port"]) == (
+        "tcp_client",
+        "127.0.0.1",
+        7,
+    )
+    wait_state(server, 1, "running")
+    status, job = request_json(server, "/jobs/1")
+    assert status == 200
+    assert job["started"] and not job["ended"]
+    status, _ = request_json(server, "/jobs", "POST", dict(JOB, port="8"))
+    assert status == 201
+    status, jobs = request_json(server, "/jobs")
+    assert status == 200
+    assert [(job["id"], job["port"]) for job in jobs] == [(1, 7), (2, 8)]
+    status, job = request_json(server, "/jobs/1", "DELETE")
+    assert status == 200
+    assert job["id"] == 1
+    wait_state(server, 1, "cancelled")
+    assert request_json(server, "/jobs/1")[1]["ended"]
+
+
+def test_jobs_limit(server):
+    for _ in range(2):
+        assert request_json(server, "/jobs", "POST", JOB)[0] == 201
+    assert request_json(server, "/jobs", "POST", JOB) == (
+        503,
+        {"error": "Too many jobs"},
+    )
+    # Cancelled jobs leave room for new ones
+    request_json(server, "/jobs/2", "DELETE")
+    wait_state(server, 2, "cancelled")
+    assert request_json(server, "/jobs", "POST", JOB)[0] == 201
+
+
+@pytest.mark.parametrize("method", ["GET", "DELETE"])
+@pytest.mark.parametrize("path", ["/jobs/0", "/jobs/1", "/jobs/99/"])
+def test_unknown_job(server, method, path):
+    assert request_json(server, path, method) == (404, {"error": "Unknown job"})
+
+
+@pytest.mark.parametrize(
+    "data", [{}, dict(JOB, service="ftp_client"), dict(JOB, port="http")]
+)
+def test_bad_job_request(server, data):
+    assert request_json(server, "/jobs", "POST", data) == (
+        400,
+        {"error": "Bad Request"},
+    )
+    assert server.job_engine.list() == []
+
+
+def test_form_request_starts_job(server):
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    body = urlencode(dict(JOB, message="Hello"))
+    rsp, page = request(server, "/", "POST", headers=headers, body=body)
+    assert rsp.status == 200
+    assert b"starting tcp_client (job 1)" in page
+    (job,) = server.job_engine.list()
+    assert job.client.port == 7
+    assert job.client.echo == "True"
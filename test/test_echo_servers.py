@@ -0,0 +1,278 @@
+"""Echo servers tests, served from a local event loop."""
+import asyncio
+import functools
+import multiprocessing
+import os
+import select
+import socket
+import struct
+import time
+import pytest
+import echo_servers
+
+
+def listening_socket(linger=False):
+    """Return socket listening on a free local port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if linger:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(5)
+    return sock
+
+
+async def kill_server_command(command):
+    """Send command to kill server connection, return what the client reads."""
+    sock = listening_socket(linger=True)
+    handler = functools.partial(echo_servers.tcp_handle, timeout=5, killable=True)
+    server = await asyncio.start_server(handler, sock=sock)
+    reader, writer = await asyncio.open_connection(*sock.getsockname())
+    try:
+        writer.write(b"echo")
+        assert await reader.read(100) == b"echo"
+        writer.write(command)
+        return await reader.read(100)
+    finally:
+        writer.close()
+        server.close()
+
+
+@pytest.mark.parametrize("command", [b"kill", b"stop"])
+def test_kill_server_resets_connection(command):
+    with pytest.raises(ConnectionResetError):
+        asyncio.run(kill_server_command(command))
+
+
+async def echo_round_trip(payloads):
+    """Send payloads through TCP echo handler, return what is read back."""
+    loop = asyncio.get_running_loop()
+    server, client = socket.socketpair()
+    server.setblocking(False)
+    client.setblocking(False)
+    handler = loop.create_task(echo_servers.tcp_echo(server, 5))
+    received = []
+
+    async def read(size):
+        data = b""
+        while len(data) < size:
+            data += await loop.sock_recv(client, size - len(data))
+        return data
+
+    for payload in payloads:
+        # Read while sending, the handler only reads once echoed data is sent
+        _, data = await asyncio.gather(
+            loop.sock_sendall(client, payload), read(len(payload))
+        )
+        received.append(data)
+    client.close()
+    await asyncio.wait_for(handler, 5)
+    return received
+
+
+def test_tcp_echo_round_trip():
+    payloads = [b"hello", bytes(range(256)) * 1024, b"bye"]
+    assert asyncio.run(echo_round_trip(payloads)) == payloads
+    # Receive buffers are back in the pool once echoed
+    assert echo_servers._buffers
+
+
+async def flood_without_reading(timeout):
+    """Send to TCP echo handler without reading back, until it closes."""
+    loop = asyncio.get_running_loop()
+    server, client = socket.socketpair()
+    server.setblocking(False)
+    client.setblocking(False)
+    handler = loop.create_task(echo_servers.tcp_echo(server, timeout))
+    while not handler.done():
+        try:
+            client.send(bytes(echo_servers.max_buffer))
+        except BlockingIOError:
+            await asyncio.sleep(0.01)
+        except OSError:
+            break
+    client.close()
+    await asyncio.wait_for(handler, 5)
+
+
+def test_tcp_echo_send_timeout():
+    asyncio.run(asyncio.wait_for(flood_without_reading(0.2), 5))
+
+
+async def concurrent_echoes(count):
+    """Echo a message over count connections at once."""
+    loop = asyncio.get_running_loop()
+    pairs = [socket.socketpair() for _ in range(count)]
+    handlers = []
+    for server, client in pairs:
+        server.setblocking(False)
+        client.setblocking(False)
+        handlers.append(loop.create_task(echo_servers.tcp_echo(server, 5)))
+    # Every connection holds a buffer while its echo is pending
+    for _, client in pairs:
+        client.send(b"ping")
+    await asyncio.sleep(0.1)
+    for _, client in pairs:
+        assert await loop.sock_recv(client, 4) == b"ping"
+        client.close()
+    await asyncio.wait_for(asyncio.gather(*handlers), 5)
+
+
+def test_tcp_echo_buffer_pool_bounded(monkeypatch):
+    monkeypatch.setattr(echo_servers, "_buffers", [])
+    monkeypatch.setattr(echo_servers, "max_pooled_buffers", 4)
+    asyncio.run(concurrent_echoes(16))
+    assert len(echo_servers._buffers) == 4
+
+
+async def echo_throughput(handler, size):
+    """Echo size bytes through handler, returns bytes echoed per second."""
+    loop = asyncio.get_running_loop()
+    server, client = socket.socketpair()
+    server.setblocking(False)
+    client.setblocking(False)
+    if handler == "tcp_echo":
+        task = loop.create_task(echo_servers.tcp_echo(server, 5))
+    else:
+        reader, writer = await asyncio.open_connection(
+            sock=server, limit=echo_servers.max_buffer
+        )
+        task = loop.create_task(echo_servers.tcp_handle(reader, writer, 5))
+    payload = bytes(echo_servers.max_buffer)
+
+    async def send():
+        for _ in range(size // len(payload)):
+            await loop.sock_sendall(client, payload)
+
+    async def receive():
+        received = 0
+        while received < size:
+            received += len(await loop.sock_recv(client, echo_servers.max_buffer))
+
+    start = time.monotonic()
+    await asyncio.gather(send(), receive())
+    elapsed = time.monotonic() - start
+    client.close()
+    await asyncio.wait_for(task, 5)
+    return size / elapsed
+
+
+def test_tcp_echo_throughput(monkeypatch, record_property):
+    # Compare data paths only, the stream handler logs every read
+    monkeypatch.setattr(echo_servers.flog, "debug", lambda message: None)
+    size = 1024 * echo_servers.max_buffer
+    rates = {
+        handler: max(asyncio.run(echo_throughput(handler, size)) for _ in range(3))
+        for handler in ("tcp_echo", "tcp_handle")
+    }
+    for handler, rate in rates.items():
+        record_property("%s_bytes_per_second" % handler, rate)
+    assert rates["tcp_echo"] > rates["tcp_handle"]
+
+
+ECHO_CONFIG = {
+    "tcp_udp": {"port": "0", "timeout": "5"},
+    "tcp_kill_server": {"port": "0", "polling_port": "0"},
+}
+
+
+def udp_workers(count):
+    """Return echo workers with UDP sockets bound to a shared local port."""
+    workers = [echo_servers.EchoServer(ECHO_CONFIG) for _ in range(count)]
+    workers[0].udp_server.bind(("127.0.0.1", 0))
+    for worker in workers[1:]:
+        worker.udp_server.bind(workers[0].udp_server.getsockname())
+    return workers
+
+
+def close_workers(workers):
+    """Close sockets of echo workers."""
+    for worker in workers:
+        worker.tcp_server.close()
+        worker.udp_server.close()
+        worker.tcp_kill_server.close()
+        worker.tcp_local_poll_server.close()
+
+
+def test_workers_share_udp_port():
+    workers = udp_workers(2)
+    servers = [worker.udp_server for worker in workers]
+    clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(32)]
+    received = [0, 0]
+    try:
+        for client in clients:
+            client.sendto(b"ping", servers[0].getsockname())
+        while sum(received) < len(clients):
+            readable, _, _ = select.select(servers, [], [], 5)
+            assert readable, "Timed out"
+            for sock in readable:
+                sock.recv(echo_servers.max_buffer)
+                received[servers.index(sock)] += 1
+    finally:
+        for sock in clients:
+            sock.close()
+        close_workers(workers)
+    # Flows of the clients are balanced between both workers
+    assert all(received)
+
+
+def echo_load(address, duration, results, flows=16, window=4):
+    """Keep datagrams in flight to address from several flows, count echoes."""
+    clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(flows)]
+    echoes = 0
+    for client in clients:
+        client.connect(address)
+        client.setblocking(False)
+        for _ in range(window):
+            client.send(b"x" * 64)
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        readable, _, _ = select.select(clients, [], [], 0.1)
+        for client in readable:
+            try:
+                while True:
+                    client.recv(echo_servers.max_buffer)
+                    echoes += 1
+                    client.send(b"x" * 64)
+            except BlockingIOError:
+                pass
+    results.put(echoes)
+
+
+def udp_echo_rate(worker_count, duration=1, loaders=2):
+    """Measure datagrams echoed per second by worker processes."""
+    context = multiprocessing.get_context("fork")
+    workers = udp_workers(worker_count)
+    address = workers[0].udp_server.getsockname()
+    processes = [
+        context.Process(target=worker.udp_handle, daemon=True) for worker in workers
+    ]
+    for process in processes:
+        process.start()
+    close_workers(workers)
+    results = context.Queue()
+    clients = [
+        context.Process(target=echo_load, args=(address, duration, results))
+        for _ in range(loaders)
+    ]
+    try:
+        for client in clients:
+            client.start()
+        echoes = sum(results.get(timeout=duration + 10) for _ in clients)
+    finally:
+        for process in processes + clients:
+            process.terminate()
+            process.join()
+    return echoes / duration
+
+
+def test_udp_echo_rate_per_worker_count(record_property):
+    workers = 4
+    single = udp_echo_rate(1)
+    multiple = udp_echo_rate(workers)
+    record_property("datagrams_per_second_1_worker", single)
+    record_property("datagrams_per_second_%d_workers" % workers, multiple)
+    assert single > 0
+    assert multiple > 0
+    # Workers only add throughput with cores to run them and the load
+    if len(os.sched_getaffinity(0)) >= 2 * workers:
+        assert multiple > 1.5 * single
@@ -0,0 +1,326 @@
+"""Data file generator tests."""
+import errno
+import hashlib
+import json
+import os
+import struct
+import subprocess
+import sys
+import tracemalloc
+import pytest
+
+np = pytest.importorskip("numpy")
+import file_manager  # noqa: E402
+
+
+def data_file(handler, extension, tmp_path):
+    """Data file handler writing to tmp_path."""
+    config = {"base_name": "data_", "extension": extension, "size_list": ["1MB"]}
+    return handler(config, {"files": {"location": str(tmp_path)}})
+
+
+def test_audio_file(tmp_path, monkeypatch):
+    wavfile = pytest.importorskip("scipy.io.wavfile")
+    monkeypatch.setattr(file_manager, "WRITE_CHUNK_SIZE", 64 * 1024)
+    audio = data_file(file_manager.AudioFile, ".wav", tmp_path)
+    audio.create_file("1MB")
+    rate, samples = wavfile.read(audio._generate_file_path("1MB"))
+    assert rate == 44100
+    assert samples.dtype == np.float64
+    assert len(samples) == int(44100 * (1024 * 1024 / 352830))
+    expected = np.sin(2 * np.pi * 440 * np.arange(len(samples)) / 44100)
+    assert np.allclose(samples, expected)
+
+
+@pytest.mark.parametrize("chunk_size", [64 * 1024, file_manager.WRITE_CHUNK_SIZE])
+def test_image_file(tmp_path, monkeypatch, chunk_size):
+    image = pytest.importorskip("PIL.Image")
+    monkeypatch.setattr(file_manager, "WRITE_CHUNK_SIZE", chunk_size)
+    tiff = data_file(file_manager.ImageFile, ".tiff", tmp_path)
+    tiff.create_file("1MB")
+    with image.open(tiff._generate_file_path("1MB")) as im:
+        assert im.mode == "F"
+        assert im.size == (512, 512)
+        pixels = np.asarray(im)
+    assert 0 <= pixels.min() and pixels.max() < 1
+    # Strips are random rows, not a repeated one
+    assert len(np.unique(pixels[:, 0])) == 512
+
+
+@pytest.mark.parametrize(
+    "handler, extension",
+    [(file_manager.AudioFile, ".wav"), (file_manager.ImageFile, ".tiff")],
+)
+def test_memory_bounded_by_chunk_size(tmp_path, monkeypatch, handler, extension):
+    monkeypatch.setattr(file_manager, "WRITE_CHUNK_SIZE", 256 * 1024)
+    generator = data_file(handler, extension, tmp_path)
+    tracemalloc.start()
+    try:
+        generator.create_file("16MB")
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # Whole file arrays would take at least the file size
+    assert peak < 2 * 1024 * 1024
+
+
+@pytest.fixture
+def video(tmp_path, monkeypatch):
+    """Video file handler of the repository template."""
+    tools = os.path.join(os.path.dirname(file_manager.__file__), "..")
+    monkeypatch.setenv("FLAKE_TOOLS", os.path.abspath(tools))
+    return data_file(file_manager.VideoFile, ".avi", tmp_path)
+
+
+def avi_chunks(data):
+    """Return RIFF chunks of AVI file data."""
+    assert data[:4] == b"RIFF" and data[8:12] == b"AVI "
+    assert struct.unpack_from("<I", data, 4)[0] == len(data) - 8
+    return dict(file_manager.riff_chunks(data, 12, len(data)))
+
+
+def test_video_template_unchanged(video):
+    video.create_file("0.5MB")
+    with open(video.template, "rb") as template:
+        expected = template.read()
+    with open(video._generate_file_path("0.5MB"), "rb") as f:
+        assert f.read() == expected
+
+
+@pytest.mark.parametrize("size, copies", [("1MB", 2), ("2.5MB", 5), ("10MB", 20)])
+def test_video_repeats_template_frames(video, size, copies):
+    with open(video.template, "rb") as template:
+        template_data = template.read()
+    template_chunks = avi_chunks(template_data)
+    video.create_file(size)
+    with open(video._generate_file_path(size), "rb") as f:
+        data = f.read()
+    chunks = avi_chunks(data)
+    movi_offset, movi_size = chunks[b"movi"]
+    template_movi_offset, template_movi_size = template_chunks[b"movi"]
+    assert movi_size == 4 + (template_movi_size - 4) * copies
+    frames = template_data[
+        template_movi_offset + 12 : template_movi_offset + 8 + template_movi_size
+    ]
+    assert data[movi_offset + 12 : movi_offset + 8 + movi_size] == frames * copies
+    # avih total frames and video stream length
+    assert struct.unpack_from("<I", data, 48)[0] == 24 * copies
+    assert struct.unpack_from("<I", data, 140)[0] == 24 * copies
+    # Every index entry points to a chunk of its id and size
+    idx1_offset, idx1_size = chunks[b"idx1"]
+    assert idx1_size == 24 * 16 * copies
+    for entry in range(idx1_offset + 8, idx1_offset + 8 + idx1_size, 16):
+        chunk_id, _, offset, size = struct.unpack_from("<4sIII", data, entry)
+        assert struct.unpack_from("<4sI", data, movi_offset + 8 + offset) == (
+            chunk_id,
+            size,
+        )
+
+
+MEASURE = """
+import sys, time
+import file_manager
+
+
+def rss(field):
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+
+
+handler = getattr(file_manager, sys.argv[1])(
+    {"base_name": "data_", "extension": sys.argv[2], "size_list": []},
+    {"files": {"location": sys.argv[3]}},
+)
+# Reset peak RSS
+with open("/proc/self/clear_refs", "w") as clear_refs:
+    clear_refs.write("5")
+start_rss = rss("VmRSS:")
+start = time.monotonic()
+handler.create_file(sys.argv[4])
+print(time.monotonic() - start, rss("VmHWM:") - start_rss)
+"""
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/clear_refs"), reason="Linux only")
+@pytest.mark.parametrize(
+    "handler, extension",
+    [("AudioFile", ".wav"), ("ImageFile", ".tiff"), ("VideoFile", ".avi")],
+)
+@pytest.mark.parametrize("size", ["1MB", "64MB"])
+def test_time_and_rss_per_size(
+    tmp_path, video, record_property, handler, extension, size
+):
+    # Fresh process per size, peak RSS is reset before creating the file
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE, handler, extension, str(tmp_path), size],
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    ).stdout
+    elapsed, rss_growth = output.splitlines()[-1].split()
+    record_property("seconds", float(elapsed))
+    record_property("peak_rss_growth", int(rss_growth))
+    # Whole file arrays would take at least the file size
+    assert int(rss_growth) < 16 * 1024 * 1024
+
+
+@pytest.fixture
+def text(tmp_path):
+    """Text file handler with a configured 1MB file."""
+    handler = data_file(file_manager.TextFile, ".txt", tmp_path)
+    handler.configure()
+    return handler
+
+
+def test_up_to_date_file_kept(text):
+    manifest = text.read_manifest()
+    assert text.check_file("1MB", manifest)
+    assert text.verify_file("1MB", manifest)
+    assert text.pending_sizes() == []
+
+
+def change_file(path, change, monkeypatch):
+    """Change size, mtime or generator version of file, keeping the rest."""
+    stat = os.stat(path)
+    if change == "size":
+        os.truncate(path, stat.st_size - 1)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    elif change == "mtime":
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    else:
+        monkeypatch.setattr(
+            file_manager, "GENERATOR_VERSION", file_manager.GENERATOR_VERSION + 1
+        )
+
+
+@pytest.mark.parametrize("change", ["size", "mtime", "version"])
+def test_changed_file_regenerated(text, monkeypatch, change):
+    path = text._generate_file_path("1MB")
+    entry = text.read_manifest()[os.path.basename(path)]
+    change_file(path, change, monkeypatch)
+    assert not text.check_file("1MB", text.read_manifest())
+    assert text.pending_sizes() == ["1MB"]
+    text.configure()
+    manifest = text.read_manifest()
+    assert manifest[os.path.basename(path)]["seed"] != entry["seed"]
+    assert os.path.getsize(path) == 1024 * 1024
+    assert text.check_file("1MB", manifest)
+
+
+def test_corrupted_file_fails_verify(text):
+    path = text._generate_file_path("1MB")
+    stat = os.stat(path)
+    with open(path, "r+b") as f:
+        f.seek(1000)
+        byte = f.read(1)
+        f.seek(1000)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    manifest = text.read_manifest()
+    # Same size and mtime, only the digest tells
+    assert text.check_file("1MB", manifest)
+    assert not text.verify_file("1MB", manifest)
+
+
+@pytest.mark.parametrize("copy_file_range", ["available", "missing", "failing"])
+def test_derived_files_are_source_prefixes(tmp_path, monkeypatch, copy_file_range):
+    if copy_file_range == "missing":
+        monkeypatch.delattr(os, "copy_file_range", raising=False)
+    elif copy_file_range == "failing":
+
+        def unsupported(*args):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+        monkeypatch.setattr(os, "copy_file_range", unsupported, raising=False)
+    sendfile_calls = []
+
+    def sendfile(*args):
+        sendfile_calls.append(args)
+        return real_sendfile(*args)
+
+    real_sendfile = os.sendfile
+    monkeypatch.setattr(os, "sendfile", sendfile)
+    config = {
+        "base_name": "data_",
+        "extension": ".bin",
+        "size_list": ["1KB", "0.5MB", "1MB", "3.3MB", "4MB"],
+        "derive_from_largest": True,
+    }
+    binary = file_manager.BinaryFile(config, {"files": {"location": str(tmp_path)}})
+    binary.configure()
+    with open(binary._generate_file_path("4MB"), "rb") as f:
+        source = f.read()
+    manifest = binary.read_manifest()
+    for size in config["size_list"][:-1]:
+        with open(binary._generate_file_path(size), "rb") as f:
+            assert f.read() == source[: file_manager.parse_size(size)]
+        assert manifest["data_%s.bin" % size]["source"] == "data_4MB.bin"
+    assert bool(sendfile_calls) == (copy_file_range != "available")
+
+
+DATA_FILES = {
+    "text": {
+        "base_name": "data_",
+        "extension": ".txt",
+        "derive_from_largest": True,
+        "size_list": ["0.5MB", "1MB", "2MB"],
+    },
+    "binary": {
+        "base_name": "data_",
+        "extension": ".bin",
+        "size_list": ["0.5MB", "1MB"],
+    },
+    "image": {
+        "base_name": "data_",
+        "extension": ".tiff",
+        "size_list": ["0.5MB", "1MB"],
+    },
+    "video": {"base_name": "data_", "extension": ".avi", "size_list": ["0.5MB", "1MB"]},
+    "audio": {"base_name": "data_", "extension": ".wav", "size_list": ["0.5MB", "1MB"]},
+}
+# Generated from a template or a formula, not from a random seed
+DETERMINISTIC = ("video", "audio")
+
+
+def configured_files(tmp_path, monkeypatch, name, processes):
+    """Configure DATA_FILES with processes, return files and manifest per type."""
+    server = tmp_path / name
+    monkeypatch.setenv("FLAKE_SERVER", str(server))
+    config_file = tmp_path / "data_files.json"
+    config_file.write_text(json.dumps(DATA_FILES))
+    assert file_manager.configure_files(
+        config_file=str(config_file), processes=processes
+    )
+    configured = {}
+    for data_type in DATA_FILES:
+        folder = server / "public" / "files" / data_type
+        files = {
+            path.name: path.read_bytes()
+            for path in folder.iterdir()
+            if path.name != file_manager.MANIFEST
+        }
+        manifest = json.loads((folder / file_manager.MANIFEST).read_text())
+        configured[data_type] = files, manifest
+    return configured
+
+
+def test_parallel_configure_matches_serial(tmp_path, monkeypatch, video):
+    serial = configured_files(tmp_path, monkeypatch, "serial", 1)
+    parallel = configured_files(tmp_path, monkeypatch, "parallel", 4)
+    for data_type in DATA_FILES:
+        serial_files, serial_manifest = serial[data_type]
+        files, manifest = parallel[data_type]
+        assert sorted(files) == sorted(manifest) == sorted(serial_manifest)
+        if data_type in DETERMINISTIC:
+            assert files == serial_files
+        for name, entry in manifest.items():
+            assert entry["digest"] == hashlib.blake2b(files[name]).hexdigest()
+            if entry["source"]:
+                assert files[entry["source"]].startswith(files[name])
+            expected = dict(serial_manifest[name], mtime_ns=entry["mtime_ns"])
+            if data_type not in DETERMINISTIC:
+                expected.update(seed=entry["seed"], digest=entry["digest"])
+            assert entry == expected
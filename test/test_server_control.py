@@ -0,0 +1,88 @@
+"""Server control tests."""
+import pytest
+
+pytest.importorskip("numpy")
+import server_control  # noqa: E402
+
+
+class StopSupervisor(Exception):
+    """Raised to end the supervisor loop."""
+
+
+class FakeProcess:
+    """Worker process, exited once poll count reaches exit_after."""
+
+    def __init__(self, exit_after=None):
+        self.exit_after = exit_after
+        self.polls = 0
+        self.returncode = None
+
+    def poll(self):
+        self.polls += 1
+        if self.exit_after is not None and self.polls >= self.exit_after:
+            self.returncode = -9
+        return self.returncode
+
+
+@pytest.fixture
+def supervisor(tmp_path, monkeypatch):
+    """Server whose worker starts are recorded instead of run."""
+    (tmp_path / "logs").mkdir()
+    server = server_control.Server.__new__(server_control.Server)
+    server.server_root = str(tmp_path)
+    server.started = []
+
+    def start_worker(service, index):
+        server.started.append((service, index))
+        # First worker dies on first check
+        return FakeProcess(exit_after=1 if len(server.started) == 1 else None)
+
+    def sleep(_):
+        if server.sleeps == 0:
+            raise StopSupervisor()
+        server.sleeps -= 1
+
+    server.sleeps = 1
+    monkeypatch.setattr(server, "_start_worker", start_worker, raising=False)
+    monkeypatch.setattr(server_control.time, "sleep", sleep)
+    monkeypatch.setattr(server_control.os, "cpu_count", lambda: 3)
+    return server
+
+
+def set_workers(monkeypatch, udp, tcp_udp):
+    """Set worker counts of supervised services."""
+    config = {"udp": {"workers": udp}, "tcp_udp": {"workers": tcp_udp}}
+    monkeypatch.setattr(server_control, "ServerConfig", lambda: config)
+
+
+def test_supervise_starts_workers(supervisor, monkeypatch):
+    set_workers(monkeypatch, "2", "auto")
+    with pytest.raises(StopSupervisor):
+        supervisor.supervise()
+    assert supervisor.started[:5] == [
+        ("udp_server", 0),
+        ("udp_server", 1),
+        ("echo_servers", 0),
+        ("echo_servers", 1),
+        ("echo_servers", 2),
+    ]
+
+
+def test_supervise_restarts_dead_worker(supervisor, monkeypatch):
+    set_workers(monkeypatch, "2", "auto")
+    with pytest.raises(StopSupervisor):
+        supervisor.supervise()
+    assert supervisor.started[5:] == [("udp_server", 0)]
+
+
+def test_supervise_default_single_worker(supervisor, monkeypatch):
+    monkeypatch.setattr(
+        server_control, "ServerConfig", lambda: {"udp": {}, "tcp_udp": {}}
+    )
+    with pytest.raises(StopSupervisor):
+        supervisor.supervise()
+    assert supervisor.started == [
+        ("udp_server", 0),
+        ("echo_servers", 0),
+        ("udp_server", 0),
+    ]
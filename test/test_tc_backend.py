@@ -0,0 +1,356 @@
+"""Traffic control backend tests.
+
+Both backends are run against tc output and rtnetlink messages recorded from
+a kernel with htb class 1:a (class id 10) and port 8080 filters in the port
+hash tables.
+"""
+import json
+import struct
+import pytest
+import rtnetlink
+import tc_backend
+import traffic_manager
+
+
+CLASS_SHOW = (
+    "class htb 1:a root prio 0 rate 100Mbit ceil 100Mbit burst 1600b cburst 1600b"
+)
+QDISC_SHOW = [
+    {
+        "kind": "htb",
+        "handle": "1:",
+        "root": True,
+        "refcnt": 2,
+        "options": {
+            "r2q": 10,
+            "default": "0",
+            "direct_packets_stat": 0,
+            "direct_qlen": 32,
+        },
+    }
+]
+# Recording kernel has no netem, as listed by tc on a kernel with netem
+NETEM_SHOW = {
+    "kind": "netem",
+    "handle": "8001:",
+    "parent": "1:a",
+    "options": {
+        "limit": 1000,
+        "delay": {"delay": 0.05, "jitter": 0, "correlation": 0},
+        "loss-random": {"loss": 0.02, "correlation": 0},
+        "ecn": False,
+        "gap": 0,
+    },
+}
+FILTER_SHOW = [
+    {"parent": "1:", "protocol": "ip", "pref": 1, "kind": "u32", "chain": 0},
+    {
+        "parent": "1:",
+        "protocol": "ip",
+        "pref": 1,
+        "kind": "u32",
+        "chain": 0,
+        "options": {"fh": "200:", "ht_divisor": 256},
+    },
+    {
+        "parent": "1:",
+        "protocol": "ip",
+        "pref": 1,
+        "kind": "u32",
+        "chain": 0,
+        "options": {
+            "fh": "200:90:800",
+            "order": 2048,
+            "key_ht": "200",
+            "bkt": "90",
+            "flowid": "1:a",
+            "not_in_hw": True,
+            "match": {
+                "value": "1f900000",
+                "mask": "ffff0000",
+                "offmask": "",
+                "off": 20,
+            },
+        },
+    },
+    {
+        "parent": "1:",
+        "protocol": "ip",
+        "pref": 1,
+        "kind": "u32",
+        "chain": 0,
+        "options": {"fh": "100:", "ht_divisor": 256},
+    },
+    {
+        "parent": "1:",
+        "protocol": "ip",
+        "pref": 1,
+        "kind": "u32",
+        "chain": 0,
+        "options": {
+            "fh": "100:90:800",
+            "order": 2048,
+            "key_ht": "100",
+            "bkt": "90",
+            "flowid": "1:a",
+            "not_in_hw": True,
+            "match": {"value": "1f90", "mask": "ffff", "offmask": "", "off": 20},
+        },
+    },
+    {
+        "parent": "1:",
+        "protocol": "ip",
+        "pref": 1,
+        "kind": "u32",
+        "chain": 0,
+        "options": {"fh": "800:", "ht_divisor": 1},
+    },
+    {
+        "parent": "1:",
+        "protocol": "ip",
+        "pref": 1,
+        "kind": "u32",
+        "chain": 0,
+        "options": {
+            "fh": "800::800",
+            "order": 2048,
+            "key_ht": "800",
+            "bkt": "0",
+            "link": "100:",
+            "not_in_hw": True,
+            "match": {"value": "0", "mask": "0", "offmask": "", "off": 0},
+            "hash_mask": "ff",
+            "hash_off": 20,
+        },
+    },
+    {
+        "parent": "1:",
+        "protocol": "ip",
+        "pref": 1,
+        "kind": "u32",
+        "chain": 0,
+        "options": {
+            "fh": "800::801",
+            "order": 2049,
+            "key_ht": "800",
+            "bkt": "0",
+            "link": "200:",
+            "not_in_hw": True,
+            "match": {"value": "0", "mask": "0", "offmask": "", "off": 0},
+            "hash_mask": "ff0000",
+            "hash_off": 20,
+        },
+    },
+]
+# rtnetlink dump replies, device ifindex 2
+QDISC_DUMP = [
+    bytes.fromhex(
+        "940000002400020001000000da1c0000000000000100000000000000ffffffff020000000c00"
+        "01006e6f71756575650005000c00000000003000070014000100000000000000000000000000"
+        "000000001800030000000000000000000000000000000000000000002c000300000000000000"
+        "00000000000000000000000000000000000000000000000000000000000000000000b4000000"
+        "2400020001000000da1c0000000000000200000000000100ffffffff02000000080001006874"
+        "62002400020018000200110003000a0000000000000000000000000000000800050020000000"
+        "05000c0000000000300007001400010000000000000000000000000000000000180003000000"
+        "0000000000000000000000000000000000002c00030000000000000000000000000000000000"
+        "000000000000000000000000000000000000000000000000b00000002400020001000000da1c"
+        "0000000000000400000000000000ffffffff020000000f000100706669666f5f666173740000"
+        "18000200030000000102020201020000010101010101010105000c0000000000300007001400"
+        "01004bfb00000000000030020000000000001800030000000000000000000000000000000000"
+        "000000002c0003004bfb00000000000030020000000000000000000000000000000000000000"
+        "00000000000000000000"
+    ),
+    bytes.fromhex("140000000300020001000000da1c000000000000"),
+]
+CLASS_DUMP = [
+    bytes.fromhex(
+        "ec0000002800020002000000da1c000000000000020000000a000100ffffffff000000000800"
+        "0100687462003400020030000100000100000000000020bcbe00000100000000000020bcbe00"
+        "d0070000d0070000400d03000000000000000000480007001400010000000000000000000000"
+        "0000000000001800030000000000000000000000000000000000000000001800040000000000"
+        "0000000000000000d0070000d00700002c000300000000000000000000000000000000000000"
+        "0000000000000000000000000000000000000000000018000400000000000000000000000000"
+        "d0070000d0070000"
+    ),
+    bytes.fromhex("140000000300020002000000da1c000000000000"),
+]
+FILTER_DUMP = [
+    bytes.fromhex(
+        "340000002c00020003000000da1c000000000000020000000000000000000100080001000800"
+        "01007533320008000b0000000000400000002c00020003000000da1c00000000000002000000"
+        "000000200000010008000100080001007533320008000b00000000000c000200080004000001"
+        "0000740000002c00020003000000da1c00000000000002000000000809200000010008000100"
+        "080001007533320008000b000000000040000200240005000100010000000000000000000000"
+        "0000ffff00001f90000014000000000000000800020000000920080001000a00010008000b00"
+        "08000000400000002c00020003000000da1c0000000000000200000000000010000001000800"
+        "0100080001007533320008000b00000000000c0002000800040000010000740000002c000200"
+        "03000000da1c0000000000000200000000080910000001000800010008000100753332000800"
+        "0b00000000004000020024000500010001000000000000000000000000000000ffff00001f90"
+        "14000000000000000800020000000910080001000a00010008000b0008000000400000002c00"
+        "020003000000da1c000000000000020000000000008000000100080001000800010075333200"
+        "08000b00000000000c0002000800040001000000740000002c00020003000000da1c00000000"
+        "000002000000000800800000010008000100080001007533320008000b000000000040000200"
+        "24000500000001000000000000001400000000ff000000000000000000000000000000000800"
+        "020000000080080003000000001008000b0008000000740000002c00020003000000da1c0000"
+        "0000000002000000010800800000010008000100080001007533320008000b00000000004000"
+        "02002400050000000100000000000000140000ff000000000000000000000000000000000000"
+        "0800020000000080080003000000002008000b0008000000"
+    ),
+    bytes.fromhex("140000000300020003000000da1c000000000000"),
+]
+IFINDEX = 2
+CLASS_ID = 10
+
+
+class FakeTc:
+    """Traffic control handler answering tc show commands from recordings."""
+
+    dev = "ifb0"
+    dry_run = False
+
+    def __init__(self, qdiscs=QDISC_SHOW):
+        self.outputs = {
+            "class show dev ifb0": CLASS_SHOW,
+            "-j qdisc show dev ifb0": json.dumps(qdiscs),
+            "-j filter show dev ifb0": json.dumps(FILTER_SHOW),
+        }
+        self.commands = []
+
+    def run(self, command, tool=None, output=False):
+        if output:
+            return self.outputs[command]
+        self.commands.append(command)
+        return True
+
+    run_tc = run
+
+
+class FakeKernel:
+    """rtnetlink socket replaying recorded replies, then acking requests."""
+
+    def __init__(self, replies=()):
+        self.replies = list(replies)
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def recv(self, size):
+        if self.replies:
+            return self.replies.pop(0)
+        request = self.sent[-1]
+        seq = rtnetlink.NLMSGHDR.unpack_from(request)[3]
+        error = struct.pack("=i", 0) + request[: rtnetlink.NLMSGHDR.size]
+        return (
+            rtnetlink.NLMSGHDR.pack(
+                rtnetlink.NLMSGHDR.size + len(error), rtnetlink.NLMSG_ERROR, 0, seq, 0
+            )
+            + error
+        )
+
+
+def netlink_backend(tc, replies=()):
+    """Netlink backend talking to a fake kernel."""
+    nl = rtnetlink.RtNetlink.__new__(rtnetlink.RtNetlink)
+    nl.sock = FakeKernel(replies)
+    nl.seq = 0
+    backend = tc_backend.NetlinkBackend.__new__(tc_backend.NetlinkBackend)
+    backend.tc = tc
+    backend.nl = nl
+    backend._ifindex = IFINDEX
+    return backend
+
+
+def sent_tc(backend):
+    """Decode tcmsg fields and options of requests sent to the fake kernel."""
+    messages = []
+    for data in backend.nl.sock.sent:
+        body = data[rtnetlink.NLMSGHDR.size :]
+        _, _, handle, parent, _ = rtnetlink.TCMSG.unpack_from(body)
+        attrs = rtnetlink.parse_attrs(body[rtnetlink.TCMSG.size :])
+        options = rtnetlink.parse_attrs(attrs.get(rtnetlink.TCA_OPTIONS, b""))
+        messages.append((handle, parent, options))
+    return messages
+
+
+def current_rules(backend):
+    """Read current rules through traffic manager with backend."""
+    tc = traffic_manager.TrafficControl.__new__(traffic_manager.TrafficControl)
+    tc.backend = backend
+    return tc.current_rules()
+
+
+def test_shell_backend_reads_recording():
+    backend = tc_backend.ShellBackend(FakeTc())
+    assert backend.class_ids() == [CLASS_ID]
+    tables, port_filters = backend.port_filters()
+    assert tables == {"100", "200", "800"}
+    assert port_filters == [
+        ("200", 8080, CLASS_ID, "200:90:800"),
+        ("100", 8080, CLASS_ID, "100:90:800"),
+    ]
+
+
+def test_netlink_backend_reads_recording():
+    backend = netlink_backend(FakeTc(), QDISC_DUMP + CLASS_DUMP + FILTER_DUMP)
+    qdiscs = backend.qdiscs()
+    assert [(q["kind"], q["handle"], q["root"]) for q in qdiscs] == [
+        ("htb", tc_backend.HTB_HANDLE, True)
+    ]
+    assert backend.class_ids() == [CLASS_ID]
+    tables, port_filters = backend.port_filters()
+    assert tables == {"100", "200", "800"}
+    assert port_filters == [
+        ("200", 8080, CLASS_ID, 0x20090800),
+        ("100", 8080, CLASS_ID, 0x10090800),
+    ]
+
+
+@pytest.mark.parametrize("backend", ["shell", "netlink"])
+def test_backends_agree_on_current_rules(backend):
+    if backend == "shell":
+        backend = tc_backend.ShellBackend(FakeTc())
+    else:
+        backend = netlink_backend(FakeTc(), QDISC_DUMP + CLASS_DUMP + FILTER_DUMP)
+    rules = current_rules(backend)
+    assert list(rules) == [CLASS_ID]
+    assert sorted(rules[CLASS_ID]["ports"]) == [("100", 8080), ("200", 8080)]
+
+
+def test_netem_parent_matches_class_id():
+    rules = current_rules(tc_backend.ShellBackend(FakeTc(QDISC_SHOW + [NETEM_SHOW])))
+    assert list(rules) == [CLASS_ID]
+    assert rules[CLASS_ID]["handle"] == "8001:"
+    assert rules[CLASS_ID]["delay"] == 0.05
+    assert rules[CLASS_ID]["loss"] == 0.02
+
+
+def test_shell_backend_writes_hex_class_minor():
+    tc = FakeTc()
+    backend = tc_backend.ShellBackend(tc)
+    backend.add_class(CLASS_ID, "100mbit")
+    backend.add_netem(CLASS_ID, "50ms", "2%")
+    backend.change_netem(CLASS_ID, "8001:", "10ms", "1%")
+    backend.add_port_filter("100", 0x90, CLASS_ID, "dport", 8080)
+    backend.del_class(CLASS_ID)
+    assert tc.commands == [
+        "class add dev ifb0 parent 1: classid 1:a htb rate 100mbit",
+        "qdisc add dev ifb0 parent 1:a netem delay 50ms loss 2%",
+        "qdisc change dev ifb0 parent 1:a handle 8001: netem delay 10ms loss 1%",
+        "filter add dev ifb0 parent 1: protocol ip prio 1 u32 ht 100:90: flowid 1:a"
+        " match ip dport 8080 0xffff",
+        "class del dev ifb0 classid 1:a",
+    ]
+
+
+def test_netlink_backend_writes_class_handle():
+    backend = netlink_backend(FakeTc())
+    assert backend.add_class(CLASS_ID, "100mbit")
+    assert backend.add_netem(CLASS_ID, "50ms", "2%")
+    assert backend.add_port_filter("100", 0x90, CLASS_ID, "dport", 8080)
+    add_class, add_netem, add_filter = sent_tc(backend)
+    assert add_class[:2] == (0x1000A, tc_backend.HTB_HANDLE)
+    assert add_netem[1] == 0x1000A
+    assert add_filter[1] == tc_backend.HTB_HANDLE
+    classid = add_filter[2][tc_backend.TCA_U32_CLASSID]
+    assert rtnetlink.parse_u32(classid) == 0x1000A
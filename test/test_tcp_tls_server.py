@@ -0,0 +1,460 @@
+"""TLS echo server tests, serving from an event loop thread."""
+import asyncio
+import contextlib
+import json
+import random
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import tcp_tls_server
+
+
+@pytest.fixture
+def config(certs, tmp_path, monkeypatch):
+    """Server config of the TLS echo servers on free ports."""
+    monkeypatch.setattr(tcp_tls_server, "_contexts", {})
+    rsa = {"fullchain": str(certs / "rsa.pem"), "privkey": str(certs / "rsa.key")}
+    ecdsa = {"fullchain": str(certs / "ec.pem"), "privkey": str(certs / "ec.key")}
+    return {
+        "tcp_tls": dict(rsa, port="0", timeout="30"),
+        "tcp_tls_mutual": {"port": "0", "CAroot": str(certs / "ca.pem")},
+        "ecdsa_tcp_tls": dict(ecdsa, port="0", timeout="30"),
+        "ecdsa_tcp_tls_mutual": {"port": "0", "CAroot": str(certs / "ca.pem")},
+        "api": {"tls_stats": {"location": str(tmp_path / "tls_stats.json")}},
+    }
+
+
+async def cancel_tasks():
+    """Cancel other tasks of event loop and wait for them to end."""
+    tasks = asyncio.all_tasks() - {asyncio.current_task()}
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@contextlib.contextmanager
+def serving(config, servers):
+    """Serve TLS echo servers from an event loop thread."""
+    for server in servers:
+        server.listen()
+        server.port = server.tcp_server.getsockname()[1]
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(tcp_tls_server.serve_tls(config, servers), loop)
+    try:
+        yield
+    finally:
+        asyncio.run_coroutine_threadsafe(cancel_tasks(), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        for server in servers:
+            server.tcp_server.close()
+
+
+def client_context(certs=None):
+    """Client TLS context, with client certificate from certs if given."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.maximum_version = ssl.TLSVersion.TLSv1_2
+    if certs:
+        context.load_cert_chain(certs / "client.pem", certs / "client.key")
+    return context
+
+
+def connect(server, context=None, session=None, timeout=5):
+    """Open TLS connection to server."""
+    sock = socket.create_connection(("127.0.0.1", server.port), timeout=timeout)
+    return (context or client_context()).wrap_socket(sock, session=session)
+
+
+def test_stalled_handshake_does_not_block_accept(config):
+    server = tcp_tls_server.TcpTLSServer(config)
+    with serving(config, [server]):
+        # Client connecting without ever sending its hello
+        stalled = socket.create_connection(("127.0.0.1", server.port))
+        start = time.monotonic()
+        with connect(server) as conn:
+            conn.sendall(b"ping")
+            assert conn.recv(4) == b"ping"
+        assert time.monotonic() - start < 2
+        stalled.close()
+
+
+def wait_for(condition, timeout=5):
+    """Wait for condition to be true."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def echo_once(conn):
+    """Check connection echoes a message."""
+    conn.sendall(b"ping")
+    assert conn.recv(4) == b"ping"
+
+
+@pytest.mark.parametrize("session_tickets", ["1", "0"])
+def test_session_resumption_counted(config, session_tickets):
+    config["tcp_tls"]["session_tickets"] = session_tickets
+    server = tcp_tls_server.TcpTLSServer(config)
+    context = client_context()
+    with serving(config, [server]):
+        with connect(server, context) as conn:
+            echo_once(conn)
+            session = conn.session
+            assert not conn.session_reused
+            # Sessions of connections not shut down cleanly are not resumable
+            conn.unwrap()
+        wait_for(lambda: server.stats["connections"] == 0)
+        with connect(server, context, session=session) as conn:
+            echo_once(conn)
+            assert conn.session_reused
+        stats = server.get_stats()
+    assert stats["handshakes"] == 2
+    assert stats["resumed"] == 1
+    assert stats["failed"] == 0
+    assert stats["rotations"] == 0
+
+
+def test_contexts_shared_by_servers(config):
+    rsa = tcp_tls_server.TcpTLSServer(config)
+    ecdsa = tcp_tls_server.TcpTLSServer(config, ecdsa=True)
+    assert tcp_tls_server.TcpTLSServer(config).shared_context is rsa.shared_context
+    assert ecdsa.shared_context is not rsa.shared_context
+    mutual = tcp_tls_server.TcpTLSServer(config, mutual=True)
+    assert mutual.shared_context is not rsa.shared_context
+
+
+def test_ticket_rotation_ends_resumption(config, monkeypatch):
+    config["tcp_tls"]["ticket_rotation"] = "60"
+    server = tcp_tls_server.TcpTLSServer(config)
+    context = client_context()
+    now = time.monotonic()
+    monkeypatch.setattr(tcp_tls_server.time, "monotonic", lambda: now)
+    with serving(config, [server]):
+        with connect(server, context) as conn:
+            echo_once(conn)
+            session = conn.session
+        now += 60
+        with connect(server, context, session=session) as conn:
+            echo_once(conn)
+            assert not conn.session_reused
+        stats = server.get_stats()
+    assert stats["rotations"] == 1
+    assert stats["resumed"] == 0
+
+
+def all_servers(config):
+    """TLS echo servers of all variants."""
+    return [
+        tcp_tls_server.TcpTLSServer(config, mutual=mutual, ecdsa=ecdsa)
+        for ecdsa in (False, True)
+        for mutual in (False, True)
+    ]
+
+
+def test_all_variants_on_one_loop(config, certs):
+    servers = all_servers(config)
+    location = config["api"]["tls_stats"]["location"]
+    with serving(config, servers):
+        for server in servers:
+            context = client_context(certs if server.is_mutual else None)
+            with connect(server, context) as conn:
+                echo_once(conn)
+                assert conn.cipher()[0].startswith(
+                    "ECDHE-ECDSA" if server.is_ecdsa else "ECDHE-RSA"
+                )
+        wait_for(lambda: all(server.stats["connections"] == 0 for server in servers))
+    with open(location) as stats_file:
+        stats = json.load(stats_file)
+    assert sorted(stats) == sorted(str(server.port) for server in servers)
+    assert [server.stats["handshakes"] for server in servers] == [1, 1, 1, 1]
+
+
+def test_mutual_requires_client_certificate(config):
+    server = tcp_tls_server.TcpTLSServer(config, mutual=True)
+    with serving(config, [server]):
+        with pytest.raises((ssl.SSLError, ConnectionResetError)):
+            with connect(server) as conn:
+                echo_once(conn)
+        wait_for(lambda: server.stats["failed"] == 1)
+    assert server.stats["handshakes"] == 0
+
+
+def test_connection_limit_shared_by_ports(config):
+    config["tcp_tls"]["max_connections"] = "1"
+    servers = [
+        tcp_tls_server.TcpTLSServer(config),
+        tcp_tls_server.TcpTLSServer(config, ecdsa=True),
+    ]
+    with serving(config, servers), ThreadPoolExecutor(1) as executor:
+        conn = connect(servers[0])
+        echo_once(conn)
+        waiting = executor.submit(connect, servers[1])
+        time.sleep(0.3)
+        assert not waiting.done()
+        conn.close()
+        with waiting.result(5) as conn:
+            echo_once(conn)
+
+
+async def echo_payload(server, payload):
+    """Send payload to server while reading it back."""
+    reader, writer = await asyncio.open_connection(
+        "127.0.0.1", server.port, ssl=client_context()
+    )
+    try:
+        writer.write(payload)
+        return await asyncio.wait_for(reader.readexactly(len(payload)), 30)
+    finally:
+        writer.close()
+
+
+@pytest.mark.parametrize("buffer", [tcp_tls_server.DEFAULT_BUFFER_SIZE, "4096"])
+@pytest.mark.parametrize("size", [1, 1024, 16385, 1 << 20, 16 << 20])
+def test_echo_payload(config, buffer, size):
+    config["tcp_tls"]["buffer"] = buffer
+    server = tcp_tls_server.TcpTLSServer(config)
+    payload = bytes(range(256)) * (size // 256) + bytes(size % 256)
+    with serving(config, [server]):
+        assert asyncio.run(echo_payload(server, payload)) == payload
+
+
+class FakeTransport:
+    """Transport recording echoed data."""
+
+    def __init__(self):
+        self.writes = []
+
+    def set_write_buffer_limits(self, high):
+        pass
+
+    def get_extra_info(self, name):
+        return None
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def is_closing(self):
+        return False
+
+
+def receive(protocol, data):
+    """Feed data to protocol as received in one read."""
+    buffer = protocol.get_buffer(-1)
+    buffer[: len(data)] = data
+    protocol.buffer_updated(len(data))
+
+
+async def echo_records(records, buffer_size):
+    """Feed records to echo protocol in one loop iteration, return writes."""
+    transport = FakeTransport()
+    protocol = tcp_tls_server.TlsEcho(5, buffer_size)
+    protocol.connection_made(transport)
+    for record in records:
+        receive(protocol, record)
+    await asyncio.sleep(0)
+    protocol.connection_lost(None)
+    return transport.writes
+
+
+def test_echo_coalesces_records(monkeypatch):
+    monkeypatch.setattr(tcp_tls_server, "_buffers", [])
+    writes = asyncio.run(echo_records([b"abc", b"de", b"f"], 16))
+    assert writes == [b"abcdef"]
+    # Buffer is back in the pool once echoed
+    assert len(tcp_tls_server._buffers) == 1
+
+
+def test_echo_flushes_full_buffer(monkeypatch):
+    monkeypatch.setattr(tcp_tls_server, "_buffers", [])
+    writes = asyncio.run(echo_records([b"abcd", b"efgh", b"ij"], 8))
+    assert writes == [b"abcdefgh", b"ij"]
+    # Flushed buffer is taken back from the pool for the next read
+    assert len(tcp_tls_server._buffers) == 1
+
+
+def timed_echo(port, context=None):
+    """Open TLS connection to port and echo a message, returns seconds taken."""
+    start = time.monotonic()
+    sock = socket.create_connection(("127.0.0.1", port), timeout=30)
+    with (context or client_context()).wrap_socket(sock) as conn:
+        echo_once(conn)
+    return time.monotonic() - start
+
+
+@contextlib.contextmanager
+def lossy_relay(port, chunk=64, delay=0.005, loss=0.05, retransmit=0.2):
+    """Relay connections to port, as a slow link losing some segments.
+
+    Data is forwarded by chunks, each delayed, lost ones until retransmitted.
+    Yields port of the relay.
+    """
+    listener = socket.create_server(("127.0.0.1", 0))
+    listener.settimeout(0.1)
+    stopped = threading.Event()
+    sockets = []
+    rng = random.Random(0)
+
+    def forward(src, dst):
+        try:
+            data = src.recv(chunk)
+            while data and not stopped.is_set():
+                time.sleep(retransmit if rng.random() < loss else delay)
+                dst.sendall(data)
+                data = src.recv(chunk)
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def accept():
+        while not stopped.is_set():
+            try:
+                client, _ = listener.accept()
+            except socket.timeout:
+                continue
+            upstream = socket.create_connection(("127.0.0.1", port))
+            sockets.extend((client, upstream))
+            for src, dst in ((client, upstream), (upstream, client)):
+                threading.Thread(target=forward, args=(src, dst), daemon=True).start()
+
+    thread = threading.Thread(target=accept, daemon=True)
+    thread.start()
+    try:
+        yield listener.getsockname()[1]
+    finally:
+        stopped.set()
+        thread.join()
+        listener.close()
+        for sock in sockets:
+            sock.close()
+
+
+def test_concurrent_handshakes_through_lossy_link(config, record_property):
+    server = tcp_tls_server.TcpTLSServer(config)
+    with serving(config, [server]), lossy_relay(server.port) as relay_port:
+        # Clients never sending their hello
+        stalled = [
+            socket.create_connection(("127.0.0.1", server.port)) for _ in range(8)
+        ]
+        with ThreadPoolExecutor(32) as executor:
+            lossy = [executor.submit(timed_echo, relay_port) for _ in range(32)]
+            # Local clients while the lossy handshakes are in progress
+            direct = [timed_echo(server.port) for _ in range(8)]
+            assert not all(future.done() for future in lossy)
+            lossy = [future.result(30) for future in lossy]
+        for sock in stalled:
+            sock.close()
+    record_property("direct_max_seconds", max(direct))
+    record_property("lossy_max_seconds", max(lossy))
+    assert max(direct) < 1
+    assert max(lossy) < 10
+    assert server.stats["handshakes"] == 40
+
+
+@contextlib.contextmanager
+def threaded_server(context):
+    """Serve TLS echo from a thread per connection, as before the event loop.
+
+    Handshakes run in the accept loop, connections are echoed by default
+    sized reads. Yields port of the server.
+    """
+    listener = socket.create_server(("127.0.0.1", 0))
+    listener.settimeout(0.1)
+    stopped = threading.Event()
+
+    def echo(conn):
+        with conn:
+            try:
+                data = conn.read()
+                while data:
+                    conn.sendall(data)
+                    data = conn.read()
+            except OSError:
+                pass
+
+    def accept():
+        while not stopped.is_set():
+            try:
+                sock, _ = listener.accept()
+            except socket.timeout:
+                continue
+            sock.settimeout(30)
+            try:
+                conn = context.wrap_socket(sock, server_side=True)
+            except OSError:
+                sock.close()
+                continue
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+    thread = threading.Thread(target=accept, daemon=True)
+    thread.start()
+    try:
+        yield listener.getsockname()[1]
+    finally:
+        stopped.set()
+        thread.join()
+        listener.close()
+
+
+def handshake_rate(port, context, count=64, clients=16):
+    """Get handshakes per second of clients connecting in parallel."""
+    with ThreadPoolExecutor(clients) as executor:
+        start = time.monotonic()
+        list(executor.map(lambda _: timed_echo(port, context), range(count)))
+        return count / (time.monotonic() - start)
+
+
+async def echo_stream(port, size, write_size):
+    """Echo size bytes written by write_size, returns bytes echoed per second."""
+    reader, writer = await asyncio.open_connection(
+        "127.0.0.1", port, ssl=client_context()
+    )
+    payload = bytes(write_size)
+
+    async def send():
+        for _ in range(size // write_size):
+            writer.write(payload)
+            await writer.drain()
+
+    start = time.monotonic()
+    try:
+        await asyncio.wait_for(asyncio.gather(send(), reader.readexactly(size)), 60)
+        return size / (time.monotonic() - start)
+    finally:
+        writer.close()
+
+
+@pytest.mark.parametrize(
+    "mutual, ecdsa", [(False, False), (True, False), (False, True)]
+)
+def test_handshake_rate(config, certs, record_property, mutual, ecdsa):
+    server = tcp_tls_server.TcpTLSServer(config, mutual=mutual, ecdsa=ecdsa)
+    context = client_context(certs if mutual else None)
+    with serving(config, [server]):
+        rate = handshake_rate(server.port, context)
+    with threaded_server(server.shared_context.get()) as port:
+        threaded_rate = handshake_rate(port, context)
+    record_property("handshakes_per_second", rate)
+    record_property("threaded_handshakes_per_second", threaded_rate)
+    # Handshakes are bound by CPU, only waiting for clients is spared
+    assert rate > threaded_rate / 2
+
+
+def test_echo_throughput(config, record_property):
+    server = tcp_tls_server.TcpTLSServer(config)
+    size = 64 << 20
+    with serving(config, [server]):
+        rate = asyncio.run(echo_stream(server.port, size, 16 << 10))
+    with threaded_server(server.shared_context.get()) as port:
+        threaded_rate = asyncio.run(echo_stream(port, size, 16 << 10))
+    record_property("bytes_per_second", rate)
+    record_property("threaded_bytes_per_second", threaded_rate)
+    assert rate > threaded_rate
@@ -0,0 +1,387 @@
+"""Traffic manager tests, run in batch mode without root."""
+import collections
+import json
+import os
+import stat
+import re
+import time
+import pytest
+import tc_backend
+import traffic_manager
+from config_handler import ConfigHandler
+
+
+SERVER_PORTS = {"tcp": {"80": ["2000:2002"], "null": ["5000"]}, "udp": {"4000": []}}
+
+
+def emulation_config(ports_per_class, delays=("0ms", "100ms"), losses=("0%", "1%")):
+    """Return network emulation config with consecutive service ports."""
+    config = {}
+    port = 20000
+    for loss in losses:
+        ports = []
+        for _ in delays:
+            ports.append(
+                {"service-%d" % i: str(port + i) for i in range(ports_per_class)}
+            )
+            port += ports_per_class
+        config["loss_" + loss.strip("%")] = {
+            "packet_delay": list(delays),
+            "packet_loss": loss,
+            "ports": ports,
+        }
+    return config
+
+
+@pytest.fixture
+def make_manager(tmp_path, monkeypatch):
+    """Return factory of batch traffic managers for an emulation config."""
+    monkeypatch.setattr(tc_backend.ShellBackend, "get_dev", lambda self: "eth0")
+    server_config = tmp_path / "server.json"
+    server_config.write_text(json.dumps({"ports": SERVER_PORTS}))
+
+    def make(config, dry_run=True, batch=True):
+        config_file = tmp_path / "network_emulation.json"
+        config_file.write_text(json.dumps(config))
+        return traffic_manager.TrafficControl(
+            ConfigHandler(str(config_file), str(server_config)),
+            batch=batch,
+            dry_run=dry_run,
+            backend="shell",
+        )
+
+    return make
+
+
+@pytest.fixture
+def stub_tool(tmp_path, monkeypatch):
+    """Return factory of stub tools on PATH, recording calls and stdin."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+
+    def make(name, script="", read_stdin=True):
+        tool = bin_dir / name
+        tool.write_text(
+            "#!/bin/sh\n"
+            "echo {name} >> {bin_dir}/calls\n"
+            'echo "$@" >> {log}.args\n'
+            "{cat}"
+            "{script}\n".format(
+                name=name,
+                bin_dir=bin_dir,
+                log=bin_dir / name,
+                cat="cat >> {}.stdin\n".format(bin_dir / name) if read_stdin else "",
+                script=script,
+            )
+        )
+        tool.chmod(tool.stat().st_mode | stat.S_IXUSR)
+        return bin_dir / name
+
+    return make
+
+
+def tc_plan(output):
+    """Return tc batch plan lines printed in dry run mode."""
+    return [
+        line
+        for line in output.splitlines()
+        if line.split(" ", 1)[0] in ("qdisc", "class", "filter")
+    ]
+
+
+def test_configure_queues_tc_plan(make_manager, capsys):
+    make_manager(emulation_config(3)).configure()
+    plan = tc_plan(capsys.readouterr().out)
+    assert plan[0] == "qdisc add dev eth0 root handle 1: htb"
+    assert len([line for line in plan if line.startswith("class add")]) == 4
+    assert len([line for line in plan if " netem " in line]) == 4
+    assert len([line for line in plan if " flowid " in line]) == 2 * 4 * 3
+
+
+def test_apply_tc_plan_single_batch(make_manager, stub_tool):
+    tc = stub_tool("tc")
+    manager = make_manager(emulation_config(1), dry_run=False)
+    manager.run_tc("class add dev eth0 parent 1: classid 1:1 htb rate 1gbit")
+    manager.run_tc("class add dev eth0 parent 1: classid 1:2 htb rate 1gbit")
+    assert manager.apply_tc_plan()
+    assert manager.tc_plan == []
+    assert (tc.parent / "tc.args").read_text() == "-force -batch -\n"
+    assert (tc.parent / "tc.stdin").read_text().splitlines() == [
+        "class add dev eth0 parent 1: classid 1:1 htb rate 1gbit",
+        "class add dev eth0 parent 1: classid 1:2 htb rate 1gbit",
+    ]
+
+
+def test_apply_tc_plan_reports_failed_lines(make_manager, stub_tool, monkeypatch):
+    stub_tool(
+        "tc",
+        "echo 'Cannot find device \"eth0\"' >&2\n"
+        "echo 'Command failed -:2' >&2\n"
+        "exit 1",
+    )
+    errors = []
+    monkeypatch.setattr(traffic_manager.flog, "error", errors.append)
+    manager = make_manager(emulation_config(1), dry_run=False)
+    manager.run_tc("qdisc add dev eth0 root handle 1: htb")
+    manager.run_tc("class add dev eth0 parent 1: classid 1:1 htb rate 1gbit")
+    assert not manager.apply_tc_plan()
+    assert errors == [
+        "tc batch line 2: 'class add dev eth0 parent 1: classid 1:1 htb rate 1gbit'"
+        ' failed: Cannot find device "eth0"'
+    ]
+
+
+def test_ip_tables_ruleset(make_manager, capsys):
+    manager = make_manager(emulation_config(1))
+    assert manager.add_ip_tables()
+    ports = {"service-%d" % i: str(20000 + i) for i in range(1000)}
+    assert manager.add_ingress_rule(ports, packet_loss="1%")
+    assert manager.apply_iptables_plan()
+    # flog lines are printed along, starting with their timestamp
+    output = [line for line in capsys.readouterr().out.splitlines() if line[:1] != "["]
+    ipset = output[: output.index("*filter")]
+    assert ipset[:3] == [
+        "create flake_accept_tcp bitmap:port range 0-65535",
+        "add flake_accept_tcp 2000-2002",
+        "add flake_accept_tcp 80",
+    ]
+    assert len([line for line in ipset if line.startswith("add flake_loss_1 ")]) == 1000
+    # One rule per port set, whatever the number of ports
+    assert output[output.index("*filter") :] == [
+        "*filter",
+        "-I INPUT -p tcp -m set --match-set flake_accept_tcp dst -j ACCEPT",
+        "-I INPUT -p udp -m set --match-set flake_accept_udp dst -j ACCEPT",
+        "COMMIT",
+        "*nat",
+        "-I PREROUTING -p tcp -m set --match-set flake_tcp_80 dst -j REDIRECT --to-port 80",
+        "-I PREROUTING -p udp -m set --match-set flake_udp_4000 dst -j REDIRECT --to-port 4000",
+        "COMMIT",
+        "*mangle",
+        "-A PREROUTING -p tcp -m set --match-set flake_loss_1 dst -m statistic --mode random --probability 0.01 -j DROP",
+        "-A PREROUTING -p udp -m set --match-set flake_loss_1 dst -m statistic --mode random --probability 0.01 -j DROP",
+        "COMMIT",
+    ]
+
+
+def test_apply_iptables_plan_single_restore(make_manager, stub_tool):
+    ipset = stub_tool("ipset")
+    restore = stub_tool("iptables-restore")
+    manager = make_manager(emulation_config(1), dry_run=False)
+    assert manager.accept_ports("udp", ["4000", "4100:4103"])
+    assert manager.apply_iptables_plan()
+    assert manager.ipset_plan == []
+    assert manager.iptables_ruleset() == []
+    # Sets are created before the rules matching them
+    assert (ipset.parent / "calls").read_text() == "ipset\niptables-restore\n"
+    assert (ipset.parent / "ipset.args").read_text() == "-exist restore\n"
+    assert (ipset.parent / "ipset.stdin").read_text().splitlines() == [
+        "create flake_accept_udp bitmap:port range 0-65535",
+        "add flake_accept_udp 4000",
+        "add flake_accept_udp 4100-4103",
+    ]
+    assert (restore.parent / "iptables-restore.args").read_text() == "--noflush\n"
+    assert (restore.parent / "iptables-restore.stdin").read_text().splitlines() == [
+        "*filter",
+        "-I INPUT -p udp -m set --match-set flake_accept_udp dst -j ACCEPT",
+        "COMMIT",
+    ]
+
+
+def test_port_filter_layout_1000_ports(make_manager, capsys):
+    make_manager(emulation_config(250)).configure()
+    plan = tc_plan(capsys.readouterr().out)
+    assert [line for line in plan if "divisor" in line or " link " in line] == [
+        "filter add dev eth0 parent 1: prio 1 handle 100: protocol ip u32 divisor 256",
+        "filter add dev eth0 parent 1: prio 1 handle 200: protocol ip u32 divisor 256",
+        "filter add dev eth0 parent 1: protocol ip prio 1 u32 ht 800:: match u32 0 0"
+        " link 100: hashkey mask 0x000000ff at 20",
+        "filter add dev eth0 parent 1: protocol ip prio 1 u32 ht 800:: match u32 0 0"
+        " link 200: hashkey mask 0x00ff0000 at 20",
+    ]
+    port_filters = [
+        re.match(
+            r"filter add dev eth0 parent 1: protocol ip prio 1 u32 "
+            r"ht (\w+):(\w+): flowid 1:(\w+) match ip (\w+) (\d+) 0xffff$",
+            line,
+        ).groups()
+        for line in plan
+        if " flowid " in line
+    ]
+    filtered = collections.defaultdict(list)
+    buckets = collections.Counter()
+    for table, bucket, flowid, match, port in port_filters:
+        port = int(port)
+        assert (table, match) in (("100", "dport"), ("200", "sport"))
+        assert int(bucket, 16) == port % 256
+        # Classes hold 250 consecutive ports each, in config order
+        assert int(flowid, 16) == (port - 20000) // 250 + 1
+        filtered[table].append(port)
+        buckets[table, bucket] += 1
+    assert sorted(filtered["100"]) == list(range(20000, 21000))
+    assert sorted(filtered["200"]) == list(range(20000, 21000))
+    # Packets are checked against the filters of a single bucket
+    assert max(buckets.values()) == 4
+
+
+def configure_calls(make_manager, stub_tool, ports_per_class, batch):
+    """Configure rules with stub tools, return tool calls and time taken."""
+    # Tools run one command at a time do not read their stdin
+    for name in ("tc", "iptables", "ipset", "iptables-restore"):
+        tool = stub_tool(name, read_stdin=batch)
+    calls = tool.parent / "calls"
+    calls.write_text("")
+    manager = make_manager(
+        emulation_config(ports_per_class), dry_run=False, batch=batch
+    )
+    start = time.monotonic()
+    manager.configure()
+    return (
+        collections.Counter(calls.read_text().split()),
+        time.monotonic() - start,
+    )
+
+
+def test_configure_batch_scaling(make_manager, stub_tool):
+    batch_calls = []
+    for ports_per_class in (5, 50):
+        calls, batch_time = configure_calls(
+            make_manager, stub_tool, ports_per_class, batch=True
+        )
+        batch_calls.append(calls)
+    # One call per tool whatever the number of ports, tc also flushes the
+    # previous rules and iptables lists the filter and nat tables
+    expected = {"tc": 2, "ipset": 1, "iptables-restore": 1, "iptables": 2}
+    assert batch_calls == [expected, expected]
+    calls, command_time = configure_calls(make_manager, stub_tool, 50, batch=False)
+    # One process per rule: 4 classes of 50 ports filtered on both directions
+    assert calls["tc"] > 2 * 4 * 50
+    assert batch_time < command_time / 10
+
+
+def fake_rules(make_manager, stub_tool, config):
+    """Stub tc and ipset to list the rules of config as applied on the device.
+
+    Returns port filters, as (class id, port) by filter handle.
+    """
+    rules = make_manager(config).desired_rules()
+    qdiscs = [{"kind": "htb", "handle": "1:", "root": True, "options": {}}]
+    classes = []
+    filters = [
+        {"kind": "u32", "options": {"fh": handle + ":", "ht_divisor": 256}}
+        for handle, _, _ in traffic_manager.PORT_HASH_TABLES
+    ]
+    port_filters = {}
+    loss_sets = collections.defaultdict(list)
+    for class_id, rule in rules.items():
+        classes.append(
+            "class htb 1:{:x} root leaf 8{:03x}: prio 0".format(class_id, class_id)
+        )
+        qdiscs.append(
+            {
+                "kind": "netem",
+                "handle": "8{:03x}:".format(class_id),
+                "parent": "1:{:x}".format(class_id),
+                "options": {
+                    "delay": {"delay": rule["delay"]},
+                    "loss-random": {"loss": rule["loss"]},
+                },
+            }
+        )
+        for port in rule["ports"]:
+            for handle, _, match in traffic_manager.PORT_HASH_TABLES:
+                mask, shift = tc_backend.PORT_MATCH[match]
+                fh = "{}:{:x}:{:x}".format(handle, port % 256, 0x800 + len(filters))
+                filters.append(
+                    {
+                        "kind": "u32",
+                        "options": {
+                            "fh": fh,
+                            "key_ht": handle,
+                            "flowid": "1:{:x}".format(class_id),
+                            "match": {
+                                "value": "{:08x}".format(port << shift),
+                                "mask": "{:08x}".format(mask),
+                            },
+                        },
+                    }
+                )
+                port_filters[fh] = (class_id, port)
+        name = traffic_manager.TrafficControl._loss_set(rule["packet_loss"])
+        loss_sets[name].extend(rule["ports"])
+
+    tc = stub_tool("tc", read_stdin=False)
+    state = tc.parent
+    (state / "qdiscs.json").write_text(json.dumps(qdiscs))
+    (state / "classes.txt").write_text("\n".join(classes))
+    (state / "filters.json").write_text(json.dumps(filters))
+    (state / "ipsets.txt").write_text(
+        "\n".join(
+            "create {} bitmap:port range 0-65535\n".format(name)
+            + "".join("add {} {}\n".format(name, port) for port in ports)
+            for name, ports in loss_sets.items()
+        )
+    )
+    stub_tool(
+        "tc",
+        'case "$*" in\n'
+        '"-j qdisc show dev eth0") cat {state}/qdiscs.json ;;\n'
+        '"class show dev eth0") cat {state}/classes.txt ;;\n'
+        '"-j filter show dev eth0") cat {state}/filters.json ;;\n'
+        "esac".format(state=state),
+        read_stdin=False,
+    )
+    stub_tool("ipset", "cat {}/ipsets.txt".format(state), read_stdin=False)
+    return port_filters
+
+
+def reconcile_changes(make_manager, capsys, config):
+    """Reconcile rules with config in dry run, return the changes printed."""
+    capsys.readouterr()
+    make_manager(config).reconcile()
+    # flog lines are printed along, starting with their timestamp
+    return [line for line in capsys.readouterr().out.splitlines() if line[:1] != "["]
+
+
+def test_reconcile_unchanged(make_manager, stub_tool, capsys):
+    config = emulation_config(3)
+    fake_rules(make_manager, stub_tool, config)
+    assert reconcile_changes(make_manager, capsys, config) == []
+
+
+def test_reconcile_changed_delay(make_manager, stub_tool, capsys):
+    fake_rules(make_manager, stub_tool, emulation_config(3))
+    config = emulation_config(3)
+    config["loss_0"]["packet_delay"][1] = "50ms"
+    # Other classes, their filters and the ipsets are left alone
+    assert reconcile_changes(make_manager, capsys, config) == [
+        "qdisc change dev eth0 parent 1:2 handle 8002: netem delay 50ms loss 0%"
+    ]
+
+
+def test_reconcile_removed_class_and_port(make_manager, stub_tool, capsys):
+    port_filters = fake_rules(make_manager, stub_tool, emulation_config(3))
+    config = emulation_config(3)
+    del config["loss_1"]
+    del config["loss_0"]["ports"][0]["service-2"]
+    changes = reconcile_changes(make_manager, capsys, config)
+    # Ingress ipsets are updated before the tc rules
+    assert changes[:7] == ["del flake_loss_0 20002"] + [
+        "del flake_loss_1 %d" % port for port in range(20006, 20012)
+    ]
+    deleted = collections.Counter(
+        port_filters[re.match(r"filter del .* handle (\S+) u32$", line).group(1)]
+        for line in changes[7:]
+        if line.startswith("filter del ")
+    )
+    # Filters of both directions for the removed port and classes
+    assert deleted == {
+        (class_id, port): 2
+        for class_id, port in [(1, 20002)]
+        + [(3, port) for port in range(20006, 20009)]
+        + [(4, port) for port in range(20009, 20012)]
+    }
+    assert [line for line in changes[7:] if not line.startswith("filter del ")] == [
+        "class del dev eth0 classid 1:3",
+        "class del dev eth0 classid 1:4",
+    ]
@@ -0,0 +1,214 @@
+"""UDP server tests."""
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+pytest.importorskip("dtls")
+import udp_server  # noqa: E402
+
+
+def test_get_file_invalid_stream_path():
+    server = udp_server.UdpServer.__new__(udp_server.UdpServer)
+    assert server.get_file("stream/text/1.2.3MB") == (
+        b"Invalid stream path stream/text/1.2.3MB\n"
+    )
+
+
+def test_resolve_path_per_server():
+    servers = []
+    for root in ("/srv/a", "/srv/b"):
+        server = udp_server.UdpServer.__new__(udp_server.UdpServer)
+        server.config = {"text": {}, "binary": {}}
+        server.root = root
+        server.resolved_paths = {}
+        servers.append(server)
+    assert [server._resolve_path("text/data_1MB.txt") for server in servers] == [
+        "/srv/a/files/text/data_1MB.txt",
+        "/srv/b/files/text/data_1MB.txt",
+    ]
+    assert servers[0]._resolve_path("index.html") == "/srv/a/index.html"
+    assert servers[0].resolved_paths == {
+        "text/data_1MB.txt": "/srv/a/files/text/data_1MB.txt",
+        "index.html": "/srv/a/index.html",
+    }
+
+
+def cached_file(tmp_path, name, data):
+    """Write data to file in tmp_path, return its path."""
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_file_cache_evicts_least_recently_used(tmp_path):
+    cache = udp_server.FileCache(3 * 1024)
+    paths = [cached_file(tmp_path, str(i), bytes([i]) * 1024) for i in range(4)]
+    views = [cache.get(path) for path in paths[:3]]
+    assert cache.get(paths[0]) is views[0]
+    cache.get(paths[3])
+    assert list(cache.files) == [paths[2], paths[0], paths[3]]
+    assert cache.size == 3 * 1024
+    # Evicted mapping is still readable by transfers using it
+    assert bytes(views[1]) == b"\x01" * 1024
+    assert bytes(cache.get(paths[1])) == b"\x01" * 1024
+    assert list(cache.files) == [paths[0], paths[3], paths[1]]
+
+
+def test_file_cache_keeps_file_over_budget(tmp_path):
+    cache = udp_server.FileCache(1024)
+    path = cached_file(tmp_path, "large", bytes(4096))
+    assert len(cache.get(path)) == 4096
+    assert list(cache.files) == [path]
+    assert cache.size == 4096
+
+
+def test_file_cache_remaps_changed_file(tmp_path):
+    cache = udp_server.FileCache(1024 * 1024)
+    path = cached_file(tmp_path, "data", b"old")
+    old = cache.get(path)
+    # Replaced file, as written by the file manager
+    os.replace(cached_file(tmp_path, "new", b"new data"), path)
+    new = cache.get(path)
+    assert bytes(new) == b"new data"
+    assert bytes(old) == b"old"
+    assert cache.get(path) is new
+    # Rewritten in place
+    with open(path, "wb") as f:
+        f.write(b"rewritten")
+    assert bytes(cache.get(path)) == b"rewritten"
+    assert list(cache.files) == [path]
+    assert cache.size == len(b"rewritten")
+
+
+class FakeClock:
+    """Monotonic clock only advanced by sleeps, oversleeping by a delay."""
+
+    def __init__(self, monkeypatch, oversleep=0):
+        self.now = 1000.0
+        self.oversleep = oversleep
+        self.sleeps = []
+        monkeypatch.setattr(udp_server.time, "monotonic", lambda: self.now)
+        monkeypatch.setattr(udp_server.time, "sleep", self.sleep)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds + self.oversleep
+
+
+def paced_time(pacer, clock, count, size=1024):
+    """Send count datagrams of size through pacer, return time taken."""
+    start = clock.now
+    for _ in range(count):
+        pacer.wait(size)
+    return clock.now - start
+
+
+@pytest.mark.parametrize("oversleep", [0, 0.002])
+def test_pacer_rate(monkeypatch, oversleep):
+    clock = FakeClock(monkeypatch, oversleep)
+    pacer = udp_server.Pacer(rate=1000000, burst=8 * 1024)
+    elapsed = paced_time(pacer, clock, 10000)
+    # First burst is sent at once, at most a burst is left unsent at the end.
+    # Time slept over target is credited, not added to every sleep.
+    expected = (10000 - 8) * 1024 / 1000000
+    assert expected <= elapsed <= expected + (8 * 1024 / 1000000) + oversleep
+    # Sends are batched by bursts, not paced one by one
+    assert len(clock.sleeps) < 10000 / 4
+
+
+def test_pacer_burst_after_idle(monkeypatch):
+    clock = FakeClock(monkeypatch)
+    pacer = udp_server.Pacer(rate=1000000, burst=8 * 1024)
+    paced_time(pacer, clock, 100)
+    clock.now += 60
+    sleeps = len(clock.sleeps)
+    # Idle time only grants a burst, sends are paced again after it
+    assert paced_time(pacer, clock, 8) == 0
+    assert paced_time(pacer, clock, 1) == pytest.approx(8 * 1024 / 1000000)
+    assert len(clock.sleeps) == sleeps + 1
+
+
+class FakeSocket:
+    """Server socket recording datagrams sent."""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+
+@pytest.fixture
+def transfer_server():
+    """UDP server whose transfers run until cancelled."""
+    server = udp_server.UdpServer.__new__(udp_server.UdpServer)
+    server.name = "UDP SERVER"
+    server.max_transfers = 2
+    server.transfers = {}
+    server.transfers_lock = threading.Lock()
+    server.executor = ThreadPoolExecutor(max_workers=server.max_transfers)
+    server.sock = FakeSocket()
+    server.get_file = lambda path: path.encode()
+    started = queue.Queue()
+
+    def send_file(data, addr, cancel):
+        started.put((data, addr, cancel))
+        cancel.wait(5)
+
+    server.send_file = send_file
+    server.started = started
+    finished = queue.Queue()
+
+    def transfer(request, addr, cancel):
+        udp_server.UdpServer._transfer(server, request, addr, cancel)
+        finished.put(request)
+
+    server._transfer = transfer
+    server.finished = finished
+    yield server
+    for cancel in list(server.transfers.values()):
+        cancel.set()
+    server.executor.shutdown()
+
+
+def test_transfers_over_limit_rejected(transfer_server):
+    clients = [("127.0.0.1", 40000 + i) for i in range(3)]
+    assert transfer_server.start_transfer("a", clients[0])
+    assert transfer_server.start_transfer("b", clients[1])
+    assert not transfer_server.start_transfer("c", clients[2])
+    assert transfer_server.sock.sent == [
+        (b"Too many transfers in progress\n", clients[2])
+    ]
+    assert sorted(transfer_server.transfers) == clients[:2]
+    # Clients with a running transfer can still replace it
+    assert transfer_server.start_transfer("d", clients[0])
+
+
+def test_new_request_replaces_transfer(transfer_server):
+    addr = ("127.0.0.1", 40000)
+    assert transfer_server.start_transfer("a", addr)
+    data, _, first = transfer_server.started.get(timeout=5)
+    assert data == b"a"
+    assert transfer_server.start_transfer("b", addr)
+    data, _, second = transfer_server.started.get(timeout=5)
+    assert data == b"b"
+    assert first.is_set() and not second.is_set()
+    # Replaced transfer ending does not untrack the new one
+    assert transfer_server.finished.get(timeout=5) == "a"
+    assert transfer_server.transfers == {addr: second}
+
+
+def test_cancel_request(transfer_server):
+    addr = ("127.0.0.1", 40000)
+    assert transfer_server.start_transfer("a", addr)
+    _, _, cancel = transfer_server.started.get(timeout=5)
+    assert not transfer_server.start_transfer(udp_server.CANCEL_REQUEST, addr)
+    assert cancel.is_set()
+    assert transfer_server.transfers == {}
+    assert transfer_server.finished.get(timeout=5) == "a"
+    assert transfer_server.started.empty()
+    # Nothing to cancel
+    assert not transfer_server.start_transfer(udp_server.CANCEL_REQUEST, addr)
+    assert transfer_server.sock.sent == []
@@ -1,16 +1,142 @@
 #!/usr/bin/env python3
 """TCP client tool."""
-import _thread
+import re
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import flog
 from config_handler import ServerConfig
+from data_stream import DataStream
 from echo_client import EchoClient
-from http.server import BaseHTTPRequestHandler, HTTPServer
-import cgi
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
 
 
 DEFAULT_TIMEOUT = 120
 LOCAL_PORT_UDP = 50000
 SERVICES = ["tcp_client", "udp_client"]
+DEFAULT_MAX_JOBS = "32"
+DEFAULT_JOB_HISTORY = "256"
+JOBS_PATH = re.compile(r"^/jobs/?$")
+JOB_PATH = re.compile(r"^/jobs/(\d+)/?$")
+
+
+class Job:
+    """Echo client run by the job engine."""
+
+    def __init__(self, job_id, service, client):
+        """Initialize job running client for service."""
+        self.id = job_id
+        self.service = service
+        self.client = client
+        self.created = time.time()
+        self.started = None
+        self.ended = None
+        self.error = None
+        self.future = None
+
+    def run(self):
+        """Run echo client."""
+        self.started = time.time()
+        try:
+            self.client.run()
+        except Exception as ex:
+            flog.warning("Job {} failed: {}".format(self.id, repr(ex)))
+            self.error = repr(ex)
+        finally:
+            self.ended = time.time()
+
+    def to_dict(self):
+        """Get job description and client stats."""
+        job = {
+            "id": self.id,
+            "service": self.service,
+            "address": self.client.address,
+            "port": self.client.port,
+            "echo": self.client.echo,
+            "created": self.created,
+            "started": self.started,
+            "ended": self.ended,
+            "error": self.error,
+        }
+        job.update(self.client.stats())
+        if self.future.cancelled():
+            job["state"] = "cancelled"
+        elif not self.started:
+            job["state"] = "queued"
+        elif self.client.stopped.is_set() and not self.ended:
+            job["state"] = "cancelling"
+        return job
+
+
+class JobEngine:
+    """Run echo client jobs on a bounded pool of workers."""
+
+    def __init__(self, max_jobs, history):
+        """Initialize engine running up to max_jobs, keeping history jobs."""
+        self.max_jobs = max_jobs
+        self.history = history
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.local_port_udp = LOCAL_PORT_UDP
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs)
+
+    def active(self):
+        """Get number of queued or running jobs."""
+        return sum(1 for job in self.jobs.values() if not job.future.done())
+
+    def create(self, service, request_vals):
+        """Create and start job, returns None if too many jobs are active."""
+        with self.lock:
+            if self.active() >= self.max_jobs:
+                return None
+            local_port = None
+            if service == "udp_client":
+                self.local_port_udp += 1
+                local_port = self.local_port_udp
+            client = EchoClient(
+                address=request_vals["address"],
+                port=int(request_vals["port"]),
+                message=request_vals["message"],
+                echo=request_vals["echo"],
+                mode="TCP" if service == "tcp_client" else "UDP",
+                local_port=local_port,
+                timeout=DEFAULT_TIMEOUT,
+            )
+            self.last_id += 1
+            job = Job(self.last_id, service, client)
+            self.jobs[job.id] = job
+            # Forget oldest finished jobs
+            for old_job in list(self.jobs.values()):
+                if len(self.jobs) <= self.history:
+                    break
+                if old_job.future and old_job.future.done():
+                    del self.jobs[old_job.id]
+            flog.info(f"Starting {service} job {job.id}.")
+            job.future = self.executor.submit(job.run)
+        return job
+
+    def get(self, job_id):
+        """Get job by id, None if unknown."""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        """Get all jobs."""
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id):
+        """Cancel job, returns None if unknown."""
+        job = self.get(job_id)
+        if job:
+            flog.info(f"Cancelling job {job.id}.")
+            job.future.cancel()
+            job.client.cancel()
+        return job
 
 
 class RequestHandler(BaseHTTPRequestHandler):
@@ -22,12 +148,87 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.send_header("Content-type", "text/html")
         self.end_headers()
 
+    def _parse_range(self, size):
+        """Parse Range header of request.
+
+        Returns (start, end) with end excluded, None if range is not satisfiable.
+        """
+        byte_range = self.headers.get("Range")
+        if not byte_range:
+            return 0, size
+        match = re.match(r"^bytes=(\d*)-(\d*)$", byte_range.strip())
+        if not match or not any(match.groups()):
+            return None
+        start, end = match.groups()
+        if not start:
+            # Suffix range: last bytes of stream
+            if not int(end):
+                return None
+            return max(size - int(end), 0), size
+        end = min(int(end) + 1, size) if end else size
+        if int(start) >= end:
+            return None
+        return int(start), end
+
+    def _send_stream(self, stream, body=True):
+        """Send generated data stream, honoring Range header."""
+        byte_range = self._parse_range(stream.size)
+        if byte_range is None:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % stream.size)
+            self.end_headers()
+            return
+        start, end = byte_range
+        if self.headers.get("Range"):
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes %d-%d/%d" % (start, end - 1, stream.size)
+            )
+        else:
+            self.send_response(200)
+        content_type = (
+            "text/plain" if stream.data_type == "text" else "application/octet-stream"
+        )
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if body:
+            for chunk in stream.chunks(start, end):
+                self.wfile.write(chunk)
+
+    def _send_path_stream(self, body=True):
+        """Send stream of request path, returns False if path is not a stream path.
+
+        Invalid stream paths get a 400 response.
+        """
+        try:
+            stream = DataStream.from_path(self.path)
+        except ValueError as e:
+            self._set_headers(400)
+            if body:
+                self.wfile.write(
+                    b"<html><body><h1>Bad Request!</h1><br><p>%s</p></body></html>"
+                    % str(e).encode("utf-8")
+                )
+            return True
+        if not stream:
+            return False
+        self._send_stream(stream, body)
+        return True
+
     def do_HEAD(self):
         """Call set headers."""
+        if self._send_path_stream(body=False):
+            return
         self._set_headers(200)
 
     def do_GET(self):
-        """Return usage."""
+        """Return usage, generated data stream for stream/<type>/<size> or jobs."""
+        if self._send_path_stream():
+            return
+        if self._get_jobs():
+            return
         self._set_headers(200)
         service_string = ""
         for service in SERVICES:
@@ -62,58 +263,113 @@ class RequestHandler(BaseHTTPRequestHandler):
             % (service_string.encode("utf-8"))
         )
 
+    def _send_json(self, data, rsp=200):
+        """Send JSON response."""
+        body = json.dumps(data, indent=2).encode()
+        self.send_response(rsp)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _job_request(self):
+        """Parse job request from form or JSON body.
+
+        Returns (service, request values), None if request is not valid.
+        """
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            values = json.loads(body or b"{}")
+        else:
+            form = parse_qs(body.decode("utf-8"))
+            values = {key: value[0] for key, value in form.items()}
+        service = values.get("service", None)
+        if not service or service not in SERVICES:
+            return None
+        request_vals = {
+            "address": values.get("address", None),
+            "port": str(values.get("port") or ""),
+            "message": values.get("message", "Hello from Flake Client!"),
+            "echo": values.get("echo", False),
+        }
+        flog.info(request_vals)
+        if not (
+            request_vals["address"]
+            and request_vals["port"].isdigit()
+            and (request_vals["message"] or request_vals["echo"])
+        ):
+            return None
+        return service, request_vals
+
+    def _job_id(self):
+        """Get job id from path, None if path is not a job path."""
+        match = JOB_PATH.match(self.path)
+        return int(match.group(1)) if match else None
+
+    def do_DELETE(self):
+        """Cancel job."""
+        job_id = self._job_id()
+        job = None if job_id is None else self.server.job_engine.cancel(job_id)
+        if not job:
+            self._send_json({"error": "Unknown job"}, 404)
+            return
+        self._send_json(job.to_dict())
+
+    def _get_jobs(self):
+        """Send job list or job, returns False if path is not a job path."""
+        if JOBS_PATH.match(self.path):
+            self._send_json([job.to_dict() for job in self.server.job_engine.list()])
+            return True
+        job_id = self._job_id()
+        if job_id is None:
+            return False
+        job = self.server.job_engine.get(job_id)
+        if not job:
+            self._send_json({"error": "Unknown job"}, 404)
+        else:
+            self._send_json(job.to_dict())
+        return True
+
     def do_POST(self):
-        """Start TCP client from request."""
-        global DEFAULT_TIMEOUT, SERVICES, LOCAL_PORT_UDP
+        """Start TCP client from request.
+
+        Form requests get an HTML page, requests to /jobs get the job as JSON.
+        """
+        api = JOBS_PATH.match(self.path) is not None
         bad_request_str = b"<html><body><h1>Bad Request!</h1></body></html>"
         try:
-            form = cgi.FieldStorage(
-                fp=self.rfile, headers=self.headers, environ={"REQUEST_METHOD": "POST"}
-            )
-            service = form.getvalue("service", None)
-            if not service or service not in SERVICES:
-                self._set_headers(400)
-                self.wfile.write(bad_request_str)
+            job_request = self._job_request()
+            if not job_request:
+                if api:
+                    self._send_json({"error": "Bad Request"}, 400)
+                else:
+                    self._set_headers(400)
+                    self.wfile.write(bad_request_str)
                 return
-
-            request_vals = {
-                "address": form.getvalue("address", None),
-                "port": form.getvalue("port", None),
-                "message": form.getvalue("message", "Hello from Flake Client!"),
-                "echo": form.getvalue("echo", False),
-            }
-            flog.info(request_vals)
-            if service in ["tcp_client", "udp_client"] and not (
-                request_vals["address"]
-                and request_vals["port"]
-                and request_vals["port"].isdigit()
-                and (request_vals["message"] or request_vals["echo"])
-            ):
-                self._set_headers(400)
-                self.wfile.write(bad_request_str)
+            service, request_vals = job_request
+            job = self.server.job_engine.create(service, request_vals)
+            if not job:
+                if api:
+                    self._send_json({"error": "Too many jobs"}, 503)
+                else:
+                    self._set_headers(503)
+                    self.wfile.write(
+                        b"<html><body><h1>Too many jobs, retry later!</h1></body></html>"
+                    )
                 return
-            local_port = None
-            if service == "udp_client":
-                LOCAL_PORT_UDP += 1
-                local_port = LOCAL_PORT_UDP
-            if service in ["tcp_client", "udp_client"]:
-                echo_client = EchoClient(
-                    address=request_vals["address"],
-                    port=int(request_vals["port"]),
-                    message=request_vals["message"],
-                    echo=request_vals["echo"],
-                    mode="TCP" if service == "tcp_client" else "UDP",
-                    local_port=local_port,
-                    timeout=DEFAULT_TIMEOUT,
-                )
-                flog.info(f"Starting {service} thread.")
-                _thread.start_new_thread(echo_client.run, ())
-                self._set_headers(200)
-                self.wfile.write(
-                    b"<html><body><h1>Request Received, starting %s!</h1></body></html>"
-                    % service.encode()
-                )
+            if api:
+                self._send_json(job.to_dict(), 201)
+                return
+            self._set_headers(200)
+            self.wfile.write(
+                b"<html><body><h1>Request Received, starting %s (job %d)!</h1></body></html>"
+                % (service.encode(), job.id)
+            )
         except Exception as e:
+            if api:
+                self._send_json({"error": repr(e)}, 400)
+                return
             self._set_headers(400)
             self.wfile.write(
                 b"<html><body><h1>Bad Request!</h1><br><p>%s</p></body></html>"
@@ -140,11 +396,18 @@ class HttpRequestServer:
                 "Could not use specified timeout, using default value: %d"
                 % DEFAULT_TIMEOUT
             )
+        self.max_jobs = int(
+            self.config["dynamic_http"].get("max_jobs", DEFAULT_MAX_JOBS)
+        )
+        self.job_history = int(
+            self.config["dynamic_http"].get("job_history", DEFAULT_JOB_HISTORY)
+        )
         self.address = ("0.0.0.0", self.port)
 
     def run(self):
-        """Run http server."""
-        httpd = HTTPServer(self.address, RequestHandler)
+        """Run http server, each request is handled in its own thread."""
+        httpd = ThreadingHTTPServer(self.address, RequestHandler)
+        httpd.job_engine = JobEngine(self.max_jobs, self.job_history)
         flog.info("Server running at localhost:%d..." % self.port)
         httpd.serve_forever()
 
@@ -1,5 +1,7 @@
 """TCP client tool."""
 import select
+import threading
+import time
 from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM
 import flog
 
@@ -29,12 +31,51 @@ class EchoClient:
         self.mode = mode.upper()
         self.local_port = local_port
         self.timeout = timeout
+        self.state = "created"
+        self.stopped = threading.Event()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.rtts = []
+        self.sent_time = None
+
+    def cancel(self):
+        """Stop client, within a second."""
+        self.stopped.set()
+
+    def stats(self):
+        """Get client state, transferred bytes and round trip times."""
+        rtt = {"count": len(self.rtts)}
+        if self.rtts:
+            rtt.update(
+                min=min(self.rtts),
+                max=max(self.rtts),
+                avg=sum(self.rtts) / len(self.rtts),
+                last=self.rtts[-1],
+            )
+        return {
+            "state": self.state,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "rtt": rtt,
+        }
+
+    def _sent(self, size):
+        """Count data sent."""
+        self.bytes_sent += size
+        self.sent_time = time.monotonic()
+
+    def _received(self, size):
+        """Count data received, answering last data sent."""
+        self.bytes_received += size
+        if self.sent_time is not None:
+            self.rtts.append(time.monotonic() - self.sent_time)
+            self.sent_time = None
 
     def send(self, data):
         """Send encoded data to server."""
         try:
             flog.info(f"Sending data of length: {len(data)}")
-            self.client.send(data)
+            self._sent(self.client.send(data))
         except (BlockingIOError, ConnectionResetError, socket.timeout) as e:
             flog.debug(e)
 
@@ -44,9 +85,16 @@ class EchoClient:
         wait_time = 1
         got_data = False
         for _ in range(0, self.timeout, wait_time):
+            if self.stopped.is_set():
+                break
             sockets, _, _ = select.select((self.client,), (), (), wait_time)
             for sock in sockets:
-                data += sock.recv(MAX_BUFFER)
+                part = sock.recv(MAX_BUFFER)
+                if part and not data:
+                    self._received(len(part))
+                elif part:
+                    self.bytes_received += len(part)
+                data += part
                 got_data = data != b""
                 flog.debug(f"Data part received length: {len(data)}")
                 break
@@ -59,6 +107,16 @@ class EchoClient:
         flog.info(f"Received message of length: {len(data)} bytes")
         return data
 
+    def wait_readable(self):
+        """Wait for data until timeout, returns False if none or stopped."""
+        for _ in range(self.timeout):
+            if self.stopped.is_set():
+                return False
+            if select.select((self.client,), (), (), 1)[0]:
+                return True
+        flog.warning("UDP Client Exception: timed out")
+        return False
+
     def check_message(self, message):
         "Check if message has command encoded."
         try:
@@ -109,8 +167,12 @@ class EchoClient:
                 data = self.message.encode()
             try:
                 flog.info(f"Sending data of length: {len(data)}")
-                self.client.sendto(data, addr)
+                self._sent(self.client.sendto(data, addr))
+                if not self.wait_readable():
+                    self.client.close()
+                    break
                 data, addr = self.client.recvfrom(MAX_BUFFER)
+                self._received(len(data))
                 flog.info(f"Received message of length: {len(data)} bytes")
                 if not data or self.check_message(data) == "close":
                     self.client.close()
@@ -126,13 +188,20 @@ class EchoClient:
         flog.debug(f"Echo: {self.echo}")
         if not self.echo:
             flog.debug(f"Message Size: {len(self.message)}")
-        if self.mode == "TCP":
-            self.run_tcp()
-        elif self.mode == "UDP":
-            self.run_udp()
-        else:
-            flog.error(
-                f"Cannot run client in mode: {self.mode}\nplease use either TCP or UDP"
-            )
-            return
+        self.state = "running"
+        try:
+            if self.mode == "TCP":
+                self.run_tcp()
+            elif self.mode == "UDP":
+                self.run_udp()
+            else:
+                flog.error(
+                    f"Cannot run client in mode: {self.mode}\nplease use either TCP or UDP"
+                )
+                self.state = "failed"
+                return
+        except Exception:
+            self.state = "failed"
+            raise
+        self.state = "cancelled" if self.stopped.is_set() else "done"
         flog.info(f"End {self.mode} Client")
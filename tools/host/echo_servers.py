@@ -1,64 +1,122 @@
 """TCP / UDP echo server."""
 import _thread
-import multiprocessing
-import os
-import select
-import signal
+import argparse
+import asyncio
+import functools
 import socket
 import struct
-import time
 import flog
 from config_handler import ServerConfig
+from datagram import DatagramRing
 
 
 max_buffer = 65535
-
-
-def tcp_handle(client_sock, killable=False):
-    """Echo data over TCP socket."""
+ZERO_BYTE_TEST = b"0 byte test"
+# Pending echo data per connection before reading is paused
+write_buffer_limit = 4 * max_buffer
+# Event loop liveness check period and lag considered as stalled, in seconds
+health_interval = 1
+health_max_lag = 1
+HEALTH_REQUEST = b"health"
+# Receive buffers, only held by connections while echoing data, the pool
+# keeps at most max_pooled_buffers of them once connections are done
+max_pooled_buffers = 64
+_buffers = []
+
+
+async def _readable(loop, sock):
+    """Wait until socket has data to read."""
+    future = loop.create_future()
+    loop.add_reader(sock.fileno(), lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        loop.remove_reader(sock.fileno())
+
+
+async def tcp_echo(sock, timeout):
+    """Echo data over TCP socket, without command scanning.
+
+    Data is received into a reused buffer and fully sent back before reading
+    more. The connection ends once reading or sending stalls for timeout.
+    """
     flog.info("Launch TCP Handler.")
-    while True:
-        try:
-            data = client_sock.recv(max_buffer)
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            await asyncio.wait_for(_readable(loop, sock), timeout)
+            buffer = _buffers.pop() if _buffers else bytearray(max_buffer)
             try:
-                data_str = data.decode("utf-8")
-            except Exception:
+                size = sock.recv_into(buffer)
+                if not size:
+                    break
+                await asyncio.wait_for(
+                    loop.sock_sendall(sock, memoryview(buffer)[:size]), timeout
+                )
+            except BlockingIOError:
                 pass
-            if killable and data_str:
-                if "kill" in data_str:
+            finally:
+                if len(_buffers) < max_pooled_buffers:
+                    _buffers.append(buffer)
+    except (asyncio.TimeoutError, OSError) as ex:
+        flog.warning("TCP Handler Exception: {}".format(repr(ex)))
+    finally:
+        sock.close()
+    flog.info("End TCP Handler")
+
+
+async def tcp_handle(reader, writer, timeout, killable=False):
+    """Echo data over TCP connection.
+
+    On killable connections, "kill" aborts the connection as if the server died
+    and "stop" closes it. Killable sockets linger 0, so both send a reset.
+    """
+    flog.info("Launch TCP Handler.")
+    writer.transport.set_write_buffer_limits(high=write_buffer_limit)
+    try:
+        while True:
+            data = await asyncio.wait_for(reader.read(max_buffer), timeout)
+            if not data:
+                break
+            if killable:
+                if b"kill" in data:
                     flog.debug("Killing Socket...")
-                    pid = os.getpid()
-                    os.kill(pid, signal.SIGKILL)
-                if "stop" in data_str:
+                    # Linger is off, connection is reset as if server died
+                    writer.transport.abort()
+                    return
+                if b"stop" in data:
                     flog.debug("Stopping Socket...")
-                    client_sock.close()
+                    # Socket is closed, with linger 0 inherited from the kill server
                     break
-            if data:
-                flog.debug("Received TCP data: %s" % data)
-                client_sock.send(data)
-            else:
-                client_sock.close()
-                break
-        except Exception as ex:
-            flog.warning("TCP Handler Exception: {}".format(ex))
-            client_sock.close()
-            break
+            flog.debug("Received TCP data: %s" % data)
+            writer.write(data)
+            # Wait for client to read echoed data before reading more
+            await writer.drain()
+    except (asyncio.TimeoutError, OSError) as ex:
+        flog.warning("TCP Handler Exception: {}".format(repr(ex)))
+    finally:
+        writer.close()
     flog.info("End TCP Handler")
 
 
-def tcp_poll_handle(client_sock):
-    """Handle TCP polling client needed for killable server."""
-    while True:
-        try:
-            data = client_sock.recv(max_buffer)
-            if data:
-                client_sock.send(data)
-            else:
-                client_sock.close()
+async def tcp_poll_handle(reader, writer, timeout, health):
+    """Handle TCP polling client needed for killable server.
+
+    Data is echoed, a health request is answered with the event loop lag.
+    """
+    try:
+        while True:
+            data = await asyncio.wait_for(reader.read(max_buffer), timeout)
+            if not data:
                 break
-        except Exception:
-            client_sock.close()
-            break
+            if data.strip() == HEALTH_REQUEST:
+                data = b"ok lag=%.3fs\n" % health()
+            writer.write(data)
+            await writer.drain()
+    except (asyncio.TimeoutError, OSError):
+        pass
+    finally:
+        writer.close()
 
 
 class EchoServer:
@@ -71,26 +129,38 @@ class EchoServer:
         self.kill_port = int(self.config["tcp_kill_server"]["port"])
         self.polling_port = int(self.config["tcp_kill_server"]["polling_port"])
         self.timeout = int(self.config["tcp_udp"]["timeout"])
+        self.log_packets = self.config["tcp_udp"].get("log_packets", "0") == "1"
+        self.loop_lag = 0
         self.local_ip = "0.0.0.0"
         self.tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.udp_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.tcp_kill_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.tcp_local_poll_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Workers share the ports, the kernel balances flows between them
+        for sock in (
+            self.tcp_server,
+            self.udp_server,
+            self.tcp_kill_server,
+            self.tcp_local_poll_server,
+        ):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
     def udp_handle(self):
-        """Echo data over UDP socket."""
+        """Echo data over UDP socket, by batches of datagrams."""
         flog.info("Launch UDP Handler.")
+        ring = DatagramRing(self.udp_server, buffer_size=max_buffer)
+        lengths = [0] * ring.batch
         while True:
-            data, addr = self.udp_server.recvfrom(max_buffer)
-            if data:
-                if data == b"0 byte test":
-                    flog.debug("Received 0 byte test")
-                    self.udp_server.sendto(b"", addr)
-                else:
-                    flog.debug("Received UDP data: %s" % data)
-                    self.udp_server.sendto(data, addr)
-            if not data:
-                self.udp_server.close()
+            count = ring.recv()
+            for i in range(count):
+                data = ring.payload(i)
+                # Answer 0 byte test with an empty datagram
+                lengths[i] = 0 if data == ZERO_BYTE_TEST else len(data)
+                if self.log_packets:
+                    flog.debug(
+                        "Received UDP data from %s: %s" % (ring.addr(i), bytes(data))
+                    )
+            ring.reply(count, lengths)
 
     def run(self):
         """Run Echo servers."""
@@ -100,7 +170,7 @@ class EchoServer:
         self.tcp_kill_server.bind((self.local_ip, self.kill_port))
         self.tcp_local_poll_server.bind((self.local_ip, self.polling_port))
         self.udp_server.bind((self.local_ip, self.port))
-        self.tcp_server.listen(5)
+        self.tcp_server.listen(100)
         self.tcp_kill_server.listen(5)
         self.tcp_local_poll_server.listen(5)
         l_onoff = 1
@@ -113,39 +183,69 @@ class EchoServer:
         _thread.start_new_thread(self.udp_handle, ())
 
         # listen for TCP
+        asyncio.run(self.serve_tcp())
+
+    async def accept_tcp(self):
+        """Accept TCP echo connections."""
+        loop = asyncio.get_running_loop()
+        tasks = set()
+        self.tcp_server.setblocking(False)
         while True:
-            sockets, _, _ = select.select(
-                (self.tcp_server, self.tcp_kill_server, self.tcp_local_poll_server),
-                (),
-                (),
-                1,
-            )
-            for sock in sockets:
-                client_sock, _ = sock.accept()
-                client_sock.settimeout(self.timeout)
-                if sock == self.tcp_server:
-                    _thread.start_new_thread(tcp_handle, (client_sock, False))
-                elif sock == self.tcp_kill_server:
-                    x = multiprocessing.Process(
-                        target=tcp_handle, args=(client_sock, True)
-                    )
-                    x.start()
-                else:
-                    _thread.start_new_thread(tcp_poll_handle, (client_sock,))
-            else:
-                time.sleep(1)
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as poll_socket:
-                    poll_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-                    poll_socket.connect_ex((self.local_ip, self.polling_port))
+            client_sock, _ = await loop.sock_accept(self.tcp_server)
+            client_sock.setblocking(False)
+            task = loop.create_task(tcp_echo(client_sock, self.timeout))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async def serve_tcp(self):
+        """Serve TCP echo, kill and polling servers from event loop."""
+        self.accept_task = asyncio.get_running_loop().create_task(self.accept_tcp())
+        handlers = (
+            (
+                self.tcp_kill_server,
+                functools.partial(tcp_handle, timeout=self.timeout, killable=True),
+            ),
+            (
+                self.tcp_local_poll_server,
+                functools.partial(
+                    tcp_poll_handle, timeout=self.timeout, health=self.health
+                ),
+            ),
+        )
+        for sock, handler in handlers:
+            await asyncio.start_server(handler, sock=sock, limit=max_buffer)
+        await self.check_liveness()
+
+    def health(self):
+        """Get event loop lag of last liveness check."""
+        return self.loop_lag
+
+    async def check_liveness(self):
+        """Check event loop keeps serving, by measuring its lag."""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(health_interval)
+            self.loop_lag = loop.time() - start - health_interval
+            if self.loop_lag > health_max_lag:
+                flog.warning("Event loop stalled for %.2fs" % self.loop_lag)
 
 
-def run_echo_server():
+def run_echo_server(worker=0):
     """Run echo servers."""
-    flog.info("Starting TCP/UDP Echo server")
+    flog.info("Starting TCP/UDP Echo server (worker {})".format(worker))
     config = ServerConfig()
     echo_servers = EchoServer(config)
     echo_servers.run()
 
 
+def main():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser(description="Flake TCP/UDP echo servers.")
+    parser.add_argument("-w", "--worker", type=int, default=0, help="worker index")
+    args = parser.parse_args()
+    run_echo_server(worker=args.worker)
+
+
 if __name__ == "__main__":
-    run_echo_server()
+    main()
@@ -1,17 +1,27 @@
 """Data file creation module to configure data files on server."""
 import os
-import re
+import json
 import time
 import shutil
+import hashlib
 import string
+import struct
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from scipy.io import wavfile
-from PIL import Image
 import flog
 from config_handler import ConfigHandler
+from data_stream import parse_size
 
 
 CONFIG = "$FLAKE_TOOLS/host/config/data_files.json"
+MANIFEST = "manifest.json"
+# Bump when generated content changes to regenerate existing files
+GENERATOR_VERSION = 4
+# Generators write by chunks of about this size to bound memory use
+WRITE_CHUNK_SIZE = 4 * 1024 * 1024
+TEXT_CHARSET = np.frombuffer(
+    (string.ascii_letters + string.digits).encode(), dtype=np.uint8
+)
 
 
 class DataFile:
@@ -22,17 +32,12 @@ class DataFile:
         self._base_name = config["base_name"]
         self._extension = config["extension"]
         self._size_list = config["size_list"]
+        # Smaller files are prefixes of the largest one
+        self.derive = config.get("derive_from_largest", False)
         base_folder = server_config["files"]["location"]
         base_folder = os.path.expandvars(base_folder)
         self._data_path = os.path.join(base_folder, data_path)
-        # Data conversion units
-        self._units = {
-            "B": 1,
-            "KB": 2**10,
-            "MB": 2**20,
-            "GB": 2**30,
-            "TB": 2**40,
-        }
+        self._data_type = data_path
 
     @staticmethod
     def get_data_handler(data_type, config, server_config):
@@ -56,8 +61,7 @@ class DataFile:
     @property
     def _data_folder(self):
         """Data folder."""
-        if not os.path.exists(self._data_path):
-            os.mkdir(self._data_path)
+        os.makedirs(self._data_path, exist_ok=True)
         return self._data_path
 
     def _generate_file_path(self, size):
@@ -67,29 +71,139 @@ class DataFile:
 
     def _parse_size(self, size):
         """Parse data size."""
-        size = size.upper()
-        if not re.match(r" ", size):
-            size = re.sub(r"([KMGT]?B)", r" \1", size)
-        number, unit = [tmp_str.strip() for tmp_str in size.split()]
-        return int(float(number) * self._units[unit])
+        return parse_size(size)
 
-    def configure(self, force=False):
-        """Create files."""
+    @property
+    def _manifest_path(self):
+        """Manifest file path."""
+        return os.path.join(self._data_folder, MANIFEST)
+
+    def read_manifest(self):
+        """Read manifest of data folder.
+
+        Returns dictionary of entries per file name.
+        """
+        try:
+            with open(self._manifest_path) as manifest_file:
+                return json.load(manifest_file)
+        except (OSError, ValueError):
+            return {}
+
+    def write_manifest(self, manifest):
+        """Write manifest of data folder."""
+        tmp_path = "%s.tmp" % self._manifest_path
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._manifest_path)
+
+    def manifest_entry(self, size, seed=None, source=None):
+        """Build manifest entry of created file."""
+        file_path = self._generate_file_path(size)
+        stat = os.stat(file_path)
+        return {
+            "type": self._data_type,
+            "size": size,
+            "bytes": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "seed": seed,
+            "source": source,
+            "digest": file_digest(file_path),
+            "version": GENERATOR_VERSION,
+        }
+
+    def pending_sizes(self, force=False, manifest=None):
+        """Get sizes of files to create."""
         if force:
             self._clear_data_folder()
-        for size in self._size_list:
-            if force or not self.check_file(size):
-                self.create_file(size)
+            return list(self._size_list)
+        if manifest is None:
+            manifest = self.read_manifest()
+        return [size for size in self._size_list if not self.check_file(size, manifest)]
+
+    def configure(self, force=False):
+        """Create files."""
+        manifest = {} if force else self.read_manifest()
+        for size in self.creation_order(self.pending_sizes(force, manifest)):
+            entry = self.make_file(size)
+            manifest[os.path.basename(self._generate_file_path(size))] = entry
+        self.write_manifest(manifest)
         return True
 
-    def check_file(self, size):
-        """Check if file exists."""
+    @property
+    def _largest_size(self):
+        """Largest size of size list."""
+        return max(self._size_list, key=self._parse_size)
+
+    def creation_order(self, sizes):
+        """Sort sizes so files to derive from are created first."""
+        if not self.derive:
+            return sizes
+        return sorted(sizes, key=self._parse_size, reverse=True)
+
+    def make_file(self, size):
+        """Create data file, derived from largest file when possible.
+
+        Returns manifest entry of file.
+        """
+        source_path = self._generate_file_path(self._largest_size)
+        if self.derive and size != self._largest_size and os.path.exists(source_path):
+            self.derive_file(size, source_path)
+            return self.manifest_entry(size, source=os.path.basename(source_path))
+        return self.manifest_entry(size, seed=self.create_file(size))
+
+    def derive_file(self, size, source_path):
+        """Create data file as a prefix of source file."""
+        file_path = self._generate_file_path(size)
+        flog.debug("Deriving %s of size %s from %s" % (file_path, size, source_path))
+        byte_size = self._parse_size(size)
+        copied = 0
+        with open(source_path, "rb") as src, open(file_path, "wb") as dst:
+            while copied < byte_size:
+                try:
+                    # Shares extents on reflink capable file systems
+                    count = os.copy_file_range(
+                        src.fileno(), dst.fileno(), byte_size - copied
+                    )
+                except (AttributeError, OSError):
+                    # Linux only, and not supported between all file systems
+                    count = os.sendfile(
+                        dst.fileno(), src.fileno(), None, byte_size - copied
+                    )
+                if count == 0:
+                    break
+                copied += count
+        assert copied == byte_size, "Failed to derive %s from %s" % (
+            file_path,
+            source_path,
+        )
+
+    def check_file(self, size, manifest):
+        """Check if file exists and matches its manifest entry (stat only)."""
         file_path = self._generate_file_path(size)
-        flog.debug("Checking if {} exists".format(file_path))
+        flog.debug("Checking if {} is up to date".format(file_path))
         if not os.path.exists(file_path):
             flog.warning("{} does not exist".format(file_path))
             return False
-        flog.debug("{} exists".format(file_path))
+        entry = manifest.get(os.path.basename(file_path))
+        stat = os.stat(file_path)
+        if (
+            not entry
+            or entry.get("version") != GENERATOR_VERSION
+            or entry.get("bytes") != stat.st_size
+            or entry.get("mtime_ns") != stat.st_mtime_ns
+        ):
+            flog.warning("{} is stale".format(file_path))
+            return False
+        flog.debug("{} is up to date".format(file_path))
+        return True
+
+    def verify_file(self, size, manifest):
+        """Check if file content matches its manifest digest."""
+        file_path = self._generate_file_path(size)
+        entry = manifest[os.path.basename(file_path)]
+        if file_digest(file_path) != entry["digest"]:
+            flog.warning("{} digest mismatch".format(file_path))
+            return False
         return True
 
 
@@ -105,20 +219,16 @@ class TextFile(DataFile):
         file_path = self._generate_file_path(size)
         flog.debug("Creating a text file %s of size %s" % (file_path, size))
         byte_size = self._parse_size(size)
-        chunk_size = 1024
-        with open(file_path, "w") as f:
+        chunk_size = WRITE_CHUNK_SIZE
+        seed = int.from_bytes(os.urandom(8), "little")
+        rng = np.random.default_rng(seed)
+        with open(file_path, "wb") as f:
             while byte_size > 0:
-                write_size = byte_size
-                if write_size > chunk_size:
-                    write_size = chunk_size
-                f.write(
-                    "".join(
-                        np.random.choice(
-                            list(string.ascii_letters + string.digits), write_size
-                        )
-                    )
-                )
+                write_size = min(byte_size, chunk_size)
+                indexes = rng.integers(0, len(TEXT_CHARSET), write_size, dtype=np.uint8)
+                f.write(TEXT_CHARSET[indexes].tobytes())
                 byte_size -= write_size
+        return seed
 
 
 class BinaryFile(DataFile):
@@ -157,10 +267,52 @@ class ImageFile(DataFile):
         byte_size = self._parse_size(size)
         # Need a slow growing series sqrt(x)/2 works for this.
         size = int(np.sqrt(byte_size) / 2)
+        # Grayscale float32 TIFF, written by strips of rows
+        rows_per_strip = max(1, WRITE_CHUNK_SIZE // (size * 4))
+        strip_sizes = [
+            min(rows_per_strip, size - row) * size * 4
+            for row in range(0, size, rows_per_strip)
+        ]
+        rng = np.random.default_rng()
+        with open(file_path, "wb") as f:
+            f.write(struct.pack("<2sHI", b"II", 42, 8 + sum(strip_sizes)))
+            for strip_size in strip_sizes:
+                rows = strip_size // (size * 4)
+                f.write(rng.random((rows, size), dtype=np.float32).tobytes())
+            f.write(self._tiff_ifd(size, rows_per_strip, strip_sizes, f.tell()))
 
-        d = np.random.random_sample((size, size)).astype(np.float32)
-        im = Image.fromarray(d, mode="F")
-        im.save(file_path)
+    @staticmethod
+    def _tiff_ifd(size, rows_per_strip, strip_sizes, offset):
+        """Encode TIFF image file directory located at offset."""
+        entry_count = 10
+        arrays_offset = offset + 2 + entry_count * 12 + 4
+        strip_offsets = [8 + sum(strip_sizes[:i]) for i in range(len(strip_sizes))]
+        if len(strip_sizes) == 1:
+            offsets_value, counts_value = strip_offsets[0], strip_sizes[0]
+        else:
+            offsets_value = arrays_offset
+            counts_value = arrays_offset + 4 * len(strip_sizes)
+        # (tag, type, count, value), type 3 is SHORT and 4 is LONG
+        entries = [
+            (256, 4, 1, size),  # ImageWidth
+            (257, 4, 1, size),  # ImageLength
+            (258, 3, 1, 32),  # BitsPerSample
+            (259, 3, 1, 1),  # Compression: none
+            (262, 3, 1, 1),  # PhotometricInterpretation: BlackIsZero
+            (273, 4, len(strip_sizes), offsets_value),  # StripOffsets
+            (277, 3, 1, 1),  # SamplesPerPixel
+            (278, 4, 1, rows_per_strip),  # RowsPerStrip
+            (279, 4, len(strip_sizes), counts_value),  # StripByteCounts
+            (339, 3, 1, 3),  # SampleFormat: IEEE float
+        ]
+        ifd = struct.pack("<H", entry_count)
+        for tag, value_type, count, value in entries:
+            ifd += struct.pack("<HHII", tag, value_type, count, value)
+        ifd += struct.pack("<I", 0)
+        if len(strip_sizes) > 1:
+            ifd += struct.pack("<%dI" % len(strip_sizes), *strip_offsets)
+            ifd += struct.pack("<%dI" % len(strip_sizes), *strip_sizes)
+        return ifd
 
 
 class VideoFile(DataFile):
@@ -173,19 +325,73 @@ class VideoFile(DataFile):
             "$FLAKE_TOOLS/host/resources/template_0.5MB.avi"
         )
 
+    def _read_template(self):
+        """Split template AVI at its movi list.
+
+        Returns (headers, frames, index): bytes up to the movi list, frame
+        chunks of the movi list and idx1 index entries.
+        """
+        with open(self.template, "rb") as f:
+            data = f.read()
+        assert data[:4] == b"RIFF" and data[8:12] == b"AVI ", "Template is not an AVI"
+        chunks = dict(riff_chunks(data, 12, len(data)))
+        movi_offset, movi_size = chunks[b"movi"]
+        idx1_offset, idx1_size = chunks[b"idx1"]
+        return (
+            data[:movi_offset],
+            data[movi_offset + 12 : movi_offset + 8 + movi_size],
+            data[idx1_offset + 8 : idx1_offset + 8 + idx1_size],
+        )
+
+    @staticmethod
+    def _repeat_headers(headers, copies):
+        """Patch frame counts of AVI headers for frames repeated copies times."""
+        headers = bytearray(headers)
+        # avih dwTotalFrames, strh dwLength of each stream list
+        fields = {b"avih": 16, b"strh": 32}
+        lists = [dict(riff_chunks(headers, 12, len(headers)))[b"hdrl"]]
+        while lists:
+            list_offset, list_size = lists.pop()
+            for fourcc, (offset, size) in riff_chunks(
+                headers, list_offset + 12, list_offset + 8 + list_size
+            ):
+                if fourcc == b"strl":
+                    lists.append((offset, size))
+                elif fourcc in fields:
+                    field = offset + 8 + fields[fourcc]
+                    value = struct.unpack_from("<I", headers, field)[0]
+                    struct.pack_into("<I", headers, field, value * copies)
+        return headers
+
     def create_file(self, size):
-        """Create data file (video)."""
+        """Create data file (video).
+
+        Frame chunks of the template are repeated, with the index and frame
+        counts of the headers extended to match.
+        """
         file_path = self._generate_file_path(size)
         flog.debug("Creating a video file %s of size %s" % (file_path, size))
         byte_size = self._parse_size(size)
-        file_str = self.template
         template_size = self._parse_size("0.5MB")
-        while template_size < byte_size:
-            file_str += "|{}".format(self.template)
-            byte_size -= template_size
-
-        cmd = 'ffmpeg -i "concat:{}" -c copy {}'.format(file_str, file_path)
-        assert os.system(cmd) == 0, "Failed to create video"
+        copies = max(1, -(-byte_size // template_size))
+        headers, frames, index = self._read_template()
+        headers = self._repeat_headers(headers, copies)
+        movi_size = 4 + len(frames) * copies
+        idx1_size = len(index) * copies
+        struct.pack_into("<I", headers, 4, len(headers) + 8 + movi_size + idx1_size)
+        # Index entries are (chunk id, flags, offset, size), offsets are
+        # relative to the movi list
+        entries = np.frombuffer(index, dtype="<u4").reshape(-1, 4)
+        with open(file_path, "wb") as f:
+            f.write(headers)
+            f.write(struct.pack("<4sI4s", b"LIST", movi_size, b"movi"))
+            for _ in range(copies):
+                f.write(frames)
+            f.write(struct.pack("<4sI", b"idx1", idx1_size))
+            for copy in range(copies):
+                copy_entries = entries.copy()
+                copy_entries[:, 2] += copy * len(frames)
+                f.write(copy_entries.tobytes())
 
 
 class AudioFile(DataFile):
@@ -203,24 +409,145 @@ class AudioFile(DataFile):
         # Need to take fraction of the size to get correct output size.
         length = byte_size / 352830
         sample_rate = 44100
-        frequency = 440.0
-        t = np.linspace(0, length, int(sample_rate * length))
-        y = np.sin(frequency * 2 * np.pi * t)  # Has frequency of 440Hz
-        wavfile.write(file_path, sample_rate, y)
+        frequency = 440
+        samples = int(sample_rate * length)
+        # 440Hz sine repeats exactly every 2205 samples (22 periods)
+        period = sample_rate // np.gcd(sample_rate, frequency)
+        table = np.sin(2 * np.pi * frequency * np.arange(period) / sample_rate)
+        chunk = np.tile(table, max(1, WRITE_CHUNK_SIZE // table.nbytes)).tobytes()
+        data_size = samples * table.itemsize
+        with open(file_path, "wb") as f:
+            # Mono 64 bits IEEE float wav
+            f.write(
+                struct.pack(
+                    "<4sI4s4sIHHIIHHH4sII4sI",
+                    b"RIFF",
+                    4 + 26 + 12 + 8 + data_size,
+                    b"WAVE",
+                    b"fmt ",
+                    18,
+                    3,  # WAVE_FORMAT_IEEE_FLOAT
+                    1,
+                    sample_rate,
+                    sample_rate * table.itemsize,
+                    table.itemsize,
+                    table.itemsize * 8,
+                    0,
+                    b"fact",
+                    4,
+                    samples,
+                    b"data",
+                    data_size,
+                )
+            )
+            remaining = data_size
+            while remaining > 0:
+                f.write(chunk[:remaining])
+                remaining -= len(chunk)
+
+
+def riff_chunks(data, start, end):
+    """Iterate (fourcc, (offset, size)) of RIFF chunks between start and end.
+
+    Lists are reported with their list type as fourcc.
+    """
+    offset = start
+    while offset < end:
+        fourcc, size = struct.unpack_from("<4sI", data, offset)
+        if fourcc in (b"RIFF", b"LIST"):
+            fourcc = bytes(data[offset + 8 : offset + 12])
+        yield fourcc, (offset, size)
+        offset += 8 + size + (size & 1)
+
+
+def file_digest(file_path):
+    """Compute digest of file content."""
+    digest = hashlib.blake2b()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _create_files(data_handler, data_type, sizes):
+    """Create data files, returns creation time and manifest entry of each."""
+    results = []
+    for size in data_handler.creation_order(sizes):
+        start_time = time.time()
+        entry = data_handler.make_file(size)
+        results.append((data_type, size, time.time() - start_time, entry))
+    return results
+
 
+def _verify_file(data_handler, data_type, size, manifest):
+    """Verify data file digest against manifest."""
+    return data_type, size, data_handler.verify_file(size, manifest)
 
-def configure_files(force=False, config_file=CONFIG):
-    """Configure server files."""
+
+def configure_files(force=False, config_file=CONFIG, processes=None, verify=False):
+    """Configure server files.
+
+    Only files missing or not matching the manifest are created, verify also
+    compares file digests to the manifest.
+    """
     config = ConfigHandler(config_file)
     configuration_times = {}
     total_time = time.time()
-    for data_type, data_values in config.items():
-        start_time = time.time()
-        data_handler = DataFile.get_data_handler(
-            data_type=data_type, config=data_values, server_config=config.server
+    handlers = {}
+    manifests = {}
+    pending = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = []
+        for data_type, data_values in config.items():
+            data_handler = DataFile.get_data_handler(
+                data_type=data_type, config=data_values, server_config=config.server
+            )
+            handlers[data_type] = data_handler
+            manifests[data_type] = {} if force else data_handler.read_manifest()
+            pending[data_type] = data_handler.pending_sizes(force, manifests[data_type])
+            if verify:
+                for size in set(data_values["size_list"]) - set(pending[data_type]):
+                    futures.append(
+                        executor.submit(
+                            _verify_file,
+                            data_handler,
+                            data_type,
+                            size,
+                            manifests[data_type],
+                        )
+                    )
+        for future in futures:
+            data_type, size, valid = future.result()
+            if not valid:
+                pending[data_type].append(size)
+        futures = []
+        for data_type, data_handler in handlers.items():
+            configuration_times[data_type] = 0
+            sizes = pending[data_type]
+            # Derived files need the largest file, keep them in one job
+            jobs = [sizes] if data_handler.derive else [[size] for size in sizes]
+            for job in jobs:
+                if job:
+                    futures.append(
+                        executor.submit(_create_files, data_handler, data_type, job)
+                    )
+        for future in futures:
+            for data_type, size, elapsed, entry in future.result():
+                file_name = os.path.basename(
+                    handlers[data_type]._generate_file_path(size)
+                )
+                manifests[data_type][file_name] = entry
+                configuration_times[data_type] += elapsed
+                configuration_times["%s %s" % (data_type, size)] = "%ss (%sMB/s)" % (
+                    format(elapsed, ".2f"),
+                    format(entry["bytes"] / 2**20 / max(elapsed, 1e-6), ".1f"),
+                )
+    for data_type, data_handler in handlers.items():
+        if pending[data_type] or force:
+            data_handler.write_manifest(manifests[data_type])
+        configuration_times[data_type] = "%ss" % format(
+            configuration_times[data_type], ".2f"
         )
-        data_handler.configure(force)
-        configuration_times[data_type] = "%ss" % format(time.time() - start_time, ".2f")
     configuration_times["Total"] = "%ss" % format(time.time() - total_time, ".2f")
     flog.info("Time to configure files:\n%s" % configuration_times)
     return True
@@ -0,0 +1,90 @@
+"""Seeded synthetic data streams.
+
+Content of a stream only depends on its type and size, any byte range of it is
+computed directly without storing the file.
+"""
+import re
+import string
+import hashlib
+
+
+BLOCK_SIZE = 64 * 1024
+STREAM_SEED = "flake"
+STREAM_TYPES = ("text", "binary")
+STREAM_ROOT = re.compile(r"^/?stream/")
+STREAM_PATH = re.compile(r"^/?stream/(\w+)/(\d+(?:\.\d+)? ?[KMGT]?B)$", re.IGNORECASE)
+# Data conversion units
+UNITS = {
+    "B": 1,
+    "KB": 2**10,
+    "MB": 2**20,
+    "GB": 2**30,
+    "TB": 2**40,
+}
+_CHARSET = (string.ascii_letters + string.digits).encode()
+TEXT_TABLE = bytes(_CHARSET[i % len(_CHARSET)] for i in range(256))
+
+
+def parse_size(size):
+    """Parse data size (e.g. 0.5MB) to bytes."""
+    size = size.upper()
+    if not re.match(r" ", size):
+        size = re.sub(r"([KMGT]?B)", r" \1", size)
+    number, unit = [tmp_str.strip() for tmp_str in size.split()]
+    return int(float(number) * UNITS[unit])
+
+
+def parse_rate(value):
+    """Parse tc rate (e.g. 1000mbit) to bytes per second."""
+    units = {"bit": 1, "kbit": 1e3, "mbit": 1e6, "gbit": 1e9, "tbit": 1e12}
+    units.update({"bps": 8, "kbps": 8e3, "mbps": 8e6, "gbps": 8e9, "tbps": 8e12})
+    match = re.match(r"([\d.]+)\s*([a-z]*)$", value.strip().lower())
+    assert match and match.group(2) in units, "Invalid rate %s" % value
+    return int(float(match.group(1)) * units[match.group(2)] / 8)
+
+
+class DataStream:
+    """Synthetic data file generated on the fly."""
+
+    def __init__(self, data_type, size, seed=STREAM_SEED):
+        """Initialize stream of data type and size (bytes or string)."""
+        assert data_type in STREAM_TYPES, "Invalid stream type {}".format(data_type)
+        self.data_type = data_type
+        self.size = parse_size(size) if isinstance(size, str) else size
+        self.key = "{}:{}:{}:".format(seed, data_type, self.size).encode()
+
+    @classmethod
+    def from_path(cls, path):
+        """Get stream from path (stream/<type>/<size>).
+
+        Returns None if path is not under stream/, raises ValueError if it is
+        not a valid stream path.
+        """
+        if not STREAM_ROOT.match(path):
+            return None
+        match = STREAM_PATH.match(path)
+        if not match or match.group(1).lower() not in STREAM_TYPES:
+            raise ValueError("Invalid stream path {}".format(path))
+        return cls(match.group(1).lower(), match.group(2))
+
+    def _block(self, index):
+        """Generate block of stream."""
+        block = hashlib.shake_128(self.key + index.to_bytes(8, "little")).digest(
+            BLOCK_SIZE
+        )
+        if self.data_type == "text":
+            block = block.translate(TEXT_TABLE)
+        return block
+
+    def chunks(self, start=0, end=None):
+        """Yield content from start to end (excluded)."""
+        end = self.size if end is None else min(end, self.size)
+        while start < end:
+            index, offset = divmod(start, BLOCK_SIZE)
+            chunk = self._block(index)[offset : offset + end - start]
+            yield chunk
+            start += len(chunk)
+
+    def read(self, start=0, end=None):
+        """Read content from start to end (excluded)."""
+        return b"".join(self.chunks(start, end))
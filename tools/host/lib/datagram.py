@@ -0,0 +1,170 @@
+"""Batched datagram socket I/O.
+
+Receives and sends several datagrams per system call with recvmmsg and
+sendmmsg, into a ring of preallocated buffers.
+"""
+import ctypes
+import errno
+import os
+import socket
+
+
+MSG_WAITFORONE = 0x10000
+SOCKADDR_SIZE = 128  # sizeof(struct sockaddr_storage)
+
+
+class iovec(ctypes.Structure):
+    """struct iovec."""
+
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    """struct msghdr."""
+
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    """struct mmsghdr."""
+
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_libc():
+    """Load libc mmsg functions, returns None if not available."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        for name in ("recvmmsg", "sendmmsg"):
+            func = getattr(libc, name)
+            func.restype = ctypes.c_int
+            func.argtypes = [
+                ctypes.c_int,
+                ctypes.POINTER(mmsghdr),
+                ctypes.c_uint,
+                ctypes.c_int,
+            ] + ([ctypes.c_void_p] if name == "recvmmsg" else [])
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+LIBC = _load_libc()
+
+
+class DatagramRing:
+    """Ring of datagram buffers filled and sent in batches.
+
+    Falls back to one datagram per system call without recvmmsg support.
+    """
+
+    def __init__(self, sock, batch=64, buffer_size=65535):
+        """Initialize ring of batch buffers of buffer_size for sock."""
+        self.sock = sock
+        self.batch = batch if LIBC else 1
+        self.buffer_size = buffer_size
+        self.buffers = (ctypes.c_char * (self.batch * buffer_size))()
+        self.view = memoryview(self.buffers).cast("B")
+        self.lengths = [0] * self.batch
+        self.addrs = [None] * self.batch
+        if not LIBC:
+            return
+        self.names = (ctypes.c_char * (self.batch * SOCKADDR_SIZE))()
+        self.iovecs = (iovec * self.batch)()
+        self.msgs = (mmsghdr * self.batch)()
+        base = ctypes.addressof(self.buffers)
+        names = ctypes.addressof(self.names)
+        for i in range(self.batch):
+            self.iovecs[i].iov_base = base + i * buffer_size
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = names + i * SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+
+    def payload(self, index):
+        """Get payload of received datagram."""
+        offset = index * self.buffer_size
+        return self.view[offset : offset + self.lengths[index]]
+
+    def addr(self, index):
+        """Get source address of received datagram."""
+        if self.addrs[index] is None:
+            hdr = self.msgs[index].msg_hdr
+            self.addrs[index] = _parse_sockaddr(
+                ctypes.string_at(hdr.msg_name, hdr.msg_namelen)
+            )
+        return self.addrs[index]
+
+    def recv(self):
+        """Wait for datagrams, returns number of datagrams received."""
+        if not LIBC:
+            self.lengths[0], self.addrs[0] = self.sock.recvfrom_into(self.view)
+            return 1
+        for i in range(self.batch):
+            self.iovecs[i].iov_len = self.buffer_size
+            self.msgs[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+            self.addrs[i] = None
+        count = _call(
+            LIBC.recvmmsg,
+            self.sock.fileno(),
+            self.msgs,
+            self.batch,
+            MSG_WAITFORONE,
+            None,
+        )
+        for i in range(count):
+            self.lengths[i] = self.msgs[i].msg_len
+        return count
+
+    def reply(self, count, lengths=None):
+        """Send back first count datagrams to their source.
+
+        Datagrams are sent as received, or truncated to lengths.
+        """
+        lengths = lengths or self.lengths
+        if not LIBC:
+            self.sock.sendto(self.payload(0)[: lengths[0]], self.addrs[0])
+            return
+        for i in range(count):
+            self.iovecs[i].iov_len = lengths[i]
+        sent = 0
+        while sent < count:
+            try:
+                sent += _call(
+                    LIBC.sendmmsg,
+                    self.sock.fileno(),
+                    ctypes.byref(self.msgs[sent]),
+                    count - sent,
+                    0,
+                )
+            except OSError:
+                # Drop datagram failing to send, e.g. unreachable client
+                sent += 1
+
+
+def _call(func, *args):
+    """Call libc function, retrying on EINTR."""
+    while True:
+        result = func(*args)
+        if result >= 0:
+            return result
+        error = ctypes.get_errno()
+        if error != errno.EINTR:
+            raise OSError(error, os.strerror(error))
+
+
+def _parse_sockaddr(data):
+    """Decode sockaddr to python address tuple."""
+    family = int.from_bytes(data[:2], "little")
+    port = int.from_bytes(data[2:4], "big")
+    if family == socket.AF_INET6:
+        return socket.inet_ntop(socket.AF_INET6, data[8:24]), port
+    return socket.inet_ntop(socket.AF_INET, data[4:8]), port
@@ -0,0 +1,197 @@
+"""DTLS server engine.
+
+Clients are demultiplexed by address into associations, each with its own
+connected socket, so that handshakes and transfers of several clients run
+concurrently. The listening connection keeps the cookie secret used to verify
+all client hellos.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from select import select
+from socket import socket, timeout as socket_timeout, AF_INET, SOCK_DGRAM
+import flog
+from dtls.err import openssl_error, SSL_ERROR_WANT_READ, SSL_ERROR_ZERO_RETURN
+from dtls.sslconnection import SSLConnection
+
+
+# Largest DTLS record payload
+READ_SIZE = 16384
+DEFAULT_MAX_ASSOCIATIONS = 64
+
+
+class DtlsAssociation:
+    """DTLS association with a client."""
+
+    def __init__(self, conn, addr):
+        """Initialize association of accepted connection from addr."""
+        self.conn = conn
+        self.addr = addr
+        self.sock = conn.get_socket(True)
+        self.started = time.monotonic()
+        self.handshake_time = None
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def handshake(self, timeout):
+        """Run handshake, retransmitting lost flights on DTLS timer."""
+        # Non-blocking socket, calls go straight to OpenSSL
+        self.sock.settimeout(0)
+        deadline = self.started + timeout
+        while True:
+            try:
+                self.conn.do_handshake()
+                break
+            except openssl_error() as err:
+                if err.ssl_error != SSL_ERROR_WANT_READ:
+                    raise
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket_timeout("handshake timed out")
+            retransmit = self.conn.get_timeout()
+            if retransmit is not None:
+                remaining = min(remaining, retransmit.total_seconds())
+            if not select([self.sock], [], [], remaining)[0]:
+                self.conn.handle_timeout()
+        self.handshake_time = time.monotonic() - self.started
+        # Reads wait for data up to timeout
+        self.sock.settimeout(timeout)
+
+    def read(self, size=READ_SIZE):
+        """Read datagram payload, returns empty bytes once peer closed."""
+        try:
+            data = self.conn.read(size)
+        except openssl_error() as err:
+            if err.ssl_error == SSL_ERROR_ZERO_RETURN:
+                return b""
+            raise
+        self.bytes_received += len(data)
+        return data
+
+    def write(self, data):
+        """Write datagram payload."""
+        self.conn.write(data)
+        self.bytes_sent += len(data)
+
+    def close(self):
+        """Shut down association and close its socket."""
+        try:
+            if self.handshake_time is not None:
+                self.sock.settimeout(0)
+                self.conn.shutdown()
+        except Exception:
+            pass
+        self.sock.close()
+
+    def timing(self):
+        """Get handshake and transfer timing of association."""
+        return {
+            "handshake": self.handshake_time,
+            "duration": time.monotonic() - self.started,
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+        }
+
+
+class DtlsEngine:
+    """DTLS server serving each client association from a worker."""
+
+    def __init__(
+        self,
+        name,
+        address,
+        certfile,
+        keyfile,
+        handler,
+        timeout,
+        max_associations=DEFAULT_MAX_ASSOCIATIONS,
+    ):
+        """Initialize server on address, handler serves handshaked associations.
+
+        Associations end once handler returns or after timeout seconds idle.
+        """
+        self.name = name
+        self.address = address
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.handler = handler
+        self.timeout = timeout
+        self.max_associations = max_associations
+        self.associations = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_associations)
+
+    def run(self):
+        """Accept client associations."""
+        sock = socket(AF_INET, SOCK_DGRAM)
+        sock.bind(self.address)
+        listener = SSLConnection(
+            sock,
+            keyfile=self.keyfile,
+            certfile=self.certfile,
+            server_side=True,
+            do_handshake_on_connect=False,
+        )
+        flog.debug("{}: Waiting for client connection".format(self.name))
+        while True:
+            self.accept(listener)
+
+    def accept(self, listener):
+        """Accept next client association of listener and serve it from a worker.
+
+        Returns the association, None if none was accepted.
+        """
+        try:
+            # Returns after a client hello with a valid cookie
+            accepted = listener.accept()
+        except Exception as ex:
+            flog.info("{}: rejected client hello: {}".format(self.name, ex))
+            return None
+        if not accepted:
+            return None
+        association = DtlsAssociation(*accepted)
+        with self.lock:
+            full = len(self.associations) >= self.max_associations
+            if not full:
+                self.associations[association.addr] = association
+        if full:
+            flog.warning(
+                "{}: too many associations, rejecting {}".format(
+                    self.name, association.addr
+                )
+            )
+            association.close()
+            return None
+        self.executor.submit(self._serve, association)
+        return association
+
+    def _serve(self, association):
+        """Run handshake then handler of association."""
+        addr = association.addr
+        try:
+            association.handshake(self.timeout)
+            flog.info(
+                "{}: handshake with {} in {:.1f} ms".format(
+                    self.name, addr, association.handshake_time * 1000
+                )
+            )
+            self.handler(association)
+        except Exception as ex:
+            flog.warning(
+                "{}: association with {} ended: {}".format(self.name, addr, ex)
+            )
+        finally:
+            association.close()
+            with self.lock:
+                if self.associations.get(addr) is association:
+                    del self.associations[addr]
+        timing = association.timing()
+        flog.info(
+            "{}: {} closed after {:.1f}s, {} bytes received, {} bytes sent".format(
+                self.name,
+                addr,
+                timing["duration"],
+                timing["bytes_received"],
+                timing["bytes_sent"],
+            )
+        )
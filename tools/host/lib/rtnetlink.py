@@ -0,0 +1,184 @@
+"""Minimal rtnetlink client.
+
+Encodes and decodes the route and traffic control messages used by flake,
+without shelling out to ip/tc.
+"""
+import os
+import socket
+import struct
+
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+RTM_GETROUTE = 26
+RTM_NEWQDISC = 36
+RTM_DELQDISC = 37
+RTM_GETQDISC = 38
+RTM_NEWTCLASS = 40
+RTM_DELTCLASS = 41
+RTM_GETTCLASS = 42
+RTM_NEWTFILTER = 44
+RTM_DELTFILTER = 45
+RTM_GETTFILTER = 46
+
+RTA_OIF = 4
+RTA_TABLE = 15
+RT_TABLE_MAIN = 254
+
+TCA_KIND = 1
+TCA_OPTIONS = 2
+
+TC_H_ROOT = 0xFFFFFFFF
+
+NLMSGHDR = struct.Struct("=IHHII")
+NLATTR = struct.Struct("=HH")
+RTMSG = struct.Struct("=BBBBBBBBI")
+TCMSG = struct.Struct("=BxxxiIII")
+
+
+class NetlinkError(Exception):
+    """Error returned by the kernel for a netlink request."""
+
+    def __init__(self, errno, request):
+        self.errno = errno
+        self.request = request
+        super(NetlinkError, self).__init__("{}: {}".format(request, os.strerror(errno)))
+
+
+def align(length):
+    """Align length on netlink 4 bytes boundary."""
+    return (length + 3) & ~3
+
+
+def attr(attr_type, data=b""):
+    """Encode netlink attribute."""
+    length = NLATTR.size + len(data)
+    return NLATTR.pack(length, attr_type) + data + b"\0" * (align(length) - length)
+
+
+def attr_u32(attr_type, value):
+    """Encode u32 netlink attribute."""
+    return attr(attr_type, struct.pack("=I", value))
+
+
+def attr_u64(attr_type, value):
+    """Encode u64 netlink attribute."""
+    return attr(attr_type, struct.pack("=Q", value))
+
+
+def attr_str(attr_type, value):
+    """Encode string netlink attribute."""
+    return attr(attr_type, value.encode() + b"\0")
+
+
+def parse_attrs(data):
+    """Decode netlink attributes to a dict of type to payload."""
+    attrs = {}
+    offset = 0
+    while offset + NLATTR.size <= len(data):
+        length, attr_type = NLATTR.unpack_from(data, offset)
+        if length < NLATTR.size:
+            break
+        # Strip NLA_F_NESTED / NLA_F_NET_BYTEORDER flags
+        attrs[attr_type & 0x3FFF] = data[offset + NLATTR.size : offset + length]
+        offset += align(length)
+    return attrs
+
+
+def parse_str(data):
+    """Decode string netlink attribute."""
+    return data.split(b"\0", 1)[0].decode()
+
+
+def parse_u32(data):
+    """Decode u32 netlink attribute."""
+    return struct.unpack_from("=I", data)[0]
+
+
+def tcmsg(ifindex, handle=0, parent=0, info=0):
+    """Encode traffic control message header."""
+    return TCMSG.pack(socket.AF_UNSPEC, ifindex, handle, parent, info)
+
+
+class RtNetlink:
+    """rtnetlink socket."""
+
+    def __init__(self):
+        """Open rtnetlink socket."""
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, 0))
+        self.seq = 0
+
+    def close(self):
+        """Close rtnetlink socket."""
+        self.sock.close()
+
+    def request(self, msg_type, body, flags=0, name=None, dump=False):
+        """Send request and wait for the kernel answer.
+
+        Returns the list of (type, payload) received for dump requests.
+        Raises NetlinkError if the kernel rejects the request.
+        """
+        self.seq += 1
+        flags |= NLM_F_REQUEST | (NLM_F_DUMP if dump else NLM_F_ACK)
+        self.sock.send(
+            NLMSGHDR.pack(NLMSGHDR.size + len(body), msg_type, flags, self.seq, 0)
+            + body
+        )
+        messages = []
+        while True:
+            data = self.sock.recv(1 << 16)
+            offset = 0
+            while offset + NLMSGHDR.size <= len(data):
+                length, rsp_type, _, seq, _ = NLMSGHDR.unpack_from(data, offset)
+                payload = data[offset + NLMSGHDR.size : offset + length]
+                offset += align(length)
+                if seq != self.seq:
+                    continue
+                if rsp_type == NLMSG_DONE:
+                    return messages
+                if rsp_type == NLMSG_ERROR:
+                    error = struct.unpack_from("=i", payload)[0]
+                    if error:
+                        raise NetlinkError(-error, name or msg_type)
+                    return messages
+                messages.append((rsp_type, payload))
+
+    def dump_tc(self, msg_type, ifindex, parent=0):
+        """Dump qdiscs, classes or filters of device.
+
+        Returns list of (tcmsg fields, attributes).
+        """
+        messages = self.request(msg_type, tcmsg(ifindex, parent=parent), dump=True)
+        objects = []
+        for _, payload in messages:
+            _, tc_ifindex, handle, tc_parent, info = TCMSG.unpack_from(payload)
+            if tc_ifindex != ifindex:
+                continue
+            fields = {"handle": handle, "parent": tc_parent, "info": info}
+            objects.append((fields, parse_attrs(payload[TCMSG.size :])))
+        return objects
+
+    def default_route_oif(self, family=socket.AF_INET):
+        """Return interface index of the default route in main table."""
+        messages = self.request(
+            RTM_GETROUTE, RTMSG.pack(family, 0, 0, 0, 0, 0, 0, 0, 0), dump=True
+        )
+        for _, payload in messages:
+            fields = RTMSG.unpack_from(payload)
+            dst_len, table = fields[1], fields[4]
+            attrs = parse_attrs(payload[RTMSG.size :])
+            if RTA_TABLE in attrs:
+                table = parse_u32(attrs[RTA_TABLE])
+            if dst_len == 0 and table == RT_TABLE_MAIN and RTA_OIF in attrs:
+                return parse_u32(attrs[RTA_OIF])
+        return None
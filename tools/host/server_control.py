@@ -1,21 +1,28 @@
 """Flake server control script."""
 import os
+import time
 import argparse
+import subprocess
 from enum import Enum
 import file_manager
 import port_publisher
 import traffic_manager
 import flog
+from config_handler import ServerConfig
 
 
 SERVER_ROOT = os.path.expandvars("$FLAKE_SERVER")
 SERVER_TOOLS = os.path.expandvars("$FLAKE_TOOLS")
+# Services run as workers by the supervisor, with their server config section
+WORKER_SERVICES = {"udp_server": "udp", "echo_servers": "tcp_udp"}
+SUPERVISOR_INTERVAL = 1
 
 
 class ServerAction(Enum):
     """Enum to hold server actions."""
 
     configure = "configure"
+    supervise = "supervise"
     test = "test"
 
 
@@ -51,12 +58,10 @@ class Server:
         ), "failed to configure traffic rules."
         flog.info("---- Successfully configured traffic rules ----")
         if self.with_services:
-            assert self.start_udp_server(), "failed to start UDP server."
-            flog.info("---- Successfully started UDP server ----")
+            assert self.start_supervisor(), "failed to start UDP/Echo servers."
+            flog.info("---- Successfully started UDP and TCP/UDP Echo servers ----")
             assert self.configure_iperf(), "failed to configure iperf server."
             flog.info("---- Successfully configured iperf on server ----")
-            assert self.start_echo_servers(), "failed to start TCP/UDP Echo servers."
-            flog.info("---- Successfully started TCP/UDP Echo servers ----")
             assert self.start_tcp_tls_server(), "failed to start TCP TLS server."
             flog.info("---- Successfully started TCP TLS Echo server  ----")
             assert (
@@ -78,21 +83,47 @@ class Server:
             flog.error(ex)
             return False
 
-    def start_udp_server(self):
-        """Start udp server as background process."""
-        script_path = os.path.join(self.server_tools, "host/udp_server.py")
-        log_file = os.path.join(self.server_root, "logs/udp_server.log")
-        cmd = "python3 -u {} > {} 2>&1 &".format(script_path, log_file)
-        flog.debug("Starting udp server with: {}".format(cmd))
+    def start_supervisor(self):
+        """Start supervisor of worker services as background process."""
+        script_path = os.path.join(self.server_tools, "host/server_control.py")
+        log_file = os.path.join(self.server_root, "logs/supervisor.log")
+        cmd = "python3 -u {} supervise > {} 2>&1 &".format(script_path, log_file)
+        flog.debug("Starting supervisor with: {}".format(cmd))
         return os.system(cmd) == 0
 
-    def start_echo_servers(self):
-        """Start tcp/udp echo servers as background process."""
-        script_path = os.path.join(self.server_tools, "host/echo_servers.py")
-        log_file = os.path.join(self.server_root, "logs/echo_servers.log")
-        cmd = "python3 -u {} > {} 2>&1 &".format(script_path, log_file)
-        flog.debug("Starting udp/tcp echo server with: {}".format(cmd))
-        return os.system(cmd) == 0
+    def _start_worker(self, service, index):
+        """Start worker process of service."""
+        script_path = os.path.join(self.server_tools, "host/{}.py".format(service))
+        log_file = os.path.join(self.server_root, "logs/{}.log".format(service))
+        cmd = ["python3", "-u", script_path, "--worker", str(index)]
+        flog.debug("Starting {} worker {} with: {}".format(service, index, cmd))
+        with open(log_file, "a") as log:
+            return subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+    def supervise(self):
+        """Run worker services, restarting dead workers."""
+        config = ServerConfig()
+        workers = {}
+        for service, section in WORKER_SERVICES.items():
+            # Clear log of previous run
+            open(
+                os.path.join(self.server_root, "logs/{}.log".format(service)), "w"
+            ).close()
+            # One worker per core with auto
+            setting = config[section].get("workers", "1")
+            count = os.cpu_count() if setting == "auto" else int(setting)
+            for index in range(count):
+                workers[(service, index)] = self._start_worker(service, index)
+        while True:
+            time.sleep(SUPERVISOR_INTERVAL)
+            for (service, index), process in workers.items():
+                if process.poll() is not None:
+                    flog.warning(
+                        "{} worker {} exited with {}, restarting.".format(
+                            service, index, process.returncode
+                        )
+                    )
+                    workers[(service, index)] = self._start_worker(service, index)
 
     def start_tcp_tls_server(self):
         """Start tcp tls echo server as background process."""
@@ -131,10 +162,12 @@ class Server:
     def configure_cron(self):
         """Configure cron settings."""
         flog.debug("configuring cron")
-        env_vars = "PYTHONPATH={} FLAKE_SERVER={} FLAKE_TOOLS={} SHELL=/bin/bash".format(
-            os.environ.get("PYTHONPATH"),
-            os.environ.get("FLAKE_SERVER"),
-            os.environ.get("FLAKE_TOOLS"),
+        env_vars = (
+            "PYTHONPATH={} FLAKE_SERVER={} FLAKE_TOOLS={} SHELL=/bin/bash".format(
+                os.environ.get("PYTHONPATH"),
+                os.environ.get("FLAKE_SERVER"),
+                os.environ.get("FLAKE_TOOLS"),
+            )
         )
         for cron_script, info in self.cron_config.items():
             script = "python3 -u {} > {} 2>&1".format(info["script"], info["log_file"])
@@ -167,6 +200,8 @@ class Server:
             result = self.test_config()
         elif action == ServerAction.configure:
             result = self.configure(force)
+        elif action == ServerAction.supervise:
+            result = self.supervise()
         return 0 if result else 1
 
 
@@ -177,7 +212,7 @@ def main():
         "action",
         type=str,
         help="action for flake server",
-        choices=["configure", "test"],
+        choices=["configure", "supervise", "test"],
     )
     parser.add_argument("-f", "--force", action="store_true", help="force action")
 
@@ -0,0 +1,475 @@
+"""Traffic control backends used by traffic_manager.
+
+The shell backend runs the tc command line tool, the netlink backend talks
+to the kernel over rtnetlink directly.
+"""
+import re
+import json
+import socket
+import struct
+import flog
+import rtnetlink
+from data_stream import parse_rate
+from rtnetlink import attr, attr_u32, attr_u64
+
+
+ETH_P_IP = 0x0800
+FILTER_PRIO = 1
+HTB_HANDLE = 0x10000
+
+TC_LINKLAYER_ETHERNET = 1
+TCA_HTB_PARMS = 1
+TCA_HTB_INIT = 2
+TCA_HTB_RATE64 = 6
+TCA_HTB_CEIL64 = 7
+TCA_NETEM_LATENCY64 = 10
+TCA_U32_CLASSID = 1
+TCA_U32_HASH = 2
+TCA_U32_LINK = 3
+TCA_U32_DIVISOR = 4
+TCA_U32_SEL = 5
+TC_U32_TERMINAL = 1
+
+# u32 port match: (mask, shift) on the ports word at offset 20.
+PORT_MATCH = {"sport": (0xFFFF0000, 16), "dport": (0x0000FFFF, 0)}
+
+
+def parse_time(value):
+    """Parse tc time (e.g. 100ms) to seconds."""
+    units = {"us": 1e-6, "ms": 1e-3, "s": 1}
+    match = re.match(r"([\d.]+)\s*(us|ms|s)?$", value.strip())
+    assert match, "Invalid time %s" % value
+    return float(match.group(1)) * units[match.group(2) or "us"]
+
+
+def parse_percent(value):
+    """Parse percentage (e.g. 2.5%) to ratio."""
+    return float(value.strip().strip("%")) / 100
+
+
+class ShellBackend:
+    """Backend running the tc command line tool.
+
+    Commands go through TrafficControl.run_tc, so they are queued in the tc
+    plan in batch mode.
+    """
+
+    name = "shell"
+
+    def __init__(self, tc):
+        """Initialize shell backend."""
+        self.tc = tc
+
+    def get_dev(self):
+        """Get interface device of the default route."""
+        cmd = "ip route | grep default | awk '{print $5}'"
+        return self.tc.run(cmd, tool=None, output=True)
+
+    def add_htb(self):
+        """Create htb root qdisc."""
+        return self.tc.run_tc(
+            "qdisc add dev {dev} root handle 1: htb".format(dev=self.tc.dev)
+        )
+
+    def del_htb(self):
+        """Delete htb root qdisc."""
+        return self.tc.run("qdisc del dev {dev} root htb".format(dev=self.tc.dev))
+
+    def add_class(self, class_id, rate):
+        """Create htb class."""
+        return self.tc.run_tc(
+            "class add dev {dev} parent 1: classid 1:{class_id:x} htb rate {rate}".format(
+                dev=self.tc.dev, class_id=class_id, rate=rate
+            )
+        )
+
+    def del_class(self, class_id):
+        """Delete htb class."""
+        return self.tc.run_tc(
+            "class del dev {dev} classid 1:{class_id:x}".format(
+                dev=self.tc.dev, class_id=class_id
+            )
+        )
+
+    def add_netem(self, class_id, delay, loss):
+        """Add netem qdisc to htb class."""
+        return self.tc.run_tc(
+            "qdisc add dev {dev} parent 1:{class_id:x} netem delay {delay} loss {loss}".format(
+                dev=self.tc.dev, class_id=class_id, delay=delay, loss=loss
+            )
+        )
+
+    def change_netem(self, class_id, handle, delay, loss):
+        """Change delay and loss of netem qdisc."""
+        return self.tc.run_tc(
+            "qdisc change dev {dev} parent 1:{class_id:x} handle {handle} netem delay {delay} loss {loss}".format(
+                dev=self.tc.dev,
+                class_id=class_id,
+                handle=handle,
+                delay=delay,
+                loss=loss,
+            )
+        )
+
+    def add_hash_table(self, handle, divisor):
+        """Create u32 hash table."""
+        return self.tc.run_tc(
+            "filter add dev {dev} parent 1: prio 1 handle {handle}: protocol ip u32 divisor {divisor}".format(
+                dev=self.tc.dev, handle=handle, divisor=divisor
+            )
+        )
+
+    def add_hash_link(self, handle, mask):
+        """Link u32 root table to hash table, hashing the ports word."""
+        return self.tc.run_tc(
+            "filter add dev {dev} parent 1: protocol ip prio 1 u32 ht 800:: match u32 0 0 link {handle}: hashkey mask {mask} at 20".format(
+                dev=self.tc.dev, handle=handle, mask=mask
+            )
+        )
+
+    def add_port_filter(self, handle, bucket, class_id, match, port):
+        """Add u32 filter to hash table bucket, catching packets on port."""
+        return self.tc.run_tc(
+            "filter add dev {dev} parent 1: protocol ip prio 1 u32 ht {handle}:{bucket:x}: flowid 1:{class_id:x} match ip {match} {port} 0xffff".format(
+                dev=self.tc.dev,
+                handle=handle,
+                bucket=bucket,
+                class_id=class_id,
+                match=match,
+                port=port,
+            )
+        )
+
+    def del_filter(self, fh):
+        """Delete u32 filter."""
+        return self.tc.run_tc(
+            "filter del dev {dev} parent 1: protocol ip prio 1 handle {fh} u32".format(
+                dev=self.tc.dev, fh=fh
+            )
+        )
+
+    def qdiscs(self):
+        """Return qdiscs of device."""
+        rsp = self.tc.run("-j qdisc show dev {}".format(self.tc.dev), output=True)
+        qdiscs = []
+        for qdisc in json.loads(rsp or "[]"):
+            options = qdisc.get("options", {})
+            qdiscs.append(
+                {
+                    "kind": qdisc["kind"],
+                    "handle": qdisc["handle"],
+                    "parent": qdisc.get("parent", ""),
+                    "root": qdisc.get("root", False),
+                    "delay": options.get("delay", {}).get("delay", 0.0),
+                    "loss": options.get("loss-random", {}).get("loss", 0.0),
+                }
+            )
+        return qdiscs
+
+    def class_ids(self):
+        """Return htb class ids of device."""
+        rsp = self.tc.run("class show dev {}".format(self.tc.dev), output=True)
+        return [int(class_id, 16) for class_id in re.findall(r"class htb 1:(\w+)", rsp)]
+
+    def port_filters(self):
+        """Return u32 hash tables and port filters of device.
+
+        Port filters are listed as (hash table, port, class id, filter handle).
+        """
+        rsp = self.tc.run("-j filter show dev {}".format(self.tc.dev), output=True)
+        tables = set()
+        port_filters = []
+        for port_filter in json.loads(rsp or "[]"):
+            options = port_filter.get("options", {})
+            if "ht_divisor" in options:
+                tables.add(options["fh"].strip(":"))
+            elif "flowid" in options and "match" in options:
+                mask = int(options["match"]["mask"], 16)
+                shift = (mask & -mask).bit_length() - 1
+                port = (int(options["match"]["value"], 16) & mask) >> shift
+                class_id = int(options["flowid"].split(":")[1], 16)
+                port_filters.append((options["key_ht"], port, class_id, options["fh"]))
+        return tables, port_filters
+
+
+class NetlinkBackend:
+    """Backend talking rtnetlink to the kernel.
+
+    Requests are sent as soon as they are made and errors are reported with
+    the kernel errno.
+    """
+
+    name = "netlink"
+
+    def __init__(self, tc):
+        """Initialize netlink backend, opening the rtnetlink socket."""
+        self.tc = tc
+        self.nl = rtnetlink.RtNetlink()
+        self._ifindex = None
+
+    @property
+    def ifindex(self):
+        """Interface index of device."""
+        if self._ifindex is None:
+            self._ifindex = socket.if_nametoindex(self.tc.dev)
+        return self._ifindex
+
+    def _request(self, name, msg_type, body, flags=0, quiet=False):
+        """Send netlink request, return True on success."""
+        flog.debug("netlink: {}".format(name))
+        if self.tc.dry_run:
+            print("netlink: {}".format(name))
+            return True
+        try:
+            self.nl.request(msg_type, body, flags=flags, name=name)
+            return True
+        except rtnetlink.NetlinkError as ex:
+            if quiet:
+                flog.debug(ex)
+            else:
+                flog.error(ex)
+            return False
+
+    @staticmethod
+    def _kind(kind, options=b""):
+        """Encode tc kind and options attributes."""
+        return rtnetlink.attr_str(rtnetlink.TCA_KIND, kind) + attr(
+            rtnetlink.TCA_OPTIONS, options
+        )
+
+    @staticmethod
+    def _u32_sel(keys, flags=0, hmask=0, hoff=0):
+        """Encode u32 selector from (mask, value, offset) keys."""
+        sel = struct.pack("=BBBx", flags, 0, len(keys))
+        sel += struct.pack(">H", 0) + struct.pack("=Hhh", 0, 0, hoff)
+        sel += struct.pack(">I", hmask)
+        for mask, value, offset in keys:
+            sel += struct.pack(">II", mask, value) + struct.pack("=ii", offset, 0)
+        return attr(TCA_U32_SEL, sel)
+
+    @staticmethod
+    def _u32_handle(handle, bucket=0):
+        """Encode u32 hash table handle."""
+        return (int(handle, 16) << 20) | (bucket << 12)
+
+    def _filter_msg(self, handle=0):
+        """Encode u32 filter message header."""
+        return rtnetlink.tcmsg(
+            self.ifindex,
+            handle=handle,
+            parent=HTB_HANDLE,
+            info=(FILTER_PRIO << 16) | socket.htons(ETH_P_IP),
+        )
+
+    def get_dev(self):
+        """Get interface device of the default route."""
+        oif = self.nl.default_route_oif()
+        return socket.if_indextoname(oif) if oif else ""
+
+    def add_htb(self):
+        """Create htb root qdisc."""
+        options = attr(TCA_HTB_INIT, struct.pack("=IIIII", 3, 10, 0, 0, 0))
+        return self._request(
+            "add htb root qdisc on {}".format(self.tc.dev),
+            rtnetlink.RTM_NEWQDISC,
+            rtnetlink.tcmsg(self.ifindex, HTB_HANDLE, rtnetlink.TC_H_ROOT)
+            + self._kind("htb", options),
+            flags=rtnetlink.NLM_F_CREATE | rtnetlink.NLM_F_EXCL,
+        )
+
+    def del_htb(self):
+        """Delete htb root qdisc."""
+        return self._request(
+            "delete root qdisc on {}".format(self.tc.dev),
+            rtnetlink.RTM_DELQDISC,
+            rtnetlink.tcmsg(self.ifindex, 0, rtnetlink.TC_H_ROOT),
+            quiet=True,
+        )
+
+    def add_class(self, class_id, rate):
+        """Create htb class."""
+        rate = parse_rate(rate)
+        # Burst of 1ms at rate, plus one MTU.
+        buffer = min(int((rate / 1000 + 1600) * 1e9 / rate) >> 6, 0xFFFFFFFF)
+        ratespec = struct.pack(
+            "=BBHhHI", 0, TC_LINKLAYER_ETHERNET, 0, 0, 0, min(rate, 0xFFFFFFFF)
+        )
+        options = attr(
+            TCA_HTB_PARMS,
+            ratespec + ratespec + struct.pack("=IIIII", buffer, buffer, 0, 0, 0),
+        )
+        if rate > 0xFFFFFFFF:
+            options += attr_u64(TCA_HTB_RATE64, rate) + attr_u64(TCA_HTB_CEIL64, rate)
+        return self._request(
+            "add class 1:{:x} on {}".format(class_id, self.tc.dev),
+            rtnetlink.RTM_NEWTCLASS,
+            rtnetlink.tcmsg(self.ifindex, HTB_HANDLE | class_id, HTB_HANDLE)
+            + self._kind("htb", options),
+            flags=rtnetlink.NLM_F_CREATE | rtnetlink.NLM_F_EXCL,
+        )
+
+    def del_class(self, class_id):
+        """Delete htb class."""
+        return self._request(
+            "delete class 1:{:x} on {}".format(class_id, self.tc.dev),
+            rtnetlink.RTM_DELTCLASS,
+            rtnetlink.tcmsg(self.ifindex, HTB_HANDLE | class_id, HTB_HANDLE),
+        )
+
+    def _netem(self, class_id, handle, delay, loss, flags):
+        """Send netem qdisc request."""
+        latency = int(parse_time(delay) * 1e9)
+        qopt = struct.pack(
+            "=IIIIII",
+            min(latency >> 6, 0xFFFFFFFF),
+            1000,
+            int(round(parse_percent(loss) * 0xFFFFFFFF)),
+            0,
+            0,
+            0,
+        )
+        options = qopt + attr(TCA_NETEM_LATENCY64, struct.pack("=q", latency))
+        return self._request(
+            "netem delay {} loss {} on 1:{:x} of {}".format(
+                delay, loss, class_id, self.tc.dev
+            ),
+            rtnetlink.RTM_NEWQDISC,
+            rtnetlink.tcmsg(self.ifindex, handle, HTB_HANDLE | class_id)
+            + self._kind("netem", options),
+            flags=flags,
+        )
+
+    def add_netem(self, class_id, delay, loss):
+        """Add netem qdisc to htb class."""
+        return self._netem(
+            class_id,
+            0,
+            delay,
+            loss,
+            flags=rtnetlink.NLM_F_CREATE | rtnetlink.NLM_F_EXCL,
+        )
+
+    def change_netem(self, class_id, handle, delay, loss):
+        """Change delay and loss of netem qdisc."""
+        return self._netem(class_id, handle, delay, loss, flags=0)
+
+    def add_hash_table(self, handle, divisor):
+        """Create u32 hash table."""
+        return self._request(
+            "add u32 hash table {}: on {}".format(handle, self.tc.dev),
+            rtnetlink.RTM_NEWTFILTER,
+            self._filter_msg(self._u32_handle(handle))
+            + self._kind("u32", attr_u32(TCA_U32_DIVISOR, divisor)),
+            flags=rtnetlink.NLM_F_CREATE | rtnetlink.NLM_F_EXCL,
+        )
+
+    def add_hash_link(self, handle, mask):
+        """Link u32 root table to hash table, hashing the ports word."""
+        options = attr_u32(TCA_U32_LINK, self._u32_handle(handle))
+        options += self._u32_sel([(0, 0, 0)], hmask=int(mask, 16), hoff=20)
+        return self._request(
+            "link u32 hash table {}: on {}".format(handle, self.tc.dev),
+            rtnetlink.RTM_NEWTFILTER,
+            self._filter_msg() + self._kind("u32", options),
+            flags=rtnetlink.NLM_F_CREATE | rtnetlink.NLM_F_EXCL,
+        )
+
+    def add_port_filter(self, handle, bucket, class_id, match, port):
+        """Add u32 filter to hash table bucket, catching packets on port."""
+        mask, shift = PORT_MATCH[match]
+        options = attr_u32(TCA_U32_HASH, self._u32_handle(handle, bucket))
+        options += attr_u32(TCA_U32_CLASSID, HTB_HANDLE | class_id)
+        options += self._u32_sel(
+            [(mask, int(port) << shift, 20)], flags=TC_U32_TERMINAL
+        )
+        return self._request(
+            "add u32 filter {} {} to 1:{:x} on {}".format(
+                match, port, class_id, self.tc.dev
+            ),
+            rtnetlink.RTM_NEWTFILTER,
+            self._filter_msg() + self._kind("u32", options),
+            flags=rtnetlink.NLM_F_CREATE | rtnetlink.NLM_F_EXCL,
+        )
+
+    def del_filter(self, fh):
+        """Delete u32 filter."""
+        return self._request(
+            "delete u32 filter {:x} on {}".format(fh, self.tc.dev),
+            rtnetlink.RTM_DELTFILTER,
+            self._filter_msg(fh) + rtnetlink.attr_str(rtnetlink.TCA_KIND, "u32"),
+        )
+
+    def qdiscs(self):
+        """Return qdiscs of device."""
+        qdiscs = []
+        for fields, attrs in self.nl.dump_tc(rtnetlink.RTM_GETQDISC, self.ifindex):
+            parent = fields["parent"]
+            qdisc = {
+                "kind": rtnetlink.parse_str(attrs.get(rtnetlink.TCA_KIND, b"")),
+                "handle": fields["handle"],
+                "parent": "{:x}:{:x}".format(parent >> 16, parent & 0xFFFF),
+                "root": parent == rtnetlink.TC_H_ROOT,
+                "delay": 0.0,
+                "loss": 0.0,
+            }
+            options = attrs.get(rtnetlink.TCA_OPTIONS, b"")
+            if qdisc["kind"] == "netem" and len(options) >= 24:
+                latency, _, loss = struct.unpack_from("=III", options)
+                netem_attrs = rtnetlink.parse_attrs(options[24:])
+                if TCA_NETEM_LATENCY64 in netem_attrs:
+                    latency = struct.unpack_from(
+                        "=q", netem_attrs[TCA_NETEM_LATENCY64]
+                    )[0]
+                else:
+                    latency <<= 6
+                qdisc["delay"] = latency / 1e9
+                qdisc["loss"] = loss / 0xFFFFFFFF
+            qdiscs.append(qdisc)
+        return qdiscs
+
+    def class_ids(self):
+        """Return htb class ids of device."""
+        return [
+            fields["handle"] & 0xFFFF
+            for fields, _ in self.nl.dump_tc(rtnetlink.RTM_GETTCLASS, self.ifindex)
+            if fields["handle"] >> 16 == HTB_HANDLE >> 16
+        ]
+
+    def port_filters(self):
+        """Return u32 hash tables and port filters of device.
+
+        Port filters are listed as (hash table, port, class id, filter handle).
+        """
+        tables = set()
+        port_filters = []
+        for fields, attrs in self.nl.dump_tc(
+            rtnetlink.RTM_GETTFILTER, self.ifindex, parent=HTB_HANDLE
+        ):
+            if rtnetlink.TCA_OPTIONS not in attrs:
+                continue
+            options = rtnetlink.parse_attrs(attrs[rtnetlink.TCA_OPTIONS])
+            table = "{:x}".format(fields["handle"] >> 20)
+            if TCA_U32_DIVISOR in options:
+                tables.add(table)
+            elif TCA_U32_CLASSID in options and TCA_U32_SEL in options:
+                sel = options[TCA_U32_SEL]
+                if sel[2] < 1 or len(sel) < 32:
+                    continue
+                mask, value = struct.unpack_from(">II", sel, 16)
+                shift = (mask & -mask).bit_length() - 1
+                class_id = rtnetlink.parse_u32(options[TCA_U32_CLASSID]) & 0xFFFF
+                port = (value & mask) >> shift
+                port_filters.append((table, port, class_id, fields["handle"]))
+        return tables, port_filters
+
+
+BACKENDS = {"shell": ShellBackend, "netlink": NetlinkBackend}
+
+
+def get_backend(name, tc):
+    """Return backend, falling back to the shell backend if unavailable."""
+    try:
+        return BACKENDS[name](tc)
+    except OSError as ex:
+        flog.warning("{} backend not available ({}), using shell".format(name, ex))
+        return ShellBackend(tc)
@@ -1,29 +1,143 @@
 import flog
-import threading
+import asyncio
+import json
+import os
+import time
 import ssl
 from socket import socket, AF_INET, SOCK_STREAM
 from config_handler import ServerConfig
 
 
-def tcp_tls_handle(conn_stream, client_sock):
-    """Echo data over TLS connection."""
-    flog.info("TCP TLS Handle Launched.")
-    while True:
-        try:
-            data = conn_stream.read()
-            if data:
-                flog.debug("Received TCP TLS: {}".format(data))
-                conn_stream.send(data)
-            if not data:
-                conn_stream.close()
-                client_sock.close()
-                break
-        except Exception as ex:
-            flog.warning("TCP TLS Handler Exception: {}".format(ex))
-            conn_stream.close()
-            client_sock.close()
-            break
-    flog.info("End TCP TLS Handler.")
+DEFAULT_TICKET_ROTATION = "3600"
+DEFAULT_STATS_INTERVAL = "10"
+DEFAULT_MAX_CONNECTIONS = "4096"
+DEFAULT_BUFFER_SIZE = "262144"
+# Pending echo data per connection before reading is paused
+write_buffer_limit = 256 * 1024
+# Echo buffers, only held by connections while echoing data
+_buffers = []
+# Contexts shared by servers using the same certificates
+_contexts = {}
+
+
+class TlsEcho(asyncio.BufferedProtocol):
+    """Echo data received over TLS connection.
+
+    Decrypted data is read into a reused buffer, and records received in the
+    same event loop iteration are echoed with a single write. Reading is
+    paused while the peer does not consume the echo.
+    """
+
+    def __init__(self, timeout, buffer_size=DEFAULT_BUFFER_SIZE):
+        """Initialize echo closing connection after timeout seconds idle."""
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.buffer = None
+        self.pending = 0
+        self.flush_handle = None
+        self.transport = None
+        self.loop = asyncio.get_running_loop()
+        self.closed = self.loop.create_future()
+        self.last_activity = self.loop.time()
+        self.idle_handle = None
+
+    def connection_made(self, transport):
+        """Start echo on established TLS connection."""
+        self.transport = transport
+        transport.set_write_buffer_limits(high=write_buffer_limit)
+        self.idle_handle = self.loop.call_later(self.timeout, self.check_idle)
+        flog.info(
+            f"TCP TLS Handle Launched for {transport.get_extra_info('peername')}."
+        )
+        flog.debug(f"Connection cipher suite: {transport.get_extra_info('cipher')}")
+
+    def get_buffer(self, sizehint):
+        """Get free part of echo buffer to read data into."""
+        if self.buffer is None:
+            self.buffer = _buffers.pop() if _buffers else bytearray(self.buffer_size)
+        elif self.pending == len(self.buffer):
+            self.flush()
+            return self.get_buffer(sizehint)
+        return memoryview(self.buffer)[self.pending :]
+
+    def buffer_updated(self, nbytes):
+        """Queue echo of data read into buffer."""
+        self.last_activity = self.loop.time()
+        self.pending += nbytes
+        if self.flush_handle is None:
+            self.flush_handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """Echo pending data and release buffer."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.buffer is None:
+            return
+        if self.pending and not self.transport.is_closing():
+            # Transport may keep written data, it gets a copy of the buffer
+            self.transport.write(bytes(memoryview(self.buffer)[: self.pending]))
+        self.pending = 0
+        if len(self.buffer) == self.buffer_size:
+            _buffers.append(self.buffer)
+        self.buffer = None
+
+    def eof_received(self):
+        """Echo pending data before closing connection."""
+        self.flush()
+
+    def pause_writing(self):
+        """Stop reading until echo data is sent."""
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        """Resume reading once echo data is sent."""
+        self.transport.resume_reading()
+
+    def check_idle(self):
+        """Close connection if it was idle for timeout."""
+        idle = self.loop.time() - self.last_activity
+        if idle < self.timeout:
+            self.idle_handle = self.loop.call_later(
+                self.timeout - idle, self.check_idle
+            )
+            return
+        flog.warning("TCP TLS Handler Exception: idle for {}s".format(self.timeout))
+        self.transport.close()
+
+    def connection_lost(self, exc):
+        """End echo."""
+        if exc:
+            flog.warning("TCP TLS Handler Exception: {}".format(repr(exc)))
+        self.idle_handle.cancel()
+        self.flush()
+        self.closed.set_result(None)
+        flog.info("End TCP TLS Handler.")
+
+
+class SharedContext:
+    """TLS context shared between servers, rebuilt to rotate ticket keys."""
+
+    def __init__(self, build, rotation):
+        """Initialize context built by build, rotated every rotation seconds."""
+        self.build = build
+        self.rotation = rotation
+        self.rotations = 0
+        self.context = build()
+        self.created = time.monotonic()
+
+    def get(self):
+        """Get context, rebuilding it if its ticket keys expired.
+
+        A new context has new session ticket keys and an empty session cache,
+        clients holding older sessions fall back to a full handshake.
+        """
+        if self.rotation and time.monotonic() - self.created >= self.rotation:
+            flog.info("Rotating TLS session ticket keys.")
+            self.context = self.build()
+            self.created = time.monotonic()
+            self.rotations += 1
+        return self.context
 
 
 class TcpTLSServer:
@@ -34,17 +148,18 @@ class TcpTLSServer:
         self.config = config
         self.is_mutual = mutual
         self.is_ecdsa = ecdsa
-        self.timeout = int(self.config["tcp_tls"]["timeout"])
         self.local_ip = "0.0.0.0"
         self.tcp_server = socket(AF_INET, SOCK_STREAM)
-        if self.is_ecdsa:
-            self.timeout = int(self.config["ecdsa_tcp_tls"]["timeout"])
-            self.fullchain = self.config["ecdsa_tcp_tls"]["fullchain"]
-            self.privkey = self.config["ecdsa_tcp_tls"]["privkey"]
-        else:
-            self.timeout = int(self.config["tcp_tls"]["timeout"])
-            self.fullchain = self.config["tcp_tls"]["fullchain"]
-            self.privkey = self.config["tcp_tls"]["privkey"]
+        section = "ecdsa_tcp_tls" if self.is_ecdsa else "tcp_tls"
+        self.timeout = int(self.config[section]["timeout"])
+        self.fullchain = self.config[section]["fullchain"]
+        self.privkey = self.config[section]["privkey"]
+        self.buffer_size = int(self.config[section].get("buffer", DEFAULT_BUFFER_SIZE))
+        self.session_tickets = int(self.config[section].get("session_tickets", "1"))
+        self.ticket_rotation = int(
+            self.config[section].get("ticket_rotation", DEFAULT_TICKET_ROTATION)
+        )
+        self.CAroot = None
         flog.debug(f"[mutual={self.is_mutual}][ecdsa={self.is_ecdsa}] Server Config")
         if not self.is_mutual and not self.is_ecdsa:
             self.port = int(self.config["tcp_tls"]["port"])
@@ -56,69 +171,131 @@ class TcpTLSServer:
         elif self.is_mutual and self.is_ecdsa:
             self.port = int(self.config["ecdsa_tcp_tls_mutual"]["port"])
             self.CAroot = self.config["ecdsa_tcp_tls_mutual"]["CAroot"]
+        self.shared_context = self.get_shared_context()
+        self.stats = {"handshakes": 0, "resumed": 0, "failed": 0, "connections": 0}
 
-    def run(self):
-        """Run TCP TLS server."""
+    def tls_context(self):
+        """Build TLS context of server."""
         TLS_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
         TLS_context.set_ciphers("ALL:@SECLEVEL=0")
         flog.debug("Loading cert and keyfile")
         TLS_context.load_cert_chain(certfile=self.fullchain, keyfile=self.privkey)
+        if not self.session_tickets:
+            # Resume from server session cache only
+            TLS_context.options |= ssl.OP_NO_TICKET
         if self.is_mutual:
             flog.debug("Setting server to mutual authentication.")
             # CA root used for verifying Client certificates
             TLS_context.load_verify_locations(cafile=self.CAroot)
             TLS_context.verify_mode = ssl.CERT_REQUIRED
+        return TLS_context
 
-        self.tcp_server.bind((self.local_ip, self.port))
-        self.tcp_server.listen(5)
+    def get_shared_context(self):
+        """Get context shared by servers with the same TLS settings."""
+        key = (self.fullchain, self.privkey, self.CAroot, self.session_tickets)
+        if key not in _contexts:
+            _contexts[key] = SharedContext(self.tls_context, self.ticket_rotation)
+        return _contexts[key]
 
+    def get_stats(self):
+        """Get session resumption counters of server."""
+        stats = dict(
+            self.stats, port=self.port, rotations=self.shared_context.rotations
+        )
+        stats["session_cache"] = self.shared_context.context.session_stats()
+        return stats
+
+    def listen(self):
+        """Listen on TLS port."""
         flog.debug("Starting TCP TLS server on {}".format(self.port))
+        self.tcp_server.bind((self.local_ip, self.port))
+        self.tcp_server.listen(100)
+        self.tcp_server.setblocking(False)
 
+    async def serve(self, limit):
+        """Accept TLS connections, handshakes run concurrently on event loop.
+
+        No connection is accepted while limit connections are open, at most
+        one accepted connection waits for a slot.
+        """
+        loop = asyncio.get_running_loop()
+        tasks = set()
         while True:
-            # listen for tcp then wrap with TLS
-            client_sock, client_address = self.tcp_server.accept()
-            client_sock.settimeout(self.timeout)
-            flog.info(f"TCP Socket Connected to {client_address}.")
-            try:
-                conn_stream = TLS_context.wrap_socket(client_sock, server_side=True)
-                flog.debug(f"Connection cipher suite: {conn_stream.cipher()}")
-                TLS_thread = threading.Thread(
-                    target=tcp_tls_handle, args=(conn_stream, client_sock)
-                )
-                TLS_thread.start()
-            except Exception as ex:
-                flog.info("Could not wrap socket. Closing TCP Socket.")
-                flog.info(ex)
-            finally:
-                client_sock.close()
+            # Wait for a free connection slot, shared with other ports
+            async with limit:
+                pass
+            client_sock, _ = await loop.sock_accept(self.tcp_server)
+            await limit.acquire()
+            task = loop.create_task(self.connect(client_sock))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda _: limit.release())
+
+    async def connect(self, client_sock):
+        """Run TLS handshake of accepted connection and echo data."""
+        loop = asyncio.get_running_loop()
+        try:
+            transport, protocol = await loop.connect_accepted_socket(
+                lambda: TlsEcho(self.timeout, self.buffer_size),
+                client_sock,
+                ssl=self.shared_context.get(),
+                ssl_handshake_timeout=self.timeout,
+            )
+        except Exception as ex:
+            self.stats["failed"] += 1
+            flog.info("Could not wrap socket: {}".format(ex))
+            client_sock.close()
+            return
+        self.stats["handshakes"] += 1
+        if transport.get_extra_info("ssl_object").session_reused:
+            self.stats["resumed"] += 1
+        self.stats["connections"] += 1
+        try:
+            await protocol.closed
+        finally:
+            self.stats["connections"] -= 1
+
+
+def publish_stats(servers, location):
+    """Publish TLS session counters of servers to file."""
+    stats = {server.port: server.get_stats() for server in servers}
+    tmp_path = "%s.tmp" % location
+    with open(tmp_path, "w") as stats_file:
+        json.dump(stats, stats_file, indent=2)
+    os.replace(tmp_path, location)
+
+
+async def serve_tls(config, servers):
+    """Serve TLS echo servers and publish their stats."""
+    limit = asyncio.Semaphore(
+        int(config["tcp_tls"].get("max_connections", DEFAULT_MAX_CONNECTIONS))
+    )
+    tasks = [asyncio.create_task(server.serve(limit)) for server in servers]
+    location = os.path.expandvars(config["api"]["tls_stats"]["location"])
+    interval = int(config["api"]["tls_stats"].get("interval", DEFAULT_STATS_INTERVAL))
+    while not any(task.done() for task in tasks):
+        try:
+            publish_stats(servers, location)
+        except Exception as e:
+            flog.error("Failed to publish TLS stats: {}".format(e))
+        await asyncio.wait(tasks, timeout=interval, return_when=asyncio.FIRST_COMPLETED)
+    await asyncio.gather(*tasks)
 
 
 def run_tcp_tls_server():
     """Run TCP TLS server."""
     flog.info("Starting TCP TLS echo server")
     config = ServerConfig()
-    tcp_tls_server = TcpTLSServer(config)
-    tcp_tls_server_mutual = TcpTLSServer(config, mutual=True)
-    ecdsa_tcp_tls_server = TcpTLSServer(config, ecdsa=True)
-    ecdsa_tcp_tls_server_mutual = TcpTLSServer(config, mutual=True, ecdsa=True)
-    flog.debug("Launch tls tcp server thread.")
-    tcp_tls_thread = threading.Thread(target=tcp_tls_server.run, args=())
-    tcp_tls_thread.start()
-    flog.debug("Launch tcp tls mutual authentication server thread.")
-    tcp_tls_mutual_thread = threading.Thread(target=tcp_tls_server_mutual.run, args=())
-    tcp_tls_mutual_thread.start()
-    flog.debug("Launch ecdsa tcp tls server thread.")
-    ecdsa_tcp_tls_thread = threading.Thread(target=ecdsa_tcp_tls_server.run, args=())
-    ecdsa_tcp_tls_thread.start()
-    flog.debug("Launch ecdsa tcp tls mutual authentication server thread.")
-    ecdsa_tcp_tls_mutual_thread = threading.Thread(
-        target=ecdsa_tcp_tls_server_mutual.run, args=()
-    )
-    ecdsa_tcp_tls_mutual_thread.start()
-    tcp_tls_thread.join()
-    tcp_tls_mutual_thread.join()
-    ecdsa_tcp_tls_thread.join()
-    ecdsa_tcp_tls_mutual_thread.join()
+    servers = [
+        TcpTLSServer(config),
+        TcpTLSServer(config, mutual=True),
+        TcpTLSServer(config, ecdsa=True),
+        TcpTLSServer(config, mutual=True, ecdsa=True),
+    ]
+    for server in servers:
+        server.listen()
+    # All TLS ports share one event loop
+    asyncio.run(serve_tls(config, servers))
 
 
 if __name__ == "__main__":
@@ -1,84 +1,278 @@
 """Traffic control module to configure tc rules on server."""
 import os
+import re
+import argparse
 import subprocess
 import socket
 from enum import Enum
 import flog
+import tc_backend
 from config_handler import ConfigHandler
 
 CONFIG = "$FLAKE_TOOLS/host/config/network_emulation.json"
 
+# u32 hash tables used to classify packets by port, keyed on the low byte of
+# the port: (handle, hash mask on the ports word at offset 20, port match).
+PORT_HASH_TABLES = [("100", "0x000000ff", "dport"), ("200", "0x00ff0000", "sport")]
+PORT_HASH_DIVISOR = 256
+
+# ipset bitmap:port sets matched by the iptables rules.
+ACCEPT_SET = "flake_accept_{protocol}"
+REDIRECT_SET = "flake_{protocol}_{dst}"
+LOSS_SET = "flake_loss_{loss}"
+
 
 class Command(Enum):
     """Command enum."""
 
     Tc = "tc"
     Iptables = "iptables"
+    IptablesRestore = "iptables-restore"
+    Ipset = "ipset"
 
 
 class TrafficControl:
     """Traffic control class to handle tc rules."""
 
-    def __init__(self, config):
-        """Initialize traffic control handler."""
+    def __init__(self, config, batch=False, dry_run=False, backend="shell"):
+        """Initialize traffic control handler.
+
+        In batch mode, tc rules are queued in an in-memory plan and applied
+        with a single `tc -batch` call (see apply_tc_plan), iptables rules are
+        queued in a ruleset and applied with a single `iptables-restore` call
+        (see apply_iptables_plan), after the ipset port sets they match.
+        In dry run mode, commands and rulesets are printed instead of applied.
+        tc rules are applied by the given backend (see tc_backend), "netlink"
+        talks to the kernel directly, "shell" runs the tc tool.
+        """
         self.config = config
         self.server_config = config.server
+        self.batch = batch
+        self.dry_run = dry_run
+        self.backend = tc_backend.get_backend(backend, self)
         self.dev = self._get_dev()
         self.index = 0
+        self.tc_plan = []
+        self.iptables_plan = {"filter": [], "nat": [], "mangle": []}
+        self.ipset_plan = []
+        self.port_sets = set()
 
     def run(self, command, tool=Command.Tc, output=False):
         """Run traffic control command."""
         cmd = "{} ".format(tool.value) if tool else ""
         cmd += command
         flog.debug(cmd)
+        if self.dry_run and not output:
+            print(cmd)
+            return True
         if output:
             return subprocess.check_output(cmd, shell=True).decode("utf-8").strip()
         return os.system(cmd) == 0
 
+    def run_tc(self, command):
+        """Run tc command, or queue it in the tc plan in batch mode."""
+        if not self.batch:
+            return self.run(command)
+        flog.debug("queued: {} {}".format(Command.Tc.value, command))
+        self.tc_plan.append(command)
+        return True
+
+    def apply_tc_plan(self):
+        """Apply queued tc commands with a single tc batch call.
+
+        tc is run with -force so that every line is attempted, failures are
+        reported per line.
+        """
+        if not self.tc_plan:
+            return True
+        if self.dry_run:
+            print("\n".join(self.tc_plan))
+            self.tc_plan = []
+            return True
+        flog.debug(
+            "{} -force -batch - ({} commands)".format(
+                Command.Tc.value, len(self.tc_plan)
+            )
+        )
+        rsp = subprocess.run(
+            [Command.Tc.value, "-force", "-batch", "-"],
+            input="\n".join(self.tc_plan) + "\n",
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        failures = self._parse_batch_errors(rsp.stderr)
+        for line, error in failures:
+            flog.error(
+                "tc batch line {}: '{}' failed: {}".format(
+                    line, self.tc_plan[line - 1], error
+                )
+            )
+        self.tc_plan = []
+        return rsp.returncode == 0 and not failures
+
+    def run_iptables(self, rule, table="filter"):
+        """Run iptables rule, or queue it in the iptables plan in batch mode."""
+        if not self.batch:
+            return self.run("-t {} {}".format(table, rule), tool=Command.Iptables)
+        flog.debug("queued: {} -t {} {}".format(Command.Iptables.value, table, rule))
+        self.iptables_plan[table].append(rule)
+        return True
+
+    def iptables_ruleset(self):
+        """Return queued iptables rules in iptables-restore format."""
+        lines = []
+        for table, rules in self.iptables_plan.items():
+            if not rules:
+                continue
+            lines.append("*{}".format(table))
+            lines.extend(rules)
+            lines.append("COMMIT")
+        return lines
+
+    def run_ipset(self, command):
+        """Run ipset command, or queue it in the ipset plan in batch mode."""
+        if not self.batch:
+            return self.run("-exist {}".format(command), tool=Command.Ipset)
+        flog.debug("queued: {} {}".format(Command.Ipset.value, command))
+        self.ipset_plan.append(command)
+        return True
+
+    def apply_ipset_plan(self):
+        """Apply queued ipset commands with a single ipset restore call."""
+        if not self.ipset_plan:
+            return True
+        plan = self.ipset_plan
+        self.ipset_plan = []
+        if self.dry_run:
+            print("\n".join(plan))
+            return True
+        flog.debug(
+            "{} -exist restore ({} lines)".format(Command.Ipset.value, len(plan))
+        )
+        rsp = subprocess.run(
+            [Command.Ipset.value, "-exist", "restore"],
+            input="\n".join(plan) + "\n",
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        if rsp.returncode != 0:
+            flog.error("ipset restore failed: {}".format(rsp.stderr.strip()))
+            return False
+        return True
+
+    def _create_port_set(self, name, rules):
+        """Create ipset of ports and the iptables rules matching it.
+
+        rules is a list of (rule, table), with {name} replaced by the set name.
+        """
+        if name in self.port_sets:
+            return True
+        self.port_sets.add(name)
+        if not self.run_ipset("create {} bitmap:port range 0-65535".format(name)):
+            return False
+        for rule, table in rules:
+            if not self.run_iptables(rule.format(name=name), table=table):
+                return False
+        return True
+
+    def _add_to_port_set(self, name, ports, action="add"):
+        """Add ports (or port ranges) to ipset."""
+        for port in ports:
+            port = str(port).replace(":", "-")
+            if not self.run_ipset("{} {} {}".format(action, name, port)):
+                return False
+        return True
+
+    def apply_iptables_plan(self):
+        """Apply queued iptables rules with a single iptables-restore call.
+
+        Queued ipset commands are applied first, as rules refer to the sets.
+        --noflush is used so that rules not managed here are kept.
+        """
+        if not self.apply_ipset_plan():
+            return False
+        ruleset = self.iptables_ruleset()
+        self.iptables_plan = {table: [] for table in self.iptables_plan}
+        if not ruleset:
+            return True
+        if self.dry_run:
+            print("\n".join(ruleset))
+            return True
+        flog.debug(
+            "{} --noflush ({} lines)".format(
+                Command.IptablesRestore.value, len(ruleset)
+            )
+        )
+        rsp = subprocess.run(
+            [Command.IptablesRestore.value, "--noflush"],
+            input="\n".join(ruleset) + "\n",
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        if rsp.returncode != 0:
+            error = rsp.stderr.strip()
+            match = re.search(r"line (\d+)", error)
+            if match and 0 < int(match.group(1)) <= len(ruleset):
+                error += " ('{}')".format(ruleset[int(match.group(1)) - 1])
+            flog.error("iptables-restore failed: {}".format(error))
+            return False
+        return True
+
+    @staticmethod
+    def _parse_batch_errors(stderr):
+        """Return list of (line, error) from tc batch stderr output."""
+        failures = []
+        messages = []
+        for line in stderr.splitlines():
+            match = re.match(r"Command failed \S*:(\d+)", line)
+            if match:
+                failures.append((int(match.group(1)), " ".join(messages)))
+                messages = []
+            elif line.strip():
+                messages.append(line.strip())
+        return failures
+
     def _get_dev(self):
         """Get interface device."""
-        cmd = "ip route | grep default | awk '{print $5}'"
-        rsp = self.run(cmd, tool=None, output=True)
+        rsp = self.backend.get_dev()
         flog.debug("dev: {}".format(rsp))
         return rsp
 
     def accept_ports(self, protocol, ports):
-        """Accept ports via iptables."""
-        cmd = "-I INPUT -p {protocol} --match multiport --dport {ports} -j ACCEPT"
-        ports_list = ",".join(ports)
-        cmd = cmd.format(ports=ports_list, protocol=protocol)
-        return self.run(cmd, tool=Command.Iptables)
+        """Accept ports via iptables, matching an ipset of ports."""
+        name = ACCEPT_SET.format(protocol=protocol)
+        cmd = "-I INPUT -p {protocol} -m set --match-set {{name}} dst -j ACCEPT"
+        cmd = cmd.format(protocol=protocol)
+        if not self._create_port_set(name, [(cmd, "filter")]):
+            return False
+        return self._add_to_port_set(name, ports)
 
     def redirect_ports(self, protocol, src_list, dst):
-        """Redirect ports via iptables."""
-        cmd = "-t nat -I PREROUTING -p {protocol} " "--match multiport --dport {ports}"
+        """Redirect ports via iptables, matching an ipset of ports."""
+        name = REDIRECT_SET.format(protocol=protocol, dst=dst.replace(".", "_"))
+        cmd = "-I PREROUTING -p {protocol} -m set --match-set {{name}} dst"
         if "." in dst:
             cmd += " -j DNAT --to-destination {dst}"
         else:
             cmd += " -j REDIRECT --to-port {dst}"
-        ports_list = ",".join(src_list)
-        cmd = cmd.format(protocol=protocol, ports=ports_list, dst=dst)
-        return self.run(cmd, tool=Command.Iptables)
+        cmd = cmd.format(protocol=protocol, dst=dst)
+        if not self._create_port_set(name, [(cmd, "nat")]):
+            return False
+        return self._add_to_port_set(name, src_list)
 
     def show_ip_tables(self):
         """Show ip tables rules."""
+        if self.dry_run:
+            return
         flog.info("IP Table Rules:")
         flog.info(self.run("-n -L --line-numbers", tool=Command.Iptables, output=True))
         flog.info(
             self.run("-t nat -n -L --line-numbers", tool=Command.Iptables, output=True)
         )
 
-    def port_range_to_ports(self, port_set):
-        ports = [port_set]
-        if ":" in port_set:
-            ports = []
-            port = int(port_set.split(":")[0])
-            max_port = int(port_set.split(":")[1])
-            while port < max_port:
-                ports.append("%s" % port)
-                port += 1
-        return ports
-
     def add_ip_tables(self, host=None):
         """Add ip table rules.
 
@@ -92,9 +286,9 @@ class TrafficControl:
             filter_host = socket.gethostbyname(hostname)
             assert host, "Unable to get host from hostname %s" % hostname
             flog.debug("Redirect connections to host %s to %s" % (filter_host, host))
-            self.run(
-                "-t nat -A POSTROUTING -o eth0 -j SNAT --to-source %s" % filter_host,
-                tool=Command.Iptables,
+            self.run_iptables(
+                "-A POSTROUTING -o eth0 -j SNAT --to-source %s" % filter_host,
+                table="nat",
             )
         for protocol, protocol_set in self.server_config["ports"].items():
             for default_port, port_set in protocol_set.items():
@@ -108,59 +302,62 @@ class TrafficControl:
                     protocol=protocol, src_list=port_set, dst=default_port
                 ):
                     return False
-        self.show_ip_tables()
         return True
 
     def _create_htb(self):
         """Create htb class."""
-        return self.run(
-            command="qdisc add dev {dev} root handle 1: htb".format(dev=self.dev)
-        )
+        return self.backend.add_htb()
 
     def clear_htb(self):
         """Clear htb class."""
-        self.run(command="qdisc del dev {dev} root htb".format(dev=self.dev))
+        self.backend.del_htb()
 
     def _create_htb_class(self, class_id, rate="1000mbit"):
         """Create htb class to hold rules."""
-        return self.run(
-            "class add dev {dev} parent 1: classid 1:{class_id} htb rate {rate}".format(
-                dev=self.dev, class_id=class_id, rate=rate
-            )
-        )
+        return self.backend.add_class(class_id, rate)
+
+    def _create_port_filter_tables(self):
+        """Create u32 hash tables to catch packets on port.
+
+        Packets are hashed on the low byte of the destination port, then of
+        the source port, so classification does not depend on the number of
+        ports configured.
+        """
+        for handle, _, _ in PORT_HASH_TABLES:
+            if not self.backend.add_hash_table(handle, PORT_HASH_DIVISOR):
+                return False
+        for handle, mask, _ in PORT_HASH_TABLES:
+            if not self.backend.add_hash_link(handle, mask):
+                return False
+        return True
 
     def _add_port_filter(self, class_id, port):
         """Add filter to class to catch packets on port."""
-        if not self.run(
-            "filter add dev {dev} parent 1: protocol ip prio 1 u32 flowid 1:{class_id} match ip dport {port} 0xffff".format(
-                dev=self.dev, class_id=class_id, port=port
-            )
-        ):
-            return False
-        return (
-            self.run(
-                "filter add dev {dev} parent 1: protocol ip prio 1 u32 flowid 1:{class_id} match ip sport {port} 0xffff".format(
-                    dev=self.dev, class_id=class_id, port=port
-                )
-            ),
-            "failed to add filter.",
-        )
+        bucket = int(port) % PORT_HASH_DIVISOR
+        for handle, _, match in PORT_HASH_TABLES:
+            if not self.backend.add_port_filter(handle, bucket, class_id, match, port):
+                return False
+        return True
 
     def _add_tc_packet_rule(self, class_id, packet_delay, packet_loss):
         """Add packet loss to rule (tc)."""
-        return self.run(
-            "qdisc add dev {dev} parent 1:{class_id} netem delay {delay} loss {loss}".format(
-                dev=self.dev, class_id=class_id, delay=packet_delay, loss=packet_loss
-            )
-        )
-
-    def _add_ip_packet_rule(self, protocol, port, packet_loss):
-        """Add packet loss to rule (ip)."""
-        return self.run(
-            "-t mangle -A PREROUTING -p {protocol} --dport {port} -m statistic --mode random --probability {loss} -j DROP".format(
-                protocol=protocol, port=port, loss=float(packet_loss.strip("%")) / 100
-            ),
-            tool=Command.Iptables,
+        return self.backend.add_netem(class_id, packet_delay, packet_loss)
+
+    @staticmethod
+    def _loss_set(packet_loss):
+        """Return name of the ipset of ports with given packet loss."""
+        return LOSS_SET.format(loss=packet_loss.strip("%").replace(".", "_"))
+
+    def _add_ip_packet_rule(self, packet_loss):
+        """Add packet loss rule (ip) for the ipset of ports with this loss."""
+        cmd = "-A PREROUTING -p {protocol} -m set --match-set {{name}} dst -m statistic --mode random --probability {loss} -j DROP"
+        loss = float(packet_loss.strip("%")) / 100
+        return self._create_port_set(
+            self._loss_set(packet_loss),
+            [
+                (cmd.format(protocol=protocol, loss=loss), "mangle")
+                for protocol in ("tcp", "udp")
+            ],
         )
 
     def add_egress_rule(
@@ -176,15 +373,14 @@ class TrafficControl:
 
     def add_ingress_rule(self, port, packet_loss="0%"):
         """Add ingress rule for packet loss."""
-        for p in port.values():
-            if not self._add_ip_packet_rule(
-                "tcp", p, packet_loss
-            ) or not self._add_ip_packet_rule("udp", p, packet_loss):
-                return False
-        return True
+        if not self._add_ip_packet_rule(packet_loss):
+            return False
+        return self._add_to_port_set(self._loss_set(packet_loss), port.values())
 
     def show_rules(self):
         """Print rules to console."""
+        if self.dry_run:
+            return True
         flog.info("Traffic Control Rules:")
         flog.info(self.run("qdisc show dev {dev}".format(dev=self.dev), output=True))
         return True
@@ -199,11 +395,14 @@ class TrafficControl:
         assert self.add_ip_tables(host), "Failed to add to ip tables"
 
         if not with_filtering:
+            assert self.apply_iptables_plan(), "Failed to apply ip tables rules"
+            self.show_ip_tables()
             return
 
         # Reset current rules
         self.clear_htb()
         assert self._create_htb(), "Failed to create htb"
+        assert self._create_port_filter_tables(), "Failed to create port filters"
         for name, setup in self.config.items():
             flog.info("Configuring for set: {name}".format(name=name))
             flog.info(
@@ -216,16 +415,11 @@ class TrafficControl:
             for delay, ports in zip(setup["packet_delay"], setup["ports"]):
                 self.index += 1
 
-                if not with_services:
-                    # If the services are remote, the delay is also applied when
-                    # we forward the packet, so we need to divide it in half.
-                    delay = "%fms" % (float(delay.strip("ms")) / 2)
-
                 assert self.add_egress_rule(
                     port=ports,
                     class_id=self.index,
                     packet_loss=setup["packet_loss"],
-                    packet_delay=delay,
+                    packet_delay=self._packet_delay(delay, with_services),
                 ), "Failed to set egress rule"
 
                 # If the services are 'local', we also need to add an ingress rule.
@@ -236,12 +430,209 @@ class TrafficControl:
                         port=ports, packet_loss=setup["packet_loss"]
                     ), "Failed to set ingress rule"
 
+        assert self.apply_iptables_plan(), "Failed to apply ip tables rules"
+        self.show_ip_tables()
+        assert self.apply_tc_plan(), "Failed to apply tc rules"
+
+    @staticmethod
+    def _packet_delay(delay, with_services=True):
+        """Return egress packet delay for a configured delay."""
+        if with_services:
+            return delay
+        # If the services are remote, the delay is also applied when
+        # we forward the packet, so we need to divide it in half.
+        return "%fms" % (float(delay.strip("ms")) / 2)
+
+    def desired_rules(self, with_services=True):
+        """Return desired egress rules from config, indexed by class id."""
+        rules = {}
+        class_id = 0
+        for setup in self.config.values():
+            for delay, ports in zip(setup["packet_delay"], setup["ports"]):
+                class_id += 1
+                packet_delay = self._packet_delay(delay, with_services)
+                rules[class_id] = {
+                    "packet_delay": packet_delay,
+                    "packet_loss": setup["packet_loss"],
+                    "delay": tc_backend.parse_time(packet_delay),
+                    "loss": tc_backend.parse_percent(setup["packet_loss"]),
+                    "ports": [int(p) for p in ports.values()],
+                }
+        return rules
+
+    def current_rules(self):
+        """Read egress rules currently applied on the device.
+
+        Returns None if the htb root or port hash tables are missing.
+        """
+        qdiscs = self.backend.qdiscs()
+        if not any(q["kind"] == "htb" and q["root"] for q in qdiscs):
+            return None
+        rules = {
+            class_id: {"handle": None, "delay": 0.0, "loss": 0.0, "ports": {}}
+            for class_id in self.backend.class_ids()
+        }
+        for qdisc in qdiscs:
+            parent = qdisc["parent"]
+            if qdisc["kind"] != "netem" or not parent.startswith("1:"):
+                continue
+            rule = rules.setdefault(
+                int(parent[2:], 16),
+                {"handle": None, "delay": 0.0, "loss": 0.0, "ports": {}},
+            )
+            rule["handle"] = qdisc["handle"]
+            rule["delay"] = qdisc["delay"]
+            rule["loss"] = qdisc["loss"]
+
+        tables, port_filters = self.backend.port_filters()
+        if not all(handle in tables for handle, _, _ in PORT_HASH_TABLES):
+            return None
+        for handle, port, class_id, fh in port_filters:
+            if class_id in rules:
+                rules[class_id]["ports"][(handle, port)] = fh
+        return rules
+
+    def _del_port_filter(self, fh):
+        """Delete u32 port filter."""
+        return self.backend.del_filter(fh)
+
+    def _change_tc_packet_rule(self, class_id, handle, packet_delay, packet_loss):
+        """Change packet delay and loss of rule (tc)."""
+        return self.backend.change_netem(class_id, handle, packet_delay, packet_loss)
+
+    def _reconcile_ingress_rules(self, desired):
+        """Update ports of the packet loss ipsets which differ from desired."""
+        wanted = {}
+        for rule in desired.values():
+            name = self._loss_set(rule["packet_loss"])
+            ports = wanted.setdefault(name, (rule["packet_loss"], set()))[1]
+            ports.update(rule["ports"])
+        current = {}
+        loss_prefix = LOSS_SET.format(loss="")
+        for line in self.run("save", tool=Command.Ipset, output=True).splitlines():
+            if len(line.split()) < 3:
+                continue
+            action, name, *args = line.split()
+            if not name.startswith(loss_prefix):
+                continue
+            if action == "create":
+                # Set exists, so do its packet loss rules.
+                self.port_sets.add(name)
+                current.setdefault(name, set())
+            elif action == "add":
+                current.setdefault(name, set()).add(int(args[0]))
+        for name, ports in current.items():
+            stale = ports - wanted.get(name, (None, set()))[1]
+            if stale:
+                flog.info("Removing ports {} from {}".format(sorted(stale), name))
+            if not self._add_to_port_set(name, sorted(stale), action="del"):
+                return False
+        for name, (packet_loss, ports) in wanted.items():
+            missing = ports - current.get(name, set())
+            if not missing:
+                continue
+            flog.info("Adding ports {} to {}".format(sorted(missing), name))
+            if not self._add_ip_packet_rule(packet_loss):
+                return False
+            if not self._add_to_port_set(name, sorted(missing)):
+                return False
+        return True
 
-def configure_server_rules(config_file=CONFIG, with_filtering=True, with_services=True):
+    def reconcile(self, with_services=True):
+        """Update tc rules to match config, without clearing the htb.
+
+        Only netem qdiscs, classes and port filters which differ from config are
+        added, changed or deleted, so traffic on other ports is not affected.
+        Falls back to a full configure if the htb or port tables are missing.
+        """
+        current = self.current_rules()
+        if current is None:
+            flog.warning("No htb port tables found, running full configure")
+            self.configure(with_services=with_services)
+            return
+        desired = self.desired_rules(with_services)
+
+        for class_id, rule in current.items():
+            wanted = desired.get(class_id)
+            for key, fh in rule["ports"].items():
+                if not wanted or key[1] not in wanted["ports"]:
+                    flog.info(
+                        "Removing port filter {} from 1:{:x}".format(key, class_id)
+                    )
+                    assert self._del_port_filter(fh), "Failed to delete port filter"
+            if not wanted:
+                flog.info("Removing class 1:{:x}".format(class_id))
+                assert self.backend.del_class(class_id), "Failed to delete class"
+
+        for class_id, wanted in desired.items():
+            rule = current.get(class_id)
+            if not rule:
+                flog.info("Adding class 1:{:x}".format(class_id))
+                assert self.add_egress_rule(
+                    port={str(p): p for p in wanted["ports"]},
+                    class_id=class_id,
+                    packet_loss=wanted["packet_loss"],
+                    packet_delay=wanted["packet_delay"],
+                ), "Failed to set egress rule"
+                continue
+            if rule["handle"] is None:
+                assert self._add_tc_packet_rule(
+                    class_id, wanted["packet_delay"], wanted["packet_loss"]
+                ), "Failed to set egress rule"
+            elif (
+                abs(rule["delay"] - wanted["delay"]) > 1e-6
+                or abs(rule["loss"] - wanted["loss"]) > 1e-6
+            ):
+                flog.info(
+                    "Changing 1:{:x}: delay {} loss {}".format(
+                        class_id, wanted["packet_delay"], wanted["packet_loss"]
+                    )
+                )
+                assert self._change_tc_packet_rule(
+                    class_id,
+                    rule["handle"],
+                    wanted["packet_delay"],
+                    wanted["packet_loss"],
+                ), "Failed to change egress rule"
+            for port in wanted["ports"]:
+                current_handles = [
+                    handle
+                    for handle, _, _ in PORT_HASH_TABLES
+                    if (handle, port) in rule["ports"]
+                ]
+                if len(current_handles) != len(PORT_HASH_TABLES):
+                    for handle in current_handles:
+                        assert self._del_port_filter(
+                            rule["ports"][(handle, port)]
+                        ), "Failed to delete port filter"
+                    flog.info("Adding port filter {} to 1:{:x}".format(port, class_id))
+                    assert self._add_port_filter(
+                        class_id, port
+                    ), "Failed to add port filter"
+
+        # If the services are 'local', ingress packet loss is applied with iptables.
+        if with_services:
+            assert self._reconcile_ingress_rules(
+                desired
+            ), "Failed to update ingress rules"
+            assert self.apply_iptables_plan(), "Failed to apply ip tables rules"
+        assert self.apply_tc_plan(), "Failed to apply tc rules"
+
+
+def configure_server_rules(
+    config_file=CONFIG,
+    with_filtering=True,
+    with_services=True,
+    batch=True,
+    dry_run=False,
+    backend="netlink",
+):
     """Configure server rules."""
     config = ConfigHandler(config_file)
     try:
-        tc_manager = TrafficControl(config)
+        tc_manager = TrafficControl(
+            config, batch=batch, dry_run=dry_run, backend=backend
+        )
         tc_manager.configure(with_filtering=with_filtering, with_services=with_services)
         tc_manager.show_rules()
         return True
@@ -250,8 +641,79 @@ def configure_server_rules(config_file=CONFIG, with_filtering=True, with_service
         return False
 
 
+def reconcile_server_rules(
+    config_file=CONFIG, with_services=True, batch=True, dry_run=False, backend="netlink"
+):
+    """Update server rules to match config, without clearing current rules."""
+    config = ConfigHandler(config_file)
+    try:
+        tc_manager = TrafficControl(
+            config, batch=batch, dry_run=dry_run, backend=backend
+        )
+        tc_manager.reconcile(with_services=with_services)
+        tc_manager.show_rules()
+        return True
+    except AssertionError as ex:
+        flog.error(ex)
+        return False
+
+
 def clear_rules(config_file=CONFIG):
     """Wipe server rules."""
     config = ConfigHandler(config_file)
     TrafficControl(config).clear_htb()
     return True
+
+
+def main():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser(description="Flake traffic rules tool.")
+    parser.add_argument(
+        "-c", "--config", type=str, default=CONFIG, help="network emulation config"
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="print tc commands and iptables ruleset instead of applying them",
+    )
+    parser.add_argument(
+        "--no-batch", action="store_true", help="apply rules one command at a time"
+    )
+    parser.add_argument(
+        "-b",
+        "--backend",
+        type=str,
+        default="netlink",
+        choices=sorted(tc_backend.BACKENDS),
+        help="backend used to apply tc rules",
+    )
+    parser.add_argument(
+        "-r",
+        "--reconcile",
+        action="store_true",
+        help="only update tc rules which differ from config",
+    )
+    args = parser.parse_args()
+    if args.reconcile:
+        result = reconcile_server_rules(
+            config_file=args.config,
+            with_services=os.environ.get("SERVICES", "1") == "1",
+            batch=not args.no_batch,
+            dry_run=args.dry_run,
+            backend=args.backend,
+        )
+        return 0 if result else 1
+    result = configure_server_rules(
+        config_file=args.config,
+        with_filtering=os.environ.get("FILTER", "1") == "1",
+        with_services=os.environ.get("SERVICES", "1") == "1",
+        batch=not args.no_batch,
+        dry_run=args.dry_run,
+        backend=args.backend,
+    )
+    return 0 if result else 1
+
+
+if __name__ == "__main__":
+    exit(main())
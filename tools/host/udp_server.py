@@ -1,15 +1,95 @@
 import os
 import time
-from socket import socket, AF_INET, SOCK_DGRAM
+import argparse
+import mmap
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_REUSEPORT
 import threading
 import flog
 from config_handler import ConfigHandler
-from dtls import wrapper as dtls_wrapper
-from dtls import do_patch
-
-do_patch()
+from data_stream import DataStream, parse_rate, parse_size
+from dtls_engine import DtlsEngine, DEFAULT_MAX_ASSOCIATIONS
 
 CONFIG = "$FLAKE_TOOLS/host/config/data_files.json"
+DEFAULT_CACHE_SIZE = "512MB"
+DEFAULT_MAX_TRANSFERS = 16
+# Requested paths are arbitrary, bound the resolved paths kept per server
+MAX_RESOLVED_PATHS = 1024
+CANCEL_REQUEST = "cancel"
+# Close to the former 1KB every 1ms
+DEFAULT_PACING = {"bitrate": "8mbit", "datagram_size": "1024", "burst": "8"}
+
+
+class Pacer:
+    """Token bucket pacing sends to a target rate."""
+
+    def __init__(self, rate, burst):
+        """Initialize pacer with rate (bytes/s) and burst (bytes)."""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def _refill(self, cap=True):
+        """Add tokens for time elapsed since last refill."""
+        now = time.monotonic()
+        tokens = self.tokens + (now - self.last) * self.rate
+        # Idle time does not grant more than a burst
+        self.tokens = min(max(self.burst, self.tokens), tokens) if cap else tokens
+        self.last = now
+
+    def wait(self, size):
+        """Wait until size bytes can be sent."""
+        self._refill()
+        if self.tokens < size:
+            # Sleep until a whole burst is available to batch the next sends,
+            # time slept over target is credited
+            time.sleep((self.burst - self.tokens) / self.rate)
+            self._refill(cap=False)
+        self.tokens -= size
+
+
+class FileCache:
+    """LRU cache of memory mapped files, shared by servers."""
+
+    def __init__(self, max_size):
+        """Initialize cache with memory budget in bytes."""
+        self.max_size = max_size
+        self.size = 0
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """Get file content as a memoryview.
+
+        Files changed on disk since they were mapped are mapped again.
+        """
+        stat = os.stat(path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            entry = self.files.get(path)
+            if entry and entry[0] == key:
+                self.files.move_to_end(path)
+                return entry[1]
+        if stat.st_size == 0:
+            return memoryview(b"")
+        with open(path, "rb") as f:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        with self.lock:
+            old_entry = self.files.pop(path, None)
+            if old_entry:
+                self.size -= len(old_entry[1])
+            self.files[path] = (key, data)
+            self.size += len(data)
+            # Evicted mappings are unmapped once no transfer uses them
+            while self.size > self.max_size and len(self.files) > 1:
+                _, (_, evicted) = self.files.popitem(last=False)
+                self.size -= len(evicted)
+        return data
+
+
+FILE_CACHE = FileCache(parse_size(DEFAULT_CACHE_SIZE))
 
 
 class UdpServer:
@@ -25,104 +105,268 @@ class UdpServer:
         self.secure = secure
         self.echo = echo
         if self.secure is False:
+            section = "udp"
             self.port = int(self.config.server["udp"]["port"])
             self.name = "UDP SERVER"
         else:
             if self.echo is False:
+                section = "dtls"
                 self.port = int(self.config.server["dtls"]["port"])
                 self.timeout = int(self.config.server["dtls"]["timeout"])
                 self.name = "DTLS SERVER"
             else:
+                section = "dtls_echo"
                 self.port = int(self.config.server["dtls_echo"]["port"])
                 self.timeout = int(self.config.server["dtls_echo"]["timeout"])
                 self.name = "DTLS ECHO SERVER"
+        self.log_packets = self.config.server[section].get("log_packets", "0") == "1"
+        pacing = dict(DEFAULT_PACING, **self.config.server[section].get("pacing", {}))
+        self.rate = parse_rate(pacing["bitrate"])
+        self.datagram_size = int(pacing["datagram_size"])
+        self.burst = max(1, int(pacing["burst"])) * self.datagram_size
+
+        self.max_transfers = int(
+            self.config.server[section].get("max_transfers", DEFAULT_MAX_TRANSFERS)
+        )
+        # Cancel events of running transfers per client address
+        self.transfers = {}
+        self.transfers_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_transfers)
+        self.max_associations = int(
+            self.config.server[section].get(
+                "max_associations", DEFAULT_MAX_ASSOCIATIONS
+            )
+        )
 
         self.local_ip = "0.0.0.0"
+        self.resolved_paths = {}
 
-    def get_file(self, path):
-        """Parse path and return file."""
+    def _resolve_path(self, path):
+        """Resolve requested path to file system path."""
+        resolved = self.resolved_paths.get(path)
+        if resolved is not None:
+            return resolved
+        resolved = os.path.join(self.root, path)
         for file_type in self.config.keys():
             if file_type in path:
-                path = os.path.join(self.root, "files", path)
+                resolved = os.path.join(self.root, "files", path)
                 break
-        else:
-            path = os.path.join(self.root, path)
+        if len(self.resolved_paths) < MAX_RESOLVED_PATHS:
+            self.resolved_paths[path] = resolved
+        return resolved
+
+    def get_file(self, path):
+        """Parse path and return file."""
+        try:
+            stream = DataStream.from_path(path)
+        except ValueError as ex:
+            return str.encode("{}\n".format(ex))
+        if stream:
+            flog.info("Streaming {} ({} bytes)".format(path, stream.size))
+            return stream
+        path = self._resolve_path(path)
         if not os.path.exists(path):
             return str.encode("Incorrect path {}\n".format(path))
         if not os.path.isfile(path):
             return str.encode("Given path is not a regular file {}\n".format(path))
-        with open(path, "rb") as f:
-            flog.info("Sending file {}".format(path))
-            return f.read()
+        flog.info("Sending file {}".format(path))
+        return FILE_CACHE.get(path)
+
+    def _datagrams(self, data):
+        """Split file into datagrams."""
+        size = self.datagram_size
+        if not isinstance(data, DataStream):
+            for offset in range(0, len(data), size):
+                yield data[offset : offset + size]
+            return
+        pending = b""
+        for chunk in data.chunks():
+            chunk = pending + chunk
+            end = len(chunk) - len(chunk) % size
+            for offset in range(0, end, size):
+                yield chunk[offset : offset + size]
+            pending = chunk[end:]
+        if pending:
+            yield pending
 
-    def send_file(self, data, addr):
+    def send_file(self, data, addr, cancel=None, send=None):
         """Send file.
 
-        File must be split into smaller packets and sent."""
-        data_size = len(data)
-        increments = 1024
-        for section in range(0, data_size, increments):
-            self.sock.sendto(data[section : (section + increments)], addr)
-            # Sleep between packet sends
-            time.sleep(0.001)
+        File must be split into smaller packets and sent at the configured
+        rate, until cancel event is set. Packets are sent with send if given,
+        else from server socket."""
+        pacer = Pacer(self.rate, self.burst)
+        for datagram in self._datagrams(data):
+            if cancel is not None and cancel.is_set():
+                flog.info("{}: transfer to {} cancelled".format(self.name, addr))
+                return False
+            pacer.wait(len(datagram))
+            if send:
+                send(datagram)
+            else:
+                self.sock.sendto(datagram, addr)
+        return True
+
+    def start_transfer(self, request, addr):
+        """Send requested file from a worker.
+
+        A new request from a client replaces its running transfer.
+        """
+        with self.transfers_lock:
+            previous = self.transfers.pop(addr, None)
+            if previous:
+                previous.set()
+            if request == CANCEL_REQUEST:
+                return False
+            if len(self.transfers) >= self.max_transfers:
+                flog.warning(
+                    "{}: too many transfers, rejecting {}".format(self.name, addr)
+                )
+                self.sock.sendto(b"Too many transfers in progress\n", addr)
+                return False
+            cancel = threading.Event()
+            self.transfers[addr] = cancel
+        self.executor.submit(self._transfer, request, addr, cancel)
+        return True
+
+    def _transfer(self, request, addr, cancel):
+        """Run transfer of requested file."""
+        try:
+            self.send_file(self.get_file(path=request), addr, cancel)
+        except Exception as ex:
+            flog.error("{}: transfer to {} failed: {}".format(self.name, addr, ex))
+        finally:
+            with self.transfers_lock:
+                if self.transfers.get(addr) is cancel:
+                    del self.transfers[addr]
+
+    def dtls_echo(self, association):
+        """Echo datagrams of DTLS association."""
+        while True:
+            data = association.read()
+            if not data:
+                return
+            if self.log_packets:
+                flog.debug(
+                    "{}: Received DTLS from client {} : {} ".format(
+                        self.name, association.addr, data
+                    )
+                )
+            association.write(data)
+
+    def dtls_transfer(self, association):
+        """Send files requested over DTLS association."""
+        while True:
+            data = association.read(self.buffer)
+            if not data:
+                return
+            try:
+                request = data.decode("utf-8")
+            except Exception as ex:
+                flog.error(
+                    "Error decoding data from {} : Exception {}".format(
+                        association.addr, ex
+                    )
+                )
+                continue
+            sent = association.bytes_sent
+            start = time.monotonic()
+            self.send_file(
+                self.get_file(path=request.strip()),
+                association.addr,
+                send=association.write,
+            )
+            flog.info(
+                "{}: sent {} bytes to {} in {:.2f}s".format(
+                    self.name,
+                    association.bytes_sent - sent,
+                    association.addr,
+                    time.monotonic() - start,
+                )
+            )
+
+    def run_dtls(self):
+        """Run DTLS server, each client association is served concurrently."""
+        flog.info("{}: starting server on {}".format(self.name, self.port))
+        engine = DtlsEngine(
+            self.name,
+            (self.local_ip, self.port),
+            self.fullchain,
+            self.privkey,
+            self.dtls_echo if self.echo else self.dtls_transfer,
+            self.timeout,
+            max_associations=self.max_associations,
+        )
+        engine.run()
 
     def run(self):
         """Run UDP server."""
+        if self.secure is True:
+            self.run_dtls()
+            return
         self.udp_server = socket(AF_INET, SOCK_DGRAM)
+        # Workers share the port, the kernel balances flows between them
+        self.udp_server.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         # bind udp socket
         flog.info("{}: starting server on {}".format(self.name, self.port))
         self.udp_server.bind((self.local_ip, self.port))
-        if self.secure is True:
-            # Wrap the socket
-            self.sock = dtls_wrapper.wrap_server(self.udp_server, keyfile=self.privkey,
-                                                 certfile=self.fullchain,
-                                                 do_handshake_on_connect=True)
-            self.sock.settimeout(self.timeout)
-            self.sock.listen(5)
-        else:
-            self.sock = self.udp_server
+        self.sock = self.udp_server
         flog.debug("{}: Waiting for client connection".format(self.name))
         while True:
             # listen for udp
             try:
-                data, addr = self.sock.recvfrom(self.port)
-            except Exception as e:
+                data, addr = self.sock.recvfrom(self.buffer)
+            except Exception:
                 continue
-            flog.debug("{}: Received UDP from client {} : {} ".format(self.name, addr, data))
+            if self.log_packets:
+                flog.debug(
+                    "{}: Received UDP from client {} : {} ".format(
+                        self.name, addr, data
+                    )
+                )
             if data:
-                if self.echo is True:
-                    self.sock.sendto(data, addr)
-                else:
-                    try:
-                        request = data.decode("utf-8")
-                    except Exception as ex:
-                        flog.error("Error decoding data from {} : Exception {}".format(addr, ex))
-                        continue
-                    data = self.get_file(path=request.strip())
-                    self.send_file(data, addr)
-
-
-def run_server(config_file=CONFIG):
-    """Run udp server."""
-    flog.info("Starting UDP server")
+                try:
+                    request = data.decode("utf-8")
+                except Exception as ex:
+                    flog.error(
+                        "Error decoding data from {} : Exception {}".format(addr, ex)
+                    )
+                    continue
+                self.start_transfer(request.strip(), addr)
+
+
+def run_server(config_file=CONFIG, worker=0):
+    """Run udp server.
+
+    DTLS servers keep per client state and only run on first worker.
+    """
+    flog.info("Starting UDP server (worker {})".format(worker))
     config = ConfigHandler(config_file)
-    udp_server = UdpServer(config, secure=False)
-    udp_dtls_server = UdpServer(config, secure=True)
-    dtls_echo_server = UdpServer(config, secure=True, echo=True)
-    flog.info("Launch UDP server thread.")
-    udp_server_thread = threading.Thread(target=udp_server.run, args=())
-    udp_server_thread.start()
-    flog.info("Launch UDP DTLS server thread.")
-    dtls_server_thread = threading.Thread(target=udp_dtls_server.run, args=())
-    dtls_server_thread.start()
-    flog.info("Launch DTLS Echo server thread.")
-    dtls_echo_server_thread = threading.Thread(target=dtls_echo_server.run, args=())
-    dtls_echo_server_thread.start()
-    udp_server_thread.join()
-    dtls_server_thread.join()
-    dtls_echo_server_thread.join()
+    # Files are cached once for all servers of the worker
+    FILE_CACHE.max_size = parse_size(
+        config.server["udp"].get("cache_size", DEFAULT_CACHE_SIZE)
+    )
+    servers = [UdpServer(config, secure=False)]
+    if worker == 0:
+        servers.append(UdpServer(config, secure=True))
+        servers.append(UdpServer(config, secure=True, echo=True))
+    threads = []
+    for server in servers:
+        flog.info("Launch {} thread.".format(server.name))
+        thread = threading.Thread(target=server.run, args=())
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
 
+def main():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser(description="Flake UDP server.")
+    parser.add_argument("-w", "--worker", type=int, default=0, help="worker index")
+    args = parser.parse_args()
+    run_server(worker=args.worker)
 
 
 if __name__ == "__main__":
-    run_server()
+    main()